@@ -0,0 +1,77 @@
+"""
+Memory used by the whole corpus loaded as `Experience` objects, in the compact representation of `utils`
+(slots, shared vocabularies, dose rows by column) against plain objects holding the JSON lists of dicts,
+as `Experience` used to.
+
+    env PYTHONPATH=src python benchmarks/memory.py data/experiences_db
+"""
+import argparse
+import gc
+import json
+import os
+import tracemalloc
+from typing import Callable, List
+
+from utils import Experience
+
+
+class PlainExperience:
+    # Previous representation: a dict-backed object keeping the parsed JSON as it is
+    def __init__(self, exp_id: str, title: str, substances_details: list, story: List[str],
+                 substances_simple: List[dict], metadata: dict, tags: List[dict]):
+        self.exp_id = exp_id
+        self.title = title
+        self.substances_details = substances_details
+        self.story = story
+        self.substances_simple = substances_simple
+        self.metadata = metadata
+        self.tags = tags
+
+
+def load(json_folder: str, experience_class: Callable) -> list:
+    experiences = []
+    for file in sorted(os.listdir(json_folder)):
+        if not file.endswith('.json') or file.find('(1)') != -1:
+            continue
+        with open(os.path.join(json_folder, file), encoding='utf-8') as open_json:
+            exp_dict = json.load(open_json)
+        experiences.append(experience_class(exp_id=file[:-len('.json')],
+                                            title=exp_dict['title'],
+                                            substances_details=exp_dict['substances_details'],
+                                            story=exp_dict['story_paragraphs'],
+                                            substances_simple=exp_dict['substances_main'],
+                                            metadata=exp_dict['metadata'],
+                                            tags=exp_dict['tags']))
+    return experiences
+
+
+def measure(json_folder: str, experience_class: Callable) -> (int, int):
+    """
+    :return: number of experiences loaded, and bytes still allocated once they are all loaded
+    """
+    gc.collect()
+    tracemalloc.start()
+    experiences = load(json_folder, experience_class)
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(experiences), allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('json_folder', nargs='?', default='data/experiences_db')
+    args = parser.parse_args()
+
+    # The compact representation goes first, so that the shared vocabularies it fills are counted
+    results = {}
+    for name, experience_class in (('compact', Experience), ('plain', PlainExperience)):
+        total, allocated = measure(args.json_folder, experience_class)
+        results[name] = allocated
+        print(f"{name:>8}: {allocated / 2 ** 20:8.1f} MiB for {total} experiences, "
+              f"{allocated / max(total, 1) / 2 ** 10:6.2f} KiB each")
+    print(f"reduction: {1 - results['compact'] / results['plain']:.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Throughput, latency and memory of each stage of the scraping pipeline, against the local stand-in of
+`benchmarks/standin.py` instead of the live site:
+
+- fetch: http call of an experience page through the SOCKS5 stand-in, without cache
+- parse: parse tree of the page
+- extract: extraction of the experience from the parse tree
+- save: JSON file of the experience
+- download: the whole pipeline, with `ErowidScraper.download` and a fresh cache and state
+- process: tag and substance stats, loading of the data points and search index of the experiences saved
+
+For every stage, the result has the pages per second, the p50 and p99 latency of a single operation, and the peak
+memory allocated by a single operation (measured by tracemalloc in a second, untimed, run). Results are written as
+JSON, with the commit they were measured on, to compare them across commits:
+
+    env PYTHONPATH=src python benchmarks/scraping.py --pages 500 --latency 0.02 --output results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from processor import ErowidJSONProcessor
+from scraper.connection import ProxyServer
+from scraper.experiences_scraper import ErowidScraper, ExperienceScraper
+from scraper.scrapers import ElementScraper
+from scraper.sessions import SessionManager
+from scraper.state import DownloadState
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standin.py')
+
+
+def start_standin(port: int, socks_ports: int, args: argparse.Namespace) -> subprocess.Popen:
+    """
+    Start the stand-in in its own process, so that it does not compete for the GIL with the code measured
+    :return: process of the stand-in, listening once returned
+    """
+    command = [sys.executable, STANDIN, '--port', str(port), '--socks-ports', str(socks_ports),
+               '--socks-latency', str(args.socks_latency), '--latency', str(args.latency),
+               '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+               '--block-rate', str(args.block_rate), '--missing-rate', str(args.missing_rate),
+               '--total', str(args.pages), '--seed', str(args.seed)]
+    standin = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    standin.stdout.readline()
+    return standin
+
+
+def free_port(ports: int) -> int:
+    """
+    :param ports: number of consecutive free ports needed
+    :return: first of the ports, picked at random
+    """
+    while True:
+        first = random.randint(20000, 60000)
+        try:
+            for port in range(first, first + ports):
+                with socket.socket() as sock:
+                    sock.bind(('127.0.0.1', port))
+            return first
+        except OSError:
+            continue
+
+
+def measure(items: list, operation: Callable, pages: Optional[int] = None,
+            prepare: Optional[Callable] = None) -> Dict[str, float]:
+    """
+    Time `operation` on each item, then run it again under tracemalloc for its peak memory
+
+    :param items: inputs of the operations
+    :param operation: operation measured, called with each item (prepared)
+    :param pages: number of pages processed by all the operations, one per item by default
+    :param prepare: untimed preparation of each item, run before each operation
+    :return: pages per second, p50 and p99 latency in milliseconds, and peak memory in MiB of a single operation
+    """
+    latencies = []
+    for item in items:
+        prepared = prepare(item) if prepare else item
+        start = time.perf_counter()
+        operation(prepared)
+        latencies.append(time.perf_counter() - start)
+    peak = 0
+    for item in items:
+        prepared = prepare(item) if prepare else item
+        tracemalloc.start()
+        operation(prepared)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    latencies = np.array(latencies)
+    return {'operations': len(items),
+            'pages_per_sec': (pages if pages is not None else len(items)) / latencies.sum() if len(items) else 0,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000) if len(items) else 0,
+            'p99_ms': float(np.percentile(latencies, 99) * 1000) if len(items) else 0,
+            'peak_memory_mb': peak / 2 ** 20}
+
+
+def pipeline_stages(urls: List[str], proxy_server: ProxyServer, work_folder: str) -> Dict[str, Dict[str, float]]:
+    """
+    Measure the stages of the download of a page one at a time, each on the output of the previous one
+    """
+    session_manager = SessionManager(os.path.join(work_folder, 'fetch_cache'))
+    session = session_manager.get_session(proxy_server)
+    responses = []
+
+    def fetch(url: str):
+        with session.cache_disabled():
+            responses.append(session.get(url, headers=ElementScraper.headers, allow_redirects=False))
+
+    results = {'fetch': measure(urls, fetch)}
+    pages = [(res.url, res.content) for res in responses[:len(urls)]
+             if res.status_code == 200 and b'has been blocked' not in res.content]
+    results['fetch']['errors'] = len(urls) - len(pages)
+
+    def new_scraper(page) -> ExperienceScraper:
+        scraper = ExperienceScraper(page[0], session_manager=session_manager)
+        scraper.save_path = os.path.join(work_folder, 'experiences', f"{scraper.exp_id}.json")
+        return scraper
+
+    def parsed_scraper(page) -> ExperienceScraper:
+        scraper = new_scraper(page)
+        scraper.parse(page[1])
+        return scraper
+
+    def extracted_scraper(page) -> Optional[ExperienceScraper]:
+        scraper = parsed_scraper(page)
+        try:
+            scraper.extract_data()
+        except Exception:
+            return None
+        return scraper
+
+    def extract(scraper: ExperienceScraper):
+        try:
+            scraper.extract_data()
+        except Exception:
+            pass
+
+    os.makedirs(os.path.join(work_folder, 'experiences'))
+    results['parse'] = measure(pages, lambda page: new_scraper(page).parse(page[1]))
+    results['extract'] = measure(pages, extract, prepare=parsed_scraper)
+    results['save'] = measure(pages, lambda scraper: scraper and scraper.save(), prepare=extracted_scraper)
+    session_manager.close()
+    return results
+
+
+class TimedErowidScraper(ErowidScraper):
+    # Uses its own cache, and keeps the duration of the download of every element, from the call to its save
+
+    def __init__(self, session_manager: SessionManager, **kwargs):
+        super().__init__(**kwargs)
+        self.session_manager = session_manager
+        self.durations: List[float] = []
+
+    def create_scraper(self, element_id: str, url: str) -> ExperienceScraper:
+        scraper = ExperienceScraper(url, session_manager=self.session_manager)
+        scraper.save_path = os.path.join(self.save_folder, f"{element_id}.json")
+        return scraper
+
+    def download_element(self, scraper: ElementScraper) -> bool:
+        start = time.perf_counter()
+        downloaded = super().download_element(scraper)
+        self.durations.append(time.perf_counter() - start)
+        return downloaded
+
+
+def download_stage(base_url: str, ids: List[int], proxy_server: ProxyServer, work_folder: str,
+                   workers_per_server: int) -> Dict[str, float]:
+    """
+    Measure the whole download, with fresh cache, state and output folder for each run
+    """
+    def run(traced: bool) -> Tuple[TimedErowidScraper, float, int]:
+        folder = tempfile.mkdtemp(dir=work_folder)
+        state = DownloadState(os.path.join(folder, 'state.sqlite'))
+        state.add_pending((str(exp_id), f"{base_url}{exp_id}") for exp_id in ids)
+        session_manager = SessionManager(os.path.join(folder, 'cache'))
+        scraper = TimedErowidScraper(session_manager, proxy_server=proxy_server, state=state)
+        scraper.save_folder = folder
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        scraper.download(workers_per_server=workers_per_server)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if traced else 0
+        tracemalloc.stop()
+        session_manager.close()
+        state.close()
+        return scraper, elapsed, peak
+
+    (timed, elapsed, _), (_, _, peak) = run(False), run(True)
+    durations = np.array(timed.durations)
+    return {'operations': len(ids),
+            'pages_per_sec': timed.urls_downloaded / elapsed,
+            'p50_ms': float(np.percentile(durations, 50) * 1000),
+            'p99_ms': float(np.percentile(durations, 99) * 1000),
+            'peak_memory_mb': peak / 2 ** 20,
+            'errors': timed.urls_failed}
+
+
+def process_stage(json_folder: str, processes: Optional[int]) -> Dict[str, float]:
+    """
+    Measure the processing of the experiences saved, each operation on all of them
+    """
+    experiences = len([file for file in os.listdir(json_folder) if file.endswith('.json')])
+    operations = {
+        'tags': lambda processor: processor.update_stats('tags', processes, rebuild=True),
+        'substances': lambda processor: processor.update_stats('substances_main', processes, rebuild=True),
+        'data_points': lambda processor: processor.load_data_points(),
+        'search_index': lambda processor: processor.get_search_index(),
+    }
+    results = measure(list(operations.values()), lambda operation: operation(ErowidJSONProcessor(json_folder)),
+                      pages=experiences * len(operations))
+    results['operations'] = list(operations)
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(STANDIN)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=300, help="number of experience pages")
+    parser.add_argument('--proxies', type=int, default=2, help="number of SOCKS5 stand-ins, one per proxy server")
+    parser.add_argument('--workers-per-server', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--socks-latency', type=float, default=0, help="seconds added to every proxied connection")
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--block-rate', type=float, default=0)
+    parser.add_argument('--missing-rate', type=float, default=0)
+    parser.add_argument('--processes', type=int, default=1, help="worker processes of the processing stage")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file where to write the results, printed if not set")
+    args = parser.parse_args()
+
+    # Logging every page and failure would dominate the timings of the fast stages
+    logging.disable(logging.CRITICAL)
+    random.seed(args.seed)
+    port = free_port(args.proxies + 1)
+    standin = start_standin(port, args.proxies, args)
+    try:
+        with tempfile.TemporaryDirectory() as work_folder:
+            credentials = os.path.join(work_folder, 'credentials.json')
+            with open(credentials, 'w') as open_json:
+                json.dump({'username': 'user', 'password': 'password',
+                           'servers': [f'127.0.0.1:{port + 1 + i}' for i in range(args.proxies)]}, open_json)
+            proxy_server = ProxyServer(credentials)
+            base_url = f"http://127.0.0.1:{port}/experiences/exp.php?ID="
+            ids = list(range(1, args.pages + 1))
+
+            stages = pipeline_stages([f"{base_url}{exp_id}" for exp_id in ids],
+                                     proxy_server.pin(proxy_server.servers[0]), work_folder)
+            stages['download'] = download_stage(base_url, ids, proxy_server, work_folder, args.workers_per_server)
+            stages['process'] = process_stage(os.path.join(work_folder, 'experiences'), args.processes)
+    finally:
+        standin.terminate()
+        standin.wait()
+
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'time': time.time(),
+              'config': vars(args), 'stages': stages}
+    for stage, results in stages.items():
+        print(f"{stage:>9}: {results['pages_per_sec']:9.1f} pages/s, p50 {results['p50_ms']:8.2f} ms, "
+              f"p99 {results['p99_ms']:8.2f} ms, peak {results['peak_memory_mb']:7.2f} MiB", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as open_json:
+            json.dump(report, open_json, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
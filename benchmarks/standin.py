@@ -0,0 +1,227 @@
+"""
+Local stand-in for Erowid, to benchmark the scraper without touching the live site: an HTTP server answering
+experience pages and search result pages with the fixtures of `benchmarks/fixtures`, and a SOCKS5 proxy in front of
+it, used as the proxy servers of the credentials file. Latency, server errors and block pages are configurable.
+
+    python benchmarks/standin.py --latency 0.05 --error-rate 0.01 --block-rate 0.01
+"""
+import argparse
+import os
+import random
+import re
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixtures(folder: str = FIXTURES_FOLDER) -> Dict[str, bytes]:
+    """
+    :param folder: folder of the fixture pages
+    :return: content of each fixture, by file name without extension
+    """
+    fixtures = {}
+    for file in sorted(os.listdir(folder)):
+        if file.endswith('.html'):
+            with open(os.path.join(folder, file), 'rb') as open_html:
+                fixtures[file[:-len('.html')]] = open_html.read()
+    return fixtures
+
+
+def list_page(ids: List[int], total: int) -> bytes:
+    """
+    :param ids: ids of the experiences listed in the page
+    :param total: total number of results of the search
+    :return: page of search results
+    """
+    rows = ''.join(f'<tr class="exp-list-row"><td class="exp-title"><a href="exp.php?ID={exp_id}">Report {exp_id}</a>'
+                   f'</td><td class="exp-pubdate">Jan 1, 2001</td></tr>\n' for exp_id in ids)
+    return (f'<html><head><title>Erowid Experience Vaults: Search</title></head><body>\n'
+            f'<center>{total:,} Total Experiences</center>\n'
+            f'<table class="exp-list-table">\n{rows}</table>\n</body></html>\n').encode()
+
+
+class StandInConfig:
+    # Seconds added to every response, plus a random jitter up to `jitter`
+    latency: float = 0
+    jitter: float = 0
+    # Share of the calls answered with a 500 error, and with the block page
+    error_rate: float = 0
+    block_rate: float = 0
+    # Share of the experience pages answered with the page of a missing experience
+    missing_rate: float = 0
+    # Total number of experiences listed by the search, with ids from `total` down to 1
+    total: int = 1000
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+class ErowidHandler(BaseHTTPRequestHandler):
+    server: 'StandInServer'
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, do not wait for the ack of the first write
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        config = self.server.config
+        delay = config.latency + random.uniform(0, config.jitter)
+        if delay:
+            time.sleep(delay)
+        roll = random.random()
+        if roll < config.error_rate:
+            self.respond(500, b'<html><body>Internal Server Error</body></html>')
+        elif roll < config.error_rate + config.block_rate:
+            self.respond(403, self.server.fixtures['blocked'])
+        else:
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path.endswith('exp.cgi'):
+                start, size = int(params.get('Start', ['0'])[0]), int(params.get('Max', ['100'])[0])
+                ids = list(range(config.total - start, max(config.total - start - size, 0), -1))
+                self.respond(200, list_page(ids, config.total))
+            elif url.path.endswith('exp.php'):
+                exp_id = int(params.get('ID', ['1'])[0])
+                self.respond(200, self.server.experience_page(exp_id))
+            else:
+                self.respond(404, b'<html><body>Not Found</body></html>')
+
+    def respond(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: StandInConfig, fixtures: Optional[Dict[str, bytes]] = None):
+        super().__init__(address, ErowidHandler)
+        self.config = config
+        self.fixtures = fixtures or load_fixtures()
+        self.experiences = [content for name, content in self.fixtures.items() if name.startswith('experience')]
+
+    def experience_page(self, exp_id: int) -> bytes:
+        """
+        :param exp_id: id of the experience
+        :return: one of the experience fixtures, always the same for the same id, with the id replaced
+        """
+        if random.random() < self.config.missing_rate:
+            return self.fixtures['missing']
+        page = self.experiences[exp_id % len(self.experiences)]
+        return re.sub(rb'ExpID: \d+', b'ExpID: %d' % exp_id, page)
+
+
+class Socks5Handler(socketserver.BaseRequestHandler):
+    # Minimal SOCKS5 proxy (CONNECT only, with or without username/password), relaying the bytes both ways
+    server: 'Socks5Server'
+
+    def recv_exactly(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Client closed the connection")
+            data += chunk
+        return data
+
+    def handle(self):
+        client = self.request
+        _, methods_count = self.recv_exactly(2)
+        methods = self.recv_exactly(methods_count)
+        if 2 in methods:
+            client.sendall(b'\x05\x02')
+            _, username_length = self.recv_exactly(2)
+            self.recv_exactly(username_length)
+            password_length, = self.recv_exactly(1)
+            self.recv_exactly(password_length)
+            client.sendall(b'\x01\x00')
+        else:
+            client.sendall(b'\x05\x00')
+        _, command, _, address_type = self.recv_exactly(4)
+        if address_type == 1:
+            host = socket.inet_ntoa(self.recv_exactly(4))
+        elif address_type == 3:
+            host = self.recv_exactly(self.recv_exactly(1)[0]).decode()
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, self.recv_exactly(16))
+        port, = struct.unpack('>H', self.recv_exactly(2))
+        if command != 1:
+            client.sendall(b'\x05\x07\x00\x01' + b'\x00' * 6)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            upstream = socket.create_connection((host, port), timeout=30)
+        except OSError:
+            client.sendall(b'\x05\x05\x00\x01' + b'\x00' * 6)
+            return
+        client.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+        for sock in (client, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with upstream:
+            sockets = [client, upstream]
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 60)
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is client else client).sendall(data)
+
+
+class Socks5Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency: float = 0):
+        """
+        :param latency: seconds added to the setup of every connection, as the round trip to a remote proxy
+        """
+        super().__init__(address, Socks5Handler)
+        self.latency = latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--socks-ports', type=int, default=1, help="number of SOCKS5 proxies, on the next ports")
+    parser.add_argument('--socks-latency', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--block-rate', type=float, default=0)
+    parser.add_argument('--missing-rate', type=float, default=0)
+    parser.add_argument('--total', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    config = StandInConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                           block_rate=args.block_rate, missing_rate=args.missing_rate, total=args.total)
+    http_server = StandInServer(('127.0.0.1', args.port), config)
+    for i in range(args.socks_ports):
+        socks_server = Socks5Server(('127.0.0.1', args.port + 1 + i), args.socks_latency)
+        threading.Thread(target=socks_server.serve_forever, daemon=True).start()
+    # Printed once listening, for the benchmark waiting for it
+    print(f"listening on {args.port}", flush=True)
+    http_server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+"""
+Single command line entry point of the project:
+
+- discover: find the experiences published on Erowid from the pages of search results
+- scrape: download the experiences, discovering the new ones at the same time, or leasing batches of ids from a
+  queue shared with other hosts
+- leases: progress of the batches of a shared queue
+- re-extract: extract the experiences again from the cached pages, after changing the extraction code
+- clean-cache: invalidate, compact or report on the cached pages
+- process: update the tag and substance stats of the experiences
+- migrate-corpus: move the JSON files of the experiences to the consolidated corpus
+- normalize-doses: normalise the dose charts of the experiences downloaded before doses were normalised
+- index-stories: add the experiences downloaded so far to the full text index of the stories
+- search-stories: search the stories, filtered by substance, tag and metadata
+- train: train the model predicting the OUTCOME tags of an experience
+- predict: predict the OUTCOME tags of a setup
+
+Each subcommand only imports the modules it needs, so that short ones start quickly, and nothing is configured when
+modules are imported: the data folder, the cache and the logging are set here, from the options.
+
+    env PYTHONPATH=src python src/cli.py --data-folder data scrape --workers-per-server 2
+    env PYTHONPATH=src python src/cli.py clean-cache --failed IndexError --report
+    env PYTHONPATH=src python src/cli.py scrape --coordinator /shared/leases.sqlite --corpus /shared/corpus
+    env PYTHONPATH=src python src/cli.py search-stories '"bad trip" NOT hospital' --substance Cannabis
+    env PYTHONPATH=src python src/cli.py predict --substances Cannabis Alcohol --routes smoked oral
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import List, Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def configure_logging(level: str):
+    """
+    Log to stderr, at `level` and above, for all the modules
+    :param level: name of the level, e.g. INFO
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, "%Y-%m-%d %H:%M:%S"))
+    logging.basicConfig(level=level, handlers=[handler])
+
+
+def data_path(args: argparse.Namespace, name: str) -> str:
+    """
+    :param name: name of a file or folder of the data folder
+    :return: its path
+    """
+    return os.path.join(args.data_folder, name)
+
+
+def configure_cache(args: argparse.Namespace):
+    """
+    Make all the scrapers use the cache of the options, instead of the one of the current directory
+    :return: shared SessionManager
+    """
+    from scraper.sessions import configure_session_manager
+
+    return configure_session_manager(args.cache or data_path(args, 'erowid_cache'))
+
+
+def open_corpus(args: argparse.Namespace):
+    """
+    :return: CorpusStore of the data folder, None if the experiences are only stored as JSON files
+    """
+    corpus_folder = data_path(args, 'corpus')
+    if not os.path.isdir(corpus_folder):
+        return None
+    from scraper.corpus import CorpusStore
+
+    return CorpusStore(corpus_folder)
+
+
+def open_proxy(args: argparse.Namespace):
+    """
+    :return: ProxyPool of the servers in the credentials file, None to make the calls directly if there is none
+    """
+    if not os.path.isfile(args.credentials):
+        logging.getLogger(__name__).warning(f"{args.credentials} not found, calls are made without proxy")
+        return None
+    from scraper.connection import ProxyPool
+
+    return ProxyPool(args.credentials)
+
+
+def create_scrapers(args: argparse.Namespace):
+    """
+    :return: scraper of the experiences, with its download state, and scraper of the pages of search results
+    """
+    from scraper.experiences_scraper import ErowidScraper, open_state
+    from scraper.urls_scraper import ErowidUrlsScraper
+
+    configure_cache(args)
+    proxy = open_proxy(args)
+    save_folder = data_path(args, 'experiences_db')
+    links_folder = data_path(args, 'exp_links')
+    state = open_state(data_path(args, 'download_state.sqlite'), save_folder, links_folder)
+    erowid_scraper = ErowidScraper(proxy_server=proxy, state=state)
+    erowid_scraper.save_folder = save_folder
+    urls_scraper = ErowidUrlsScraper(proxy_server=proxy, on_urls=erowid_scraper.add_urls)
+    urls_scraper.save_folder = links_folder
+    for folder in (save_folder, links_folder):
+        os.makedirs(folder, exist_ok=True)
+    return erowid_scraper, urls_scraper
+
+
+def discover(args: argparse.Namespace):
+    erowid_scraper, urls_scraper = create_scrapers(args)
+    known = len(erowid_scraper.state)
+    urls_scraper.discover(args.workers_per_server, wait=True, incremental=not args.full)
+    print(f"{len(erowid_scraper.state) - known} new experiences, {erowid_scraper.state.count_remaining()} to download")
+
+
+def scrape(args: argparse.Namespace):
+    from scraper.experiences_scraper import discover_and_download
+    from scraper.metrics import ScrapeMetrics
+    from scraper.story_index import StoryIndex
+    from scraper.writer import ExperienceWriter
+
+    erowid_scraper, urls_scraper = create_scrapers(args)
+    erowid_scraper.story_index = StoryIndex(data_path(args, 'story_index.sqlite'))
+    if args.corpus:
+        from scraper.corpus import CorpusStore
+
+        erowid_scraper.corpus = CorpusStore(args.corpus)
+    if args.writer_queue:
+        erowid_scraper.writer = ExperienceWriter(corpus=erowid_scraper.corpus, story_index=erowid_scraper.story_index,
+                                                 max_queue=args.writer_queue, fsync=not args.no_fsync)
+    erowid_scraper.metrics = ScrapeMetrics(args.metrics or data_path(args, 'scrape_metrics.prom'),
+                                           profile_rate=args.profile_rate,
+                                           profile_folder=data_path(args, 'profiles'))
+    if args.coordinator:
+        from scraper.coordinator import LeaseQueue
+
+        lease_queue = LeaseQueue(args.coordinator, lease_seconds=args.lease_seconds)
+        lease_queue.create(batch_size=args.batch_size)
+        batches = erowid_scraper.download_leased(lease_queue, wait=True, workers_per_server=args.workers_per_server)
+        print(f"{batches} batches downloaded by {lease_queue.worker}, queue: {lease_queue.counts()}")
+        lease_queue.close()
+        return
+    erowid_scraper.update_from_folder(urls_scraper.save_folder)
+    if args.no_discovery:
+        erowid_scraper.download(wait=True, workers_per_server=args.workers_per_server)
+    else:
+        discover_and_download(erowid_scraper, urls_scraper, incremental=not args.full_discovery,
+                              workers_per_server=args.workers_per_server)
+
+
+def leases(args: argparse.Namespace):
+    from scraper.coordinator import LeaseQueue
+
+    lease_queue = LeaseQueue(args.coordinator)
+    print(f"Batches: {lease_queue.counts()}")
+    for worker, stats in sorted(lease_queue.workers().items()):
+        print(f"  {worker:<40}{stats['batches']:>6} batches{stats['downloaded']:>8} downloaded"
+              f"{stats['failed']:>8} failed")
+    lease_queue.close()
+
+
+def reextract(args: argparse.Namespace):
+    from scraper.experiences_scraper import ErowidScraper, open_state
+
+    save_folder = data_path(args, 'experiences_db')
+    os.makedirs(save_folder, exist_ok=True)
+    erowid_scraper = ErowidScraper(state=open_state(data_path(args, 'download_state.sqlite'), save_folder,
+                                                    data_path(args, 'exp_links')))
+    erowid_scraper.cache_name = args.cache or data_path(args, 'erowid_cache')
+    erowid_scraper.save_folder = save_folder
+    failures = erowid_scraper.reextract(args.ids or None, args.processes)
+    print(f"{erowid_scraper.urls_downloaded} experiences extracted again, failures: {failures}")
+
+
+def clean_cache(args: argparse.Namespace):
+    from scraper.cache_operations import CacheCleaner, print_size_report
+    from scraper.cache_policy import CACHE_TTLS
+
+    session_manager = configure_cache(args)
+    cache = session_manager.cache
+    if args.apply_ttls:
+        cache.apply_ttls(CACHE_TTLS)
+    cleaner = CacheCleaner(session_manager)
+    if args.failed is not None:
+        from scraper.state import DownloadState
+
+        state = DownloadState(data_path(args, 'download_state.sqlite'))
+        for error_type in args.failed or [None]:
+            cleaner.add_failures_to_clean(state, error_type)
+        state.close()
+    if args.failed_txt:
+        from scraper.scrapers import from_txt_to_list
+
+        links_folder = data_path(args, 'exp_links')
+        for file in os.listdir(links_folder):
+            if file.startswith('failed_urls_') and file.endswith('.txt'):
+                cleaner.add_urls_to_clean(from_txt_to_list(os.path.join(links_folder, file)))
+    for pattern in args.pattern:
+        cleaner.add_pattern_to_clean(pattern)
+    deleted = cleaner.clean_cache_from_urls()
+    if deleted:
+        print(f"{deleted} pages invalidated")
+    if args.compact:
+        size = os.path.getsize(cache.db_path)
+        cache.compact()
+        print(f"Cache compacted from {size / 2 ** 20:.1f} MB to {os.path.getsize(cache.db_path) / 2 ** 20:.1f} MB")
+    if args.report is not None:
+        print_size_report(cache.size_report(args.report))
+
+
+def process(args: argparse.Namespace):
+    from processor import ErowidJSONProcessor
+    from search import ExperienceIndex
+
+    processor = ErowidJSONProcessor(data_path(args, 'experiences_db'), corpus=open_corpus(args))
+    for key in ('tags', 'substances_main'):
+        stats = processor.update_stats(key, args.processes, rebuild=args.rebuild)
+        print(f"{key}: {len(stats.names)} in {stats.experiences} experiences")
+        for item_id, appearances in stats.appearances.most_common(args.top):
+            print(f"  {stats.names.get(item_id, item_id):<40}{appearances:>8}")
+    if args.search_index:
+        index = processor.get_search_index(args.search_index, rebuild=args.rebuild)
+        print(f"Search index of {len(index.exp_ids)} experiences in {ExperienceIndex.file_path(args.search_index)}")
+
+
+def migrate_corpus(args: argparse.Namespace):
+    from scraper.corpus import CorpusStore
+
+    corpus = CorpusStore(data_path(args, 'corpus'))
+    corpus.import_folder(data_path(args, 'experiences_db'))
+    corpus.compact()
+    print(f"{len(corpus.exp_ids())} experiences in {corpus.folder}")
+
+
+def normalize_doses(args: argparse.Namespace):
+    from scraper.doses import normalize_corpus, normalize_folder
+
+    corpus = open_corpus(args)
+    if corpus is not None:
+        print(f"{normalize_corpus(corpus)} experiences normalised in {corpus.folder}")
+        corpus.compact()
+    json_folder = data_path(args, 'experiences_db')
+    if os.path.isdir(json_folder):
+        print(f"{normalize_folder(json_folder)} experiences normalised in {json_folder}")
+
+
+def index_stories(args: argparse.Namespace):
+    from scraper.story_index import StoryIndex
+
+    story_index = StoryIndex(data_path(args, 'story_index.sqlite'))
+    corpus = open_corpus(args)
+    if corpus is not None:
+        story_index.import_corpus(corpus)
+    json_folder = data_path(args, 'experiences_db')
+    if os.path.isdir(json_folder):
+        story_index.import_folder(json_folder)
+    print(f"{len(story_index)} experiences indexed")
+    story_index.close()
+
+
+def search_stories(args: argparse.Namespace):
+    from scraper.story_index import StoryIndex
+
+    story_index = StoryIndex(data_path(args, 'story_index.sqlite'))
+    metadata = dict(item.split('=', 1) for item in args.metadata)
+    print(f"{story_index.count(args.query, args.substance, args.tag, metadata)} experiences")
+    for exp_id, title, snippet in story_index.search(args.query, args.substance, args.tag, metadata, args.limit):
+        print(f"{exp_id:>8}  {title}\n          {snippet}")
+    story_index.close()
+
+
+def train(args: argparse.Namespace):
+    from prediction import TagPredictor, build_features
+    from processor import ErowidJSONProcessor, ExperiencesTagCategory
+
+    processor = ErowidJSONProcessor(data_path(args, 'experiences_db'), corpus=open_corpus(args))
+    tag_categories = ExperiencesTagCategory(args.tags_categories or data_path(args, 'tags_categories.csv'))
+    feature_matrix = build_features(processor, tag_categories, args.rebuild)
+    TagPredictor.fit(feature_matrix).save(args.model or data_path(args, 'tag_predictor.pickle'))
+
+
+def predict(args: argparse.Namespace):
+    from prediction import TagPredictor
+    from processor import ErowidJSONProcessor
+
+    predictor = TagPredictor.load(args.model or data_path(args, 'tag_predictor.pickle'))
+    processor = ErowidJSONProcessor(data_path(args, 'experiences_db'), corpus=open_corpus(args))
+    # Only the names are needed, the persisted stats are not updated
+    substance_names = processor.load_stats('substances_main').names
+    ids_by_name = {name.lower(): substance_id for substance_id, name in substance_names.items()}
+    substances = [ids_by_name.get(substance.lower(), substance) for substance in args.substances]
+    predictions = predictor.predict(substances=substances, routes=args.routes, setting_tags=args.setting_tags)
+    for tag_id, probability in sorted(predictions.items(), key=lambda item: -item[1]):
+        print(f"{tag_id}\t{probability:.3f}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-folder', default='data', help="folder of the cache, the state and the experiences")
+    parser.add_argument('--cache', help="path of the sqlite cache, without extension, erowid_cache in the data folder "
+                                        "by default")
+    parser.add_argument('--credentials', default='credentials.json', help="proxy servers, no proxy if not found")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    discover_parser = subparsers.add_parser('discover', help="find the experiences to download")
+    discover_parser.set_defaults(run=discover)
+    discover_parser.add_argument('--workers-per-server', type=int, default=1)
+    discover_parser.add_argument('--full', action='store_true',
+                                 help="download all the pages of results, not only the ones of new experiences")
+
+    scrape_parser = subparsers.add_parser('scrape', help="download the experiences, discovering the new ones")
+    scrape_parser.set_defaults(run=scrape)
+    scrape_parser.add_argument('--workers-per-server', type=int, default=1)
+    scrape_parser.add_argument('--no-discovery', action='store_true', help="only download the experiences known")
+    scrape_parser.add_argument('--full-discovery', action='store_true',
+                               help="download all the pages of results, not only the ones of new experiences")
+    scrape_parser.add_argument('--metrics', help="file where to write the metrics, .prom for the Prometheus format, "
+                                                 "scrape_metrics.prom in the data folder by default")
+    scrape_parser.add_argument('--profile-rate', type=float, default=0.001,
+                               help="share of the experiences downloaded under cProfile")
+    scrape_parser.add_argument('--writer-queue', type=int, default=256,
+                               help="experiences waiting to be written in the background at most, 0 to write them "
+                                    "from the download workers")
+    scrape_parser.add_argument('--no-fsync', action='store_true',
+                               help="do not wait for the experiences to be on disk before marking them done")
+    scrape_parser.add_argument('--corpus', help="corpus folder where to save the experiences, instead of one JSON file "
+                                                "each, e.g. shared by the hosts of a coordinated scrape")
+    scrape_parser.add_argument('--coordinator', metavar='QUEUE',
+                               help="sqlite file shared with the other hosts, download the batches of ids leased from "
+                                    "it instead of the experiences discovered")
+    scrape_parser.add_argument('--batch-size', type=int, default=500,
+                               help="ids per batch, when the coordinator queue is created")
+    scrape_parser.add_argument('--lease-seconds', type=float, default=600,
+                               help="seconds after which the batch of a worker that stopped renewing it is leased "
+                                    "again")
+
+    leases_parser = subparsers.add_parser('leases', help="progress of the batches of a coordinated scrape")
+    leases_parser.set_defaults(run=leases)
+    leases_parser.add_argument('coordinator', metavar='QUEUE', help="sqlite file of the queue")
+
+    reextract_parser = subparsers.add_parser('re-extract', help="extract the experiences again from the cache")
+    reextract_parser.set_defaults(run=reextract)
+    reextract_parser.add_argument('--ids', nargs='*',
+                                  help="ids of the experiences, all the ones downloaded or failed by default")
+    reextract_parser.add_argument('--processes', type=int, help="one per core by default")
+
+    cache_parser = subparsers.add_parser('clean-cache', help="invalidate, compact or report on the cached pages")
+    cache_parser.set_defaults(run=clean_cache)
+    cache_parser.add_argument('--failed', nargs='*', metavar='ERROR_TYPE',
+                              help="pages whose download failed with these exceptions, all the failures if none "
+                                   "is given")
+    cache_parser.add_argument('--pattern', action='append', default=[],
+                              help="url glob pattern, e.g. 'www.erowid.org/experiences/exp.cgi*'")
+    cache_parser.add_argument('--failed-txt', action='store_true',
+                              help="pages listed in the failed_urls_<Exception>.txt files of exp_links in the data "
+                                   "folder")
+    cache_parser.add_argument('--apply-ttls', action='store_true',
+                              help="set the expiration of the pages cached without one, and index the cache")
+    cache_parser.add_argument('--compact', action='store_true',
+                              help="compress the cache with a dictionary trained on its pages, and give back free "
+                                   "space")
+    cache_parser.add_argument('--report', nargs='*', metavar='PATTERN',
+                              help="print the size of the cache by url pattern, the patterns of CACHE_TTLS if none "
+                                   "is given")
+
+    process_parser = subparsers.add_parser('process', help="update the tag and substance stats")
+    process_parser.set_defaults(run=process)
+    process_parser.add_argument('--processes', type=int, help="one per core by default")
+    process_parser.add_argument('--rebuild', action='store_true', help="count all the experiences again")
+    process_parser.add_argument('--top', type=int, default=10, help="number of most common items printed")
+    process_parser.add_argument('--search-index', help="file of the index of substance combinations, built again if "
+                                                       "experiences were added since it was saved")
+
+    migrate_parser = subparsers.add_parser('migrate-corpus', help="move the JSON files of the experiences to the "
+                                                                  "corpus, and compact it")
+    migrate_parser.set_defaults(run=migrate_corpus)
+
+    doses_parser = subparsers.add_parser('normalize-doses', help="normalise the dose charts of the experiences "
+                                                                 "downloaded before")
+    doses_parser.set_defaults(run=normalize_doses)
+
+    index_parser = subparsers.add_parser('index-stories', help="index the stories of the experiences not indexed yet")
+    index_parser.set_defaults(run=index_stories)
+
+    search_parser = subparsers.add_parser('search-stories', help="search the titles and stories of the experiences")
+    search_parser.set_defaults(run=search_stories)
+    search_parser.add_argument('query', help="FTS5 query, with \"phrases\", AND, OR, NOT and prefix*")
+    search_parser.add_argument('--substance', nargs='*', default=[], help="ids or names of substances they contain")
+    search_parser.add_argument('--tag', nargs='*', default=[], help="ids of tags they have")
+    search_parser.add_argument('--metadata', nargs='*', default=[], metavar='KEY=VALUE',
+                               help="metadata they have, e.g. Gender=Female")
+    search_parser.add_argument('--limit', type=int, default=20)
+
+    train_parser = subparsers.add_parser('train', help="train the model predicting the OUTCOME tags")
+    train_parser.set_defaults(run=train)
+    train_parser.add_argument('--tags-categories', help="csv of the categories of the tags, tags_categories.csv in the "
+                                                        "data folder by default")
+    train_parser.add_argument('--model', help="file where to save the model, tag_predictor.pickle in the data folder "
+                                              "by default")
+    train_parser.add_argument('--rebuild', action='store_true', help="ignore the cached features")
+
+    predict_parser = subparsers.add_parser('predict', help="predict the OUTCOME tags of a setup")
+    predict_parser.set_defaults(run=predict)
+    predict_parser.add_argument('--model', help="file of the model, tag_predictor.pickle in the data folder by "
+                                                "default")
+    predict_parser.add_argument('--substances', nargs='*', default=[], help="ids or names of the substances")
+    predict_parser.add_argument('--routes', nargs='*', default=[])
+    predict_parser.add_argument('--setting-tags', nargs='*', default=[], help="ids of the SETTING tags")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_level)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Sparse incidence matrices (experiences x tags, experiences x substances) and the co-occurrence
+measures that can be computed from them with a single sparse matrix product.
+
+Given two incidence matrices A and B over the same N experiences, C = A.T @ B counts, for each pair
+of columns (i, j), the experiences in which both appear. From C and the column totals:
+- lift: C_ij * N / (n_i * m_j), how much more often the pair appears than if independent
+- pmi: log(lift)
+- jaccard: C_ij / (n_i + m_j - C_ij)
+Pairs that never appear together are left out of the sparse results (their count is 0, and so are
+lift and jaccard, while pmi would be -inf).
+"""
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+from scipy import sparse
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+MEASURES = ('count', 'lift', 'pmi', 'jaccard')
+
+
+def co_occurrence_measure(counts: sparse.coo_matrix, totals: np.ndarray, other_totals: np.ndarray,
+                          total_rows: int, measure: str = 'count') -> sparse.csr_matrix:
+    """
+    Turn co-occurrence counts into one of `MEASURES`
+
+    :param counts: number of rows in which each pair of columns appears together
+    :param totals: number of rows in which each column of the first matrix appears
+    :param other_totals: number of rows in which each column of the second matrix appears
+    :param total_rows: total number of rows
+    :param measure: one of `MEASURES`
+    :return: sparse matrix with the measure for each pair that appears at least once
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"Unknown measure {measure}, choose one of {MEASURES}")
+    if measure == 'count':
+        return counts.tocsr()
+    first, second = totals[counts.row].astype(np.float64), other_totals[counts.col].astype(np.float64)
+    if measure == 'jaccard':
+        values = counts.data / (first + second - counts.data)
+    else:
+        values = counts.data * total_rows / (first * second)
+        if measure == 'pmi':
+            values = np.log(values)
+    return sparse.csr_matrix((values, (counts.row, counts.col)), shape=counts.shape)
+
+
+def labelled_frame(matrix: sparse.spmatrix, index: List[str], columns: List[str],
+                   names: Optional[Dict[str, str]] = None,
+                   column_names: Optional[Dict[str, str]] = None) -> 'pd.DataFrame':
+    """
+    Dense dataframe of a sparse matrix, with ids replaced by names when available
+
+    :param matrix: sparse matrix
+    :param index: id of each row
+    :param columns: id of each column
+    :param names: names of the row ids
+    :param column_names: names of the column ids
+    :return: dataframe
+    """
+    import pandas as pd
+
+    index = [names.get(label, label) for label in index] if names else index
+    columns = [column_names.get(label, label) for label in columns] if column_names else columns
+    return pd.DataFrame(matrix.toarray(), index=index, columns=columns)
+
+
+class IncidenceMatrix:
+
+    def __init__(self, row_labels: List[str], column_labels: List[str], matrix: sparse.csr_matrix):
+        """
+        :param row_labels: id of each row (experience)
+        :param column_labels: id of each column (e.g. tag or substance)
+        :param matrix: binary matrix, 1 where the column appears in the row
+        """
+        self.row_labels = row_labels
+        self.column_labels = column_labels
+        self.matrix = matrix
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[str, Iterable[str]]],
+                  row_labels: Optional[List[str]] = None) -> 'IncidenceMatrix':
+        """
+        Build the matrix from the items found in each row
+
+        :param rows: tuples of row id and ids of the items in the row
+        :param row_labels: order of the rows to use, e.g. to align two matrices over the same experiences.
+                           Rows not listed are discarded, listed rows that are missing stay empty
+        :return: incidence matrix
+        """
+        rows_index: Dict[str, int] = {label: i for i, label in enumerate(row_labels)} if row_labels else {}
+        fixed_rows = row_labels is not None
+        row_labels = list(row_labels) if row_labels else []
+        columns_index: Dict[str, int] = {}
+        row_indices: List[int] = []
+        column_indices: List[int] = []
+        for row_id, items in rows:
+            row = rows_index.get(row_id)
+            if row is None:
+                if fixed_rows:
+                    continue
+                row = rows_index[row_id] = len(row_labels)
+                row_labels.append(row_id)
+            for item in set(items):
+                column = columns_index.setdefault(item, len(columns_index))
+                row_indices.append(row)
+                column_indices.append(column)
+        data = np.ones(len(row_indices), dtype=np.int32)
+        matrix = sparse.csr_matrix((data, (row_indices, column_indices)),
+                                   shape=(len(row_labels), len(columns_index)))
+        return cls(row_labels, list(columns_index), matrix)
+
+    @property
+    def column_totals(self) -> np.ndarray:
+        """
+        :return: number of rows in which each column appears
+        """
+        return np.asarray(self.matrix.sum(axis=0)).ravel()
+
+    def co_occurrence(self, other: Optional['IncidenceMatrix'] = None, measure: str = 'count') -> sparse.csr_matrix:
+        """
+        Co-occurrence between the columns of this matrix and the ones of `other`.
+
+        :param other: incidence matrix with the same rows, this matrix itself by default
+        :param measure: one of `MEASURES`
+        :return: sparse matrix with one row per column of this matrix, and one column per column of `other`
+        """
+        other = other if other is not None else self
+        assert self.row_labels == other.row_labels, "Incidence matrices must have the same rows"
+        counts = (self.matrix.T @ other.matrix).tocoo()
+        return co_occurrence_measure(counts, self.column_totals, other.column_totals, len(self.row_labels), measure)
+
+    def co_occurrence_frame(self, other: Optional['IncidenceMatrix'] = None, measure: str = 'count',
+                            names: Optional[Dict[str, str]] = None,
+                            other_names: Optional[Dict[str, str]] = None) -> 'pd.DataFrame':
+        """
+        Dense, labelled version of `co_occurrence`
+
+        :param other: incidence matrix with the same rows, this matrix itself by default
+        :param measure: one of `MEASURES`
+        :param names: labels to use instead of the column ids of this matrix
+        :param other_names: labels to use instead of the column ids of `other`
+        :return: dataframe with one row per column of this matrix, and one column per column of `other`
+        """
+        other_matrix = other if other is not None else self
+        if other is None:
+            other_names = other_names or names
+        return labelled_frame(self.co_occurrence(other, measure), self.column_labels, other_matrix.column_labels,
+                              names, other_names)
@@ -0,0 +1,337 @@
+"""
+Prediction of the outcome of an experience from its setup: the OUTCOME tags are the targets, and the features are
+the substances, the routes of administration, the normalised doses and the SETTING tags.
+
+Feature matrices are cached on disk, keyed by a hash of the version of every experience. When the corpus changes,
+the rows of the experiences left untouched are reused, and only the new or changed experiences are read.
+One logistic regression is trained per OUTCOME tag, and their coefficients are stacked in a single matrix, so that
+predictions are a sparse matrix product for a batch, and a few dot products for a single setup.
+
+    env PYTHONPATH=src python src/cli.py train
+    env PYTHONPATH=src python src/cli.py predict --substances Cannabis Alcohol --routes smoked oral
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+from collections import defaultdict
+from dataclasses import dataclass
+from glob import glob
+from math import log1p
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.linear_model import LogisticRegression
+
+from processor import ErowidJSONProcessor, ExperiencesTagCategory, TagCategory
+from scraper.doses import normalize_dose
+
+# Create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def corpus_version(versions: Dict[str, float]) -> str:
+    """
+    :param versions: version of each experience, by id
+    :return: hash identifying the whole corpus
+    """
+    digest = hashlib.sha1()
+    for exp_id, version in sorted(versions.items()):
+        digest.update(f'{exp_id}:{version!r}\n'.encode())
+    return digest.hexdigest()
+
+
+def setup_features(substances: Iterable[str] = (), routes: Iterable[str] = (),
+                   doses: Iterable[Tuple[str, float, str]] = (), setting_tags: Iterable[str] = ()) -> Dict[str, float]:
+    """
+    Features of a setup, named after their kind and value
+
+    :param substances: ids of the substances taken
+    :param routes: canonical routes of administration
+    :param doses: substance name, amount and canonical unit of each dose
+    :param setting_tags: ids of the SETTING tags
+    :return: value of each feature
+    """
+    features: Dict[str, float] = {}
+    for substance_id in substances:
+        features[f'substance:{substance_id}'] = 1
+    for route in routes:
+        features[f'route:{route}'] = 1
+    amounts: Dict[str, float] = defaultdict(float)
+    for substance_name, amount, unit in doses:
+        amounts[f'dose:{substance_name}:{unit}'] += amount
+    # Doses span several orders of magnitude
+    features.update((feature, log1p(amount)) for feature, amount in amounts.items())
+    for tag_id in setting_tags:
+        features[f'tag:{tag_id}'] = 1
+    return features
+
+
+def experience_features(experience: dict, tag_categories: ExperiencesTagCategory
+                        ) -> Optional[Tuple[Dict[str, float], List[str]]]:
+    """
+    :param experience: experience with its substances, dose chart and tags
+    :param tag_categories: category of each tag
+    :return: features and OUTCOME tags of the experience, None if it has to be discarded
+    """
+    categories: Dict[str, Optional[TagCategory]] = {}
+    for tag in experience['tags']:
+        try:
+            categories[tag['id']] = TagCategory(tag_categories.tag_categories[int(tag['id'])])
+        except (KeyError, ValueError):
+            categories[tag['id']] = None
+    if TagCategory.DISCARD_EXP in categories.values():
+        return None
+    doses = []
+    routes = set()
+    for dose in experience.get('substances_details') or []:
+        if 'route' not in dose:
+            dose = {**dose, **normalize_dose(dose)}
+        if dose['route']:
+            routes.add(dose['route'])
+        if dose['amount_value'] is not None and dose['amount_unit']:
+            doses.append((dose['substance_name'], dose['amount_value'], dose['amount_unit']))
+    features = setup_features(substances=[substance['id'] for substance in experience.get('substances_main') or []],
+                              routes=routes,
+                              doses=doses,
+                              setting_tags=[tag_id for tag_id, category in categories.items()
+                                            if category == TagCategory.SETTING])
+    outcomes = [tag_id for tag_id, category in categories.items() if category == TagCategory.OUTCOME]
+    return features, outcomes
+
+
+@dataclass
+class FeatureMatrix:
+    exp_ids: List[str]
+    # Version of each experience the row was built from
+    versions: np.ndarray
+    # Experiences discarded because of their tags have an empty row, and are not used for training
+    usable: np.ndarray
+    feature_labels: List[str]
+    features: sparse.csr_matrix
+    target_labels: List[str]
+    targets: sparse.csr_matrix
+
+    @classmethod
+    def from_experiences(cls, experiences: Iterable[dict], versions: Dict[str, float],
+                         tag_categories: ExperiencesTagCategory,
+                         feature_labels: Optional[List[str]] = None,
+                         target_labels: Optional[List[str]] = None) -> 'FeatureMatrix':
+        """
+        :param experiences: experiences with their substances, dose chart and tags
+        :param versions: version of each experience, by id
+        :param tag_categories: category of each tag
+        :param feature_labels: columns to start with, new features are added after them
+        :param target_labels: target columns to start with, new targets are added after them
+        :return: features of the experiences, one row each
+        """
+        feature_index = {label: i for i, label in enumerate(feature_labels or [])}
+        target_index = {label: i for i, label in enumerate(target_labels or [])}
+        exp_ids, usable = [], []
+        features = ([], [], [])
+        targets = ([], [], [])
+        for row, experience in enumerate(experiences):
+            exp_ids.append(experience['exp_id'])
+            result = experience_features(experience, tag_categories)
+            usable.append(result is not None)
+            if result is None:
+                continue
+            exp_features, outcomes = result
+            for feature, value in exp_features.items():
+                features[0].append(row)
+                features[1].append(feature_index.setdefault(feature, len(feature_index)))
+                features[2].append(value)
+            for outcome in outcomes:
+                targets[0].append(row)
+                targets[1].append(target_index.setdefault(outcome, len(target_index)))
+                targets[2].append(1)
+        return cls(exp_ids=exp_ids,
+                   versions=np.array([versions[exp_id] for exp_id in exp_ids], dtype=np.float64),
+                   usable=np.array(usable, dtype=bool),
+                   feature_labels=list(feature_index),
+                   features=sparse.csr_matrix((features[2], (features[0], features[1])),
+                                              shape=(len(exp_ids), len(feature_index))),
+                   target_labels=list(target_index),
+                   targets=sparse.csr_matrix((targets[2], (targets[0], targets[1])),
+                                             shape=(len(exp_ids), len(target_index)), dtype=np.int8))
+
+    def take(self, rows: np.ndarray) -> 'FeatureMatrix':
+        """
+        :param rows: indices of the rows to keep
+        :return: matrix with only those rows
+        """
+        return FeatureMatrix(exp_ids=[self.exp_ids[row] for row in rows], versions=self.versions[rows],
+                             usable=self.usable[rows], feature_labels=self.feature_labels,
+                             features=self.features[rows], target_labels=self.target_labels,
+                             targets=self.targets[rows])
+
+    def append(self, other: 'FeatureMatrix') -> 'FeatureMatrix':
+        """
+        :param other: rows built starting with the columns of this matrix, so that they only add columns after them
+        :return: matrix with the rows of both
+        """
+        features = self.features.copy()
+        features.resize((features.shape[0], len(other.feature_labels)))
+        targets = self.targets.copy()
+        targets.resize((targets.shape[0], len(other.target_labels)))
+        return FeatureMatrix(exp_ids=self.exp_ids + other.exp_ids,
+                             versions=np.concatenate([self.versions, other.versions]),
+                             usable=np.concatenate([self.usable, other.usable]),
+                             feature_labels=other.feature_labels,
+                             features=sparse.vstack([features, other.features], format='csr'),
+                             target_labels=other.target_labels,
+                             targets=sparse.vstack([targets, other.targets], format='csr'))
+
+    def save(self, path: str):
+        """
+        Persist the matrices as a npz file
+
+        :param path: path of the file
+        """
+        labels = json.dumps({'exp_ids': self.exp_ids, 'features': self.feature_labels,
+                             'targets': self.target_labels})
+        np.savez(path, labels=np.array(labels), versions=self.versions, usable=self.usable,
+                 features_data=self.features.data, features_indices=self.features.indices,
+                 features_indptr=self.features.indptr, features_shape=self.features.shape,
+                 targets_data=self.targets.data, targets_indices=self.targets.indices,
+                 targets_indptr=self.targets.indptr, targets_shape=self.targets.shape)
+
+    @classmethod
+    def load(cls, path: str) -> 'FeatureMatrix':
+        """
+        :param path: path of the file written by `save`
+        :return: feature matrix
+        """
+        with np.load(path) as npz:
+            labels = json.loads(str(npz['labels']))
+            return cls(exp_ids=labels['exp_ids'], versions=npz['versions'], usable=npz['usable'],
+                       feature_labels=labels['features'],
+                       features=sparse.csr_matrix((npz['features_data'], npz['features_indices'],
+                                                   npz['features_indptr']), shape=tuple(npz['features_shape'])),
+                       target_labels=labels['targets'],
+                       targets=sparse.csr_matrix((npz['targets_data'], npz['targets_indices'],
+                                                  npz['targets_indptr']), shape=tuple(npz['targets_shape'])))
+
+
+def build_features(processor: ErowidJSONProcessor, tag_categories: ExperiencesTagCategory,
+                   rebuild: bool = False) -> FeatureMatrix:
+    """
+    Feature matrix of all the experiences, loaded from the cache when the corpus has not changed. Otherwise the rows
+    of the most recent cached matrix are reused for the experiences with the same version, and only the new or
+    changed experiences are read. The cache keeps only the matrix of the current corpus.
+
+    :param processor: processor of the corpus or JSON folder
+    :param tag_categories: category of each tag
+    :param rebuild: ignore the cached matrices
+    :return: feature matrix
+    """
+    folder = os.path.join(os.path.dirname(processor.stats_path('tags')), 'features')
+    os.makedirs(folder, exist_ok=True)
+    versions = processor.experience_versions()
+    path = os.path.join(folder, f'{corpus_version(versions)}.npz')
+    if os.path.isfile(path) and not rebuild:
+        logger.info(f"Loading cached features from {path}")
+        return FeatureMatrix.load(path)
+
+    cached = sorted(glob(os.path.join(folder, '*.npz')), key=os.path.getmtime)
+    if cached and not rebuild:
+        previous = FeatureMatrix.load(cached[-1])
+        unchanged = np.array([versions.get(exp_id) == version
+                              for exp_id, version in zip(previous.exp_ids, previous.versions)], dtype=bool)
+        previous = previous.take(np.flatnonzero(unchanged))
+    else:
+        previous = FeatureMatrix.from_experiences([], versions, tag_categories)
+    logger.info(f"Reusing features of {len(previous.exp_ids)} experiences, "
+                f"building the ones of {len(versions) - len(previous.exp_ids)}")
+    new = FeatureMatrix.from_experiences(processor.iter_experience_items(exclude=set(previous.exp_ids)), versions,
+                                         tag_categories, previous.feature_labels, previous.target_labels)
+    feature_matrix = previous.append(new)
+
+    feature_matrix.save(path)
+    for old_path in cached:
+        if old_path != path:
+            os.remove(old_path)
+    return feature_matrix
+
+
+class TagPredictor:
+
+    def __init__(self, feature_labels: List[str], target_labels: List[str], coefficients: np.ndarray,
+                 intercepts: np.ndarray):
+        """
+        :param feature_labels: name of each feature
+        :param target_labels: id of each OUTCOME tag predicted
+        :param coefficients: one row of coefficients per target, one column per feature
+        :param intercepts: intercept of each target
+        """
+        self.feature_labels = feature_labels
+        self.target_labels = target_labels
+        self.coefficients = coefficients
+        self.intercepts = intercepts
+        self.feature_index: Dict[str, int] = {label: i for i, label in enumerate(feature_labels)}
+
+    @classmethod
+    def fit(cls, feature_matrix: FeatureMatrix, min_examples: int = 10, regularization: float = 1.0) -> 'TagPredictor':
+        """
+        Train one logistic regression per OUTCOME tag with at least `min_examples` positive and negative examples
+
+        :param feature_matrix: features and targets of the experiences
+        :param min_examples: minimum number of positive and negative examples of a target
+        :param regularization: inverse of the regularization strength
+        :return: trained predictor
+        """
+        rows = np.flatnonzero(feature_matrix.usable)
+        features = feature_matrix.features[rows]
+        targets = feature_matrix.targets[rows].tocsc()
+        target_labels, coefficients, intercepts = [], [], []
+        for column, target in enumerate(feature_matrix.target_labels):
+            y = targets[:, column].toarray().ravel() > 0
+            if min(y.sum(), len(y) - y.sum()) < min_examples:
+                continue
+            model = LogisticRegression(C=regularization, solver='liblinear')
+            model.fit(features, y)
+            target_labels.append(target)
+            coefficients.append(model.coef_[0])
+            intercepts.append(model.intercept_[0])
+        logger.info(f"Trained {len(target_labels)} targets on {len(rows)} experiences")
+        return cls(feature_matrix.feature_labels, target_labels,
+                   np.array(coefficients).reshape(len(target_labels), len(feature_matrix.feature_labels)),
+                   np.array(intercepts))
+
+    def predict_proba(self, features: sparse.csr_matrix) -> np.ndarray:
+        """
+        Batch prediction
+
+        :param features: feature matrix, with the columns of the training one (or a prefix of them)
+        :return: probability of each target, one row per experience
+        """
+        scores = features @ self.coefficients[:, :features.shape[1]].T + self.intercepts
+        return 1 / (1 + np.exp(-scores))
+
+    def predict(self, substances: Iterable[str] = (), routes: Iterable[str] = (),
+                doses: Iterable[Tuple[str, float, str]] = (), setting_tags: Iterable[str] = ()) -> Dict[str, float]:
+        """
+        Prediction for a single setup, see `setup_features`. Features never seen in training are ignored.
+
+        :return: probability of each OUTCOME tag, by id
+        """
+        columns, values = [], []
+        for feature, value in setup_features(substances, routes, doses, setting_tags).items():
+            column = self.feature_index.get(feature)
+            if column is not None:
+                columns.append(column)
+                values.append(value)
+        scores = self.coefficients[:, columns] @ np.array(values) + self.intercepts
+        return dict(zip(self.target_labels, 1 / (1 + np.exp(-scores))))
+
+    def save(self, path: str):
+        with open(path, 'wb') as open_pickle:
+            pickle.dump(self, open_pickle)
+
+    @staticmethod
+    def load(path: str) -> 'TagPredictor':
+        with open(path, 'rb') as open_pickle:
+            return pickle.load(open_pickle)
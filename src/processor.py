@@ -17,32 +17,34 @@ Some of the functions:
 """
 import json
 import logging
+import os
 import re
 import sys
-from dataclasses import dataclass
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from glob import glob
-from statistics import mean
-from typing import List, Dict, Union
+from math import sqrt
+from typing import List, Dict, Union, Optional, Tuple, Set, Iterable, TYPE_CHECKING
 from enum import Enum
 from tqdm import tqdm
-import pandas as pd
+import numpy as np
+from scipy import sparse
 
-from utils import Experience
+from cooccurrence import IncidenceMatrix, co_occurrence_measure, labelled_frame
+from scraper.corpus import CorpusStore
+from scraper.doses import parse_amount, parse_use_time, parse_route
+from search import ExperienceIndex
+from utils import DOSE_FIELDS, Experience
+
+if TYPE_CHECKING:
+    # pandas is slow to import, and only loaded by the methods building dataframes
+    import pandas as pd
 
 # Create logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Create STDERR handler
-handler = logging.StreamHandler(sys.stderr)
-
-# Create formatter and add it to the handler
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
-handler.setFormatter(formatter)
-
-# Set STDERR handler as the only handler
-logger.handlers = [handler]
-
 
 class TagCategory(Enum):
     SETTING = 1
@@ -62,6 +64,8 @@ class ExperiencesTagCategory:
                                     two keys.
         """
 
+        import pandas as pd
+
         # Load data from csv and index tags ids
         tags_categories_df = pd.read_csv(tags_categories_path)
 
@@ -70,10 +74,12 @@ class ExperiencesTagCategory:
 
 @dataclass
 class Tag:
+    __slots__ = ('name', 'tag_id', 'exp_appearances', 'tag_category', 'perc_exp_appearances', 'perc_usages_sum',
+                 'perc_usages_sum_squares', 'average_impact', 'impact_std', 'co_appearances')
 
     def __init__(self, name: str, tag_id: str, perc_usage: float, category_mapper: ExperiencesTagCategory):
-        self.name: str = name
-        self.tag_id: str = tag_id
+        self.name: str = sys.intern(name)
+        self.tag_id: str = sys.intern(tag_id)
         self.exp_appearances: int = 1
 
         # TODO make sure the right category is assigned
@@ -85,10 +91,13 @@ class Tag:
         self.perc_exp_appearances: Union[float, None] = None
 
         # Percent of usage of the tag among other tags (e.g. Bad Trip is one among three tags, the usage is 0.333)
-        # Average is calculated among all appearances. Can only be calculated when total number of experiences is known.
-        self.perc_usages: List[float] = [perc_usage]
+        # Only its sum and sum of squares over all appearances are kept, average and standard deviation are
+        # calculated from them.
+        self.perc_usages_sum: float = perc_usage
+        self.perc_usages_sum_squares: float = perc_usage ** 2
 
         self.average_impact: Union[float, None] = None
+        self.impact_std: Union[float, None] = None
 
         self.co_appearances: Dict[str, int] = {}
 
@@ -100,7 +109,9 @@ class Tag:
         :param total_experiences: Total number of experiences from which tags are extracted
         """
         self.perc_exp_appearances = self.exp_appearances / total_experiences
-        self.average_impact = mean(self.perc_usages)
+        self.average_impact = self.perc_usages_sum / self.exp_appearances
+        variance = self.perc_usages_sum_squares / self.exp_appearances - self.average_impact ** 2
+        self.impact_std = sqrt(max(variance, 0))
 
     def to_dict(self):
         #TODO add tag type
@@ -108,8 +119,9 @@ class Tag:
                 'tag_id': self.tag_id,
                 'exp_appearances': self.exp_appearances,
                 'perc_exp_appearances': self.perc_exp_appearances,
-                'perc_usages': self.perc_usages,
-                'average_impact': self.average_impact}
+                'perc_usages_sum': self.perc_usages_sum,
+                'average_impact': self.average_impact,
+                'impact_std': self.impact_std}
 
 
 class Substance:
@@ -132,20 +144,199 @@ class Substance:
     # self.average_impact: Union[float, None] = None
     #
     # self.co_appearances: Dict[str, int] = {}
+    __slots__ = ('name', 'substance_id')
+
     def __init__(self, name: str, substance_id: str, perc_usage: float, category_mapper: ExperiencesTagCategory):
+        self.name: str = sys.intern(name)
+        self.substance_id: str = sys.intern(substance_id)
+
+
+# Tag ids that are used for the same tag
+TAG_ALIASES: Dict[str, str] = {'2-9': '17'}
+
+# Corpus table containing each key of the experience JSON that can be counted
+COUNTABLE_KEYS: Dict[str, str] = {'tags': 'tags', 'substances_main': 'substances'}
+
+
+@dataclass
+class ItemStats:
+    # Running aggregates of tags or substances: counts, sums and sums of squares of their usage, and co-appearances.
+    # They are persisted next to the corpus, and only updated with the experiences added since they were computed.
+    # Worker processes compute them over shards of experiences, and the partial ones are merged.
+
+    experiences: int = 0
+    exp_ids: Set[str] = field(default_factory=set)
+    names: Dict[str, str] = field(default_factory=dict)
+    appearances: Counter = field(default_factory=Counter)
+    perc_usages_sum: Counter = field(default_factory=Counter)
+    perc_usages_sum_squares: Counter = field(default_factory=Counter)
+    # Number of experiences where both items appear, keyed by the pair of ids
+    co_appearances: Counter = field(default_factory=Counter)
+    # Ids of the items found in each experience not yet included in `co_appearances`. Not persisted.
+    exp_items: List[Tuple[str, List[str]]] = field(default_factory=list)
+
+    def add_experience(self, exp_id: str, exp_items: Optional[List[dict]], aliases: Optional[Dict[str, str]] = None):
+        """
+        Count the items of one experience
+
+        :param exp_id: id of the experience
+        :param exp_items: items (dict with name and id) of the experience, None if it could not be parsed
+        :param aliases: ids to replace with another one
+        """
+        self.experiences += 1
+        self.exp_ids.add(exp_id)
+        if exp_items is None:
+            return
+        found_ids = []
+        for item in exp_items:
+            item_id = aliases.get(item['id'], item['id']) if aliases else item['id']
+            perc_usage = 1 / len(exp_items)
+            self.names.setdefault(item_id, item['name'])
+            self.appearances[item_id] += 1
+            self.perc_usages_sum[item_id] += perc_usage
+            self.perc_usages_sum_squares[item_id] += perc_usage ** 2
+            found_ids.append(item_id)
+        self.exp_items.append((exp_id, found_ids))
+
+    def merge(self, other: 'ItemStats'):
+        """
+        Add the aggregates of another shard of experiences to these ones
+        """
+        self.experiences += other.experiences
+        self.exp_ids.update(other.exp_ids)
+        for item_id, name in other.names.items():
+            self.names.setdefault(item_id, name)
+        self.appearances.update(other.appearances)
+        self.perc_usages_sum.update(other.perc_usages_sum)
+        self.perc_usages_sum_squares.update(other.perc_usages_sum_squares)
+        self.co_appearances.update(other.co_appearances)
+        self.exp_items.extend(other.exp_items)
+
+    def count_co_appearances(self):
+        """
+        Add the co-appearances of the experiences in `exp_items`, with a single sparse matrix product
+        """
+        incidence = IncidenceMatrix.from_rows(self.exp_items)
+        counts = incidence.co_occurrence().tocoo()
+        labels = incidence.column_labels
+        for row, column, value in zip(counts.row, counts.col, counts.data):
+            self.co_appearances[(labels[row], labels[column])] += int(value)
+        self.exp_items = []
+
+    def co_occurrence(self, measure: str = 'count') -> Tuple[List[str], sparse.csr_matrix]:
+        """
+        Co-occurrence matrix of the items, from the persisted counts
+
+        :param measure: one of 'count', 'lift', 'pmi', 'jaccard'
+        :return: ids of the items, and square sparse matrix
+        """
+        labels = list(self.names)
+        index = {label: i for i, label in enumerate(labels)}
+        rows, columns, data = [], [], []
+        for (item_id, co_occurring_id), value in self.co_appearances.items():
+            rows.append(index[item_id])
+            columns.append(index[co_occurring_id])
+            data.append(value)
+        counts = sparse.coo_matrix((data, (rows, columns)), shape=(len(labels), len(labels)))
+        totals = np.array([self.appearances[label] for label in labels])
+        return labels, co_occurrence_measure(counts, totals, totals, self.experiences, measure)
+
+    def save(self, path: str):
+        """
+        Persist the aggregates as JSON, replacing the previous file at once so that an interrupted run never leaves
+        it truncated
+
+        :param path: path of the JSON file
+        """
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as open_json:
+            json.dump({'experiences': self.experiences,
+                       'exp_ids': sorted(self.exp_ids),
+                       'names': self.names,
+                       'appearances': self.appearances,
+                       'perc_usages_sum': self.perc_usages_sum,
+                       'perc_usages_sum_squares': self.perc_usages_sum_squares,
+                       'co_appearances': [[*pair, value] for pair, value in self.co_appearances.items()]},
+                      open_json)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ItemStats':
+        """
+        :param path: path of the JSON file written by `save`
+        :return: persisted aggregates
+        """
+        with open(path, encoding='utf-8') as open_json:
+            stats_dict = json.load(open_json)
+        return cls(experiences=stats_dict['experiences'],
+                   exp_ids=set(stats_dict['exp_ids']),
+                   names=stats_dict['names'],
+                   appearances=Counter(stats_dict['appearances']),
+                   perc_usages_sum=Counter(stats_dict['perc_usages_sum']),
+                   perc_usages_sum_squares=Counter(stats_dict['perc_usages_sum_squares']),
+                   co_appearances=Counter({(item_id, co_occurring_id): value
+                                           for item_id, co_occurring_id, value in stats_dict['co_appearances']}))
+
+
+def _read_json_items(exp_json_path: str, key: str) -> Optional[List[dict]]:
+    """
+    Read only one key of an experience JSON file
+
+    :param exp_json_path: path of the experience
+    :param key: key to read, e.g. tags
+    :return: items of the experience, None if the JSON cannot be parsed for any reason
+    """
+    if exp_json_path.find('(1)') != -1:
+        logger.warning(f"Duplicate file: {exp_json_path} ")
+        return None
+    try:
+        with open(exp_json_path, encoding='utf-8') as open_json:
+            return json.load(open_json)[key]
+    except Exception:
+        return None
+
+
+def _count_json_shard(job: Tuple[List[str], str]) -> ItemStats:
+    exp_json_paths, key = job
+    aliases = TAG_ALIASES if key == 'tags' else None
+    counts = ItemStats()
+    for exp_json_path in exp_json_paths:
+        exp_id = os.path.basename(exp_json_path)[:-len('.json')]
+        counts.add_experience(exp_id, _read_json_items(exp_json_path, key), aliases)
+    return counts
+
+
+def _count_corpus_shard(job: Tuple[str, str, int, int, Set[str]]) -> ItemStats:
+    corpus_folder, key, partition, partitions, skip_ids = job
+    aliases = TAG_ALIASES if key == 'tags' else None
+    counts = ItemStats()
+    records = CorpusStore(corpus_folder).read(COUNTABLE_KEYS[key], partition=(partition, partitions), exclude=skip_ids)
+    for record in records:
+        counts.add_experience(record['exp_id'], record[key], aliases)
+    return counts
 
 
 class ErowidJSONProcessor:
 
-    def __init__(self, json_folder: str):
+    def __init__(self, json_folder: str, corpus: Optional[CorpusStore] = None):
 
         # Folder containing the JSON erowid data, one file per experience.
         self.json_folder = json_folder.rstrip('/')
 
+        # Consolidated storage of the erowid data. When set, it is used instead of the JSON folder.
+        self.corpus = corpus
+
         self.tags: Dict[str, Tag] = dict()
+        self.tag_stats = ItemStats()
+        self.substance_stats = ItemStats()
+
+        # Incidence matrices of each key of the experience JSON, all with the same rows
+        self.incidences: Dict[str, IncidenceMatrix] = {}
 
         self.data_points: Dict[str, Experience] = {}
 
+        self.search_index: Optional[ExperienceIndex] = None
+
     @staticmethod
     def get_exp(exp_json_path: str) -> Experience:
         """
@@ -157,96 +348,307 @@ class ErowidJSONProcessor:
         if exp_json_path.find('(1)') != -1:
             logger.warning(f"Duplicate file: {exp_json_path} ")
             raise Exception
-        with open(exp_json_path) as open_json:
+        with open(exp_json_path, encoding='utf-8') as open_json:
             exp_dict = json.load(open_json)
             try:
                 exp_id = re.findall(r'/(\d+)\.json', exp_json_path)[0]
             except Exception:
                 logging.exception(f"Error when extracting id from json file name {exp_json_path}")
                 raise
-            return Experience(exp_id=exp_id,
-                              title=exp_dict['title'],
-                              substances_details=exp_dict['substances_details'],
-                              story=exp_dict['story_paragraphs'],
-                              substances_simple=exp_dict['substances_main'],
-                              metadata=exp_dict['metadata'],
-                              tags=exp_dict['tags'])
+            return ErowidJSONProcessor.exp_from_dict(exp_id, exp_dict)
 
-    def get_tags(self):
+    @staticmethod
+    def exp_from_dict(exp_id: str, exp_dict: dict) -> Experience:
+        """
+        :param exp_id: id of the experience
+        :param exp_dict: experience, with the keys of the JSON files written by the scraper
+        :return: Instantiated Experience object
         """
-        Create the stats for each Tag found in all the experiences json files.
+        return Experience(exp_id=exp_id,
+                          title=exp_dict['title'],
+                          substances_details=exp_dict['substances_details'],
+                          story=exp_dict['story_paragraphs'],
+                          substances_simple=exp_dict['substances_main'],
+                          metadata=exp_dict['metadata'],
+                          tags=exp_dict['tags'])
+
+    def load_data_points(self):
         """
+        Load all the experiences in `data_points`. Experiences are kept in their compact representation, with tags,
+        substances and dose values stored once in the shared vocabularies of `utils`.
+        """
+        if self.corpus is not None:
+            for exp_dict in tqdm(self.corpus.read_experiences()):
+                self.data_points[exp_dict['exp_id']] = self.exp_from_dict(exp_dict['exp_id'], exp_dict)
+            return
+        for exp_json_path in tqdm(glob(f'{self.json_folder}/*.json')):
+            try:
+                exp = self.get_exp(exp_json_path)
+            except Exception:
+                continue
+            self.data_points[exp.exp_id] = exp
 
-        tags_categories = ExperiencesTagCategory('../data/tags_categories.csv')
+    def experience_versions(self) -> Dict[str, float]:
+        """
+        Version of each experience, which changes whenever the experience is written again: the modification time
+        of its JSON file, or the time its most recent record was written in the corpus, kept by compactions.
+
+        :return: version of each experience, by id
+        """
+        versions: Dict[str, float] = {}
+        if self.corpus is not None:
+            for table in ('substances', 'doses', 'tags'):
+                for record in self.corpus.read(table, columns=('_ts',)):
+                    versions[record['exp_id']] = max(record['_ts'], versions.get(record['exp_id'], 0))
+            return versions
+        with os.scandir(self.json_folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.name.find('(1)') == -1:
+                    versions[entry.name[:-len('.json')]] = entry.stat().st_mtime
+        return versions
+
+    def iter_experience_items(self, exclude: Optional[Set[str]] = None) -> Iterable[dict]:
+        """
+        :param exclude: ids of experiences not to read
+        :return: iterator of experiences with only their substances, dose chart and tags, tag aliases replaced
+        """
+        exclude = exclude or set()
+        keys = ('substances_main', 'substances_details', 'tags')
+        if self.corpus is not None:
+            records: Dict[str, dict] = {}
+            for table in ('substances', 'doses', 'tags'):
+                for record in self.corpus.read(table, exclude=exclude):
+                    records.setdefault(record['exp_id'], {}).update(record)
+            experiences = iter(records.values())
+        else:
+            exp_jsons = (exp_json_path for exp_json_path in glob(f'{self.json_folder}/*.json')
+                         if exp_json_path.find('(1)') == -1
+                         and os.path.basename(exp_json_path)[:-len('.json')] not in exclude)
+            experiences = ({'exp_id': os.path.basename(exp_json_path)[:-len('.json')],
+                            **{key: _read_json_items(exp_json_path, key) for key in keys}}
+                           for exp_json_path in exp_jsons)
+        for experience in experiences:
+            experience['tags'] = [{'name': tag['name'], 'id': TAG_ALIASES.get(tag['id'], tag['id'])}
+                                  for tag in experience.get('tags') or []]
+            yield experience
+
+    def search_index_path(self) -> str:
+        """
+        :return: path of the persisted search index, next to the corpus or the JSON folder
+        """
+        folder = self.corpus.folder if self.corpus is not None else os.path.dirname(self.json_folder)
+        return os.path.join(folder, 'search_index.npz')
 
-        total_experiences = 0
-        for exp_json in tqdm(glob(f'{self.json_folder}/*.json')):
+    def get_search_index(self, path: Optional[str] = None, rebuild: bool = False) -> ExperienceIndex:
+        """
+        Load the index to search experiences by combination of substances, e.g.
+        `processor.get_search_index().search(['Cannabis', 'Alcohol'], exact=True).tag_distribution`
+        The persisted index is used while no experience was added or written again since it was saved, otherwise
+        it is built again and saved.
+
+        :param path: path of the persisted index, `search_index_path` by default
+        :param rebuild: ignore the persisted index
+        :return: search index over all the experiences
+        """
+        path = ExperienceIndex.file_path(path or self.search_index_path())
+        if os.path.isfile(path) and not rebuild:
+            versions = self.experience_versions()
+            index = ExperienceIndex.load(path)
+            if set(index.exp_ids) == set(versions) and max(versions.values(), default=0) <= os.path.getmtime(path):
+                self.search_index = index
+                return self.search_index
+            logger.info(f"Search index {path} out of date, building it again")
+        self.search_index = ExperienceIndex.from_experiences(tqdm(self.iter_experience_items()))
+        self.search_index.save(path)
+        return self.search_index
+
+    def get_dose_table(self) -> 'pd.DataFrame':
+        """
+        Dose rows of all the experiences, with the raw strings and the normalised amount, unit, time and route.
+        Each column is normalised over its distinct values only, and the results spread to all the rows at once.
 
-            total_experiences += 1
-            try:
-                exp = self.get_exp(exp_json)
-            except:
-                # Skip experience if the json cannot be parsed for any reason
-                continue
-            found_tags_ids = []
-            for tag in exp.tags:
-                if tag['id'] in ['17', '2-9']:
-                    tag['id'] = '17'
-                existing_tag = self.tags.get(tag['id'])
-                if existing_tag:
-                    self.tags[tag['id']].exp_appearances += 1
-                    self.tags[tag['id']].perc_usages.append(1 / len(exp.tags))
-                else:
-                    self.tags[tag['id']] = Tag(name=tag['name'],
-                                               tag_id=tag['id'],
-                                               perc_usage=1 / len(exp.tags),
-                                               category_mapper=tags_categories)
-                found_tags_ids.append(tag['id'])
-
-            for tag in found_tags_ids:
-                for co_occurring_tag in found_tags_ids:
-                    if self.tags[tag].co_appearances.get(co_occurring_tag) is None:
-                        self.tags[tag].co_appearances[co_occurring_tag] = 1
-                    else:
-                        self.tags[tag].co_appearances[co_occurring_tag] += 1
-            total_experiences += 1
+        :return: dataframe with one row per dose, and its exp_id
+        """
+        import pandas as pd
+
+        if self.corpus is not None:
+            doses = pd.DataFrame(self.corpus.iter_dose_rows(), columns=('exp_id',) + DOSE_FIELDS)
+        else:
+            rows = []
+            for exp_json_path in glob(f'{self.json_folder}/*.json'):
+                exp_id = os.path.basename(exp_json_path)[:-len('.json')]
+                rows.extend({'exp_id': exp_id, **row} for row in _read_json_items(exp_json_path, 'substances_details')
+                            or [])
+            doses = pd.DataFrame(rows, columns=('exp_id',) + DOSE_FIELDS)
+        doses[list(DOSE_FIELDS)] = doses[list(DOSE_FIELDS)].fillna('')
+
+        for column, parser, fields in (('amount', parse_amount, ('amount_value', 'amount_unit')),
+                                       ('use_time', parse_use_time, ('use_minutes',)),
+                                       ('method', parse_route, ('route',))):
+            codes, raw_values = pd.factorize(doses[column])
+            parsed = [parser(raw) for raw in raw_values]
+            if len(fields) == 1:
+                parsed = [(value,) for value in parsed]
+            for i, field_name in enumerate(fields):
+                doses[field_name] = pd.Series([value[i] for value in parsed], dtype=object).take(codes).values
+        doses['amount_value'] = doses['amount_value'].astype(float)
+        doses['use_minutes'] = doses['use_minutes'].astype('Int64')
+        return doses
+
+    def count_items(self, key: str = 'tags', processes: Optional[int] = None,
+                    skip_ids: Optional[Set[str]] = None) -> ItemStats:
+        """
+        Count tags or substances over all the experiences, in parallel. Each worker process counts the items of a
+        shard of experiences, reading only the key needed, and the partial counts are merged at the end.
 
-        for tag in self.tags.values():
-            tag.calculate_stats(total_experiences)
+        :param key: key of the experience JSON to count, one of `COUNTABLE_KEYS`
+        :param processes: number of worker processes, one per core by default
+        :param skip_ids: ids of experiences not to read, e.g. the ones already counted
+        :return: counts of the experiences read
+        """
+        processes = processes or os.cpu_count() or 1
+        skip_ids = skip_ids or set()
+        if self.corpus is not None:
+            # Experiences are partitioned by id, so that all the records of one experience go to the same worker
+            jobs = [(self.corpus.folder, key, partition, processes, skip_ids) for partition in range(processes)]
+            count_shard = _count_corpus_shard
+        else:
+            exp_jsons = [exp_json for exp_json in glob(f'{self.json_folder}/*.json')
+                         if os.path.basename(exp_json)[:-len('.json')] not in skip_ids]
+            shard_size = max(1, len(exp_jsons) // (processes * 4) + 1)
+            jobs = [(exp_jsons[i:i + shard_size], key) for i in range(0, len(exp_jsons), shard_size)]
+            count_shard = _count_json_shard
+
+        counts = ItemStats()
+        with ProcessPoolExecutor(processes) as executor:
+            for shard_counts in tqdm(executor.map(count_shard, jobs), total=len(jobs)):
+                counts.merge(shard_counts)
+        return counts
+
+    def stats_path(self, key: str) -> str:
+        """
+        :param key: key of the experience JSON counted, one of `COUNTABLE_KEYS`
+        :return: path of the persisted aggregates, next to the corpus or the JSON folder
+        """
+        folder = self.corpus.folder if self.corpus is not None else os.path.dirname(self.json_folder)
+        return os.path.join(folder, f'{COUNTABLE_KEYS[key]}_stats.json')
 
-    def get_tags_co_appearances_matrix(self) -> pd.DataFrame:
+    def update_stats(self, key: str = 'tags', processes: Optional[int] = None, rebuild: bool = False) -> ItemStats:
         """
-        Create tags co-appearances matrix and return it as a dataframe.
-        This can then be visualized like a correlation matrix.
-        :return: a co-appearances matrix of all the tags found in the different experiences
+        Load the persisted aggregates, and update them with the experiences added since they were saved.
+        Experiences changed in place (e.g. extracted again) are only counted again with `rebuild`.
+
+        :param key: key of the experience JSON to count, one of `COUNTABLE_KEYS`
+        :param processes: number of worker processes, one per core by default
+        :param rebuild: ignore the persisted aggregates and count all the experiences again
+        :return: aggregates of all the experiences
+        """
+        path = self.stats_path(key)
+        stats = ItemStats.load(path) if os.path.isfile(path) and not rebuild else ItemStats()
+        new_counts = self.count_items(key, processes, skip_ids=stats.exp_ids)
+        logger.info(f"Updating {key} stats with {new_counts.experiences} new experiences")
+        stats.merge(new_counts)
+        stats.count_co_appearances()
+        stats.save(path)
+        return stats
+
+    def load_stats(self, key: str = 'tags') -> ItemStats:
+        """
+        Load the persisted aggregates as they are, without counting the experiences added since they were saved.
+        They are only computed if they were never saved.
+
+        :param key: key of the experience JSON counted, one of `COUNTABLE_KEYS`
+        :return: aggregates
+        """
+        path = self.stats_path(key)
+        if os.path.isfile(path):
+            return ItemStats.load(path)
+        return self.update_stats(key)
+
+    def get_tags(self, processes: Optional[int] = None, rebuild: bool = False):
         """
+        Create the stats for each Tag found in all the experiences, updating the persisted aggregates.
+
+        :param processes: number of worker processes, one per core by default
+        :param rebuild: count all the experiences again, instead of only the new ones
+        """
+
+        tags_categories = ExperiencesTagCategory('../data/tags_categories.csv')
+
+        self.tag_stats = self.update_stats('tags', processes, rebuild)
+        for tag_id, name in self.tag_stats.names.items():
+            tag = Tag(name=name, tag_id=tag_id, perc_usage=0, category_mapper=tags_categories)
+            tag.exp_appearances = self.tag_stats.appearances[tag_id]
+            tag.perc_usages_sum = self.tag_stats.perc_usages_sum[tag_id]
+            tag.perc_usages_sum_squares = self.tag_stats.perc_usages_sum_squares[tag_id]
+            self.tags[tag_id] = tag
+        for (tag_id, co_occurring_tag_id), co_appearances in self.tag_stats.co_appearances.items():
+            self.tags[tag_id].co_appearances[co_occurring_tag_id] = co_appearances
 
-        tags_co_appearances = []
         for tag in self.tags.values():
-            co_appearances_titles = {self.tags[tag_id].name: co_appearances for tag_id, co_appearances in tag.co_appearances.items()}
-            tags_co_appearances.append({**co_appearances_titles, 'tag_id':tag.name})
+            tag.calculate_stats(self.tag_stats.experiences)
 
-        # Create dataframe from list of dict
-        tags_co_appearances_df = pd.DataFrame(tags_co_appearances)
-        tags_co_appearances_df = tags_co_appearances_df.set_index('tag_id')
+    def get_substances(self, processes: Optional[int] = None, rebuild: bool = False):
+        """
+        Create the aggregates of the substances found in all the experiences, updating the persisted ones.
 
-        # Make dataframe symmetrical
-        label_union = tags_co_appearances_df.index.union(tags_co_appearances_df.columns)
-        tags_co_appearances_df = tags_co_appearances_df.reindex(index=label_union, columns=label_union)
-        return tags_co_appearances_df
+        :param processes: number of worker processes, one per core by default
+        :param rebuild: count all the experiences again, instead of only the new ones
+        """
+        self.substance_stats = self.update_stats('substances_main', processes, rebuild)
 
+    def get_incidence(self, key: str, processes: Optional[int] = None) -> IncidenceMatrix:
+        """
+        Build the experiences x items incidence matrix, reading all the experiences. Matrices of different keys
+        have the same rows, so that they can be multiplied.
+
+        :param key: key of the experience JSON, one of `COUNTABLE_KEYS`
+        :param processes: number of worker processes, one per core by default
+        :return: incidence matrix
+        """
+        if key not in self.incidences:
+            counts = self.count_items(key, processes)
+            row_labels = next(iter(self.incidences.values())).row_labels if self.incidences else sorted(counts.exp_ids)
+            self.incidences[key] = IncidenceMatrix.from_rows(counts.exp_items, row_labels=row_labels)
+        return self.incidences[key]
+
+    def get_co_occurrence_matrix(self, first: str = 'tags', second: Optional[str] = None, measure: str = 'count',
+                                 dense: bool = True) -> Union['pd.DataFrame', sparse.csr_matrix]:
+        """
+        Co-occurrence of tags and/or substances over all the experiences.
+        Co-occurrences of the same kind come from the persisted aggregates (`get_tags` or `get_substances` must be
+        called first), the ones between tags and substances from a single sparse matrix product.
+
+        :param first: 'tags' or 'substances_main', the rows of the result
+        :param second: 'tags' or 'substances_main', the columns of the result. Same as `first` by default
+        :param measure: one of 'count', 'lift', 'pmi', 'jaccard'
+        :param dense: return a dataframe labelled with names instead of a sparse matrix
+        :return: co-occurrence matrix
+        """
+        all_stats = {'tags': self.tag_stats, 'substances_main': self.substance_stats}
+        second = second or first
+        if second == first:
+            labels, matrix = all_stats[first].co_occurrence(measure)
+            other_labels = labels
+        else:
+            incidence, other_incidence = self.get_incidence(first), self.get_incidence(second)
+            matrix = incidence.co_occurrence(other_incidence, measure)
+            labels, other_labels = incidence.column_labels, other_incidence.column_labels
+        if not dense:
+            return matrix
+        return labelled_frame(matrix, labels, other_labels, all_stats[first].names, all_stats[second].names)
+
+    def get_tags_co_appearances_matrix(self) -> 'pd.DataFrame':
+        """
+        Create tags co-appearances matrix and return it as a dataframe.
+        This can then be visualized like a correlation matrix.
+        :return: a co-appearances matrix of all the tags found in the different experiences
+        """
+        tags_co_appearances_df = self.get_co_occurrence_matrix('tags')
+        label_order = sorted(tags_co_appearances_df.index)
+        return tags_co_appearances_df.reindex(index=label_order, columns=label_order)
 
     @staticmethod
     def process_exp(exp_dict):
         # TODO create from here
         pass
-
-
-def main():
-    processor = ErowidJSONProcessor('../data/experiences_db')
-    processor.get_tags()
-    print('completed')
-
-
-if __name__ == '__main__':
-    main()
@@ -1,35 +1,58 @@
-from typing import List
+import logging
+from typing import Dict, List, Optional
 
-import requests
-import requests_cache
+from scraper.sessions import SessionManager, get_session_manager
+from scraper.state import DownloadState
 
-from scraper.scrapers import from_txt_to_list
-
-requests_cache.install_cache("data/erowid_cache")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
 
 
 class CacheCleaner:
-    urls_to_clear: List[str] = []
+    urls_to_clear: List[str]
+    patterns_to_clear: List[str]
+
+    def __init__(self, session_manager: Optional[SessionManager] = None):
+        """
+        :param session_manager: sessions whose cache is cleaned, the shared ones by default
+        """
+        self.session_manager = session_manager or get_session_manager()
+        self.urls_to_clear = []
+        self.patterns_to_clear = []
 
     def add_urls_to_clean(self, urls: List[str]):
         self.urls_to_clear.extend(urls)
 
-    def clean_cache_from_urls(self):
+    def add_pattern_to_clean(self, pattern: str):
         """
-        Delete all urls in `urls_to_clear` from cache
+        :param pattern: url glob pattern, e.g. 'www.erowid.org/experiences/exp.cgi*' for all the list pages
         """
-        for url in self.urls_to_clear:
-            requests.Session().cache.delete_url(url)
-
-
-def main():
-    cleaner = CacheCleaner()
-    cleaner.add_urls_to_clean(from_txt_to_list('../../data/exp_links/failed_urls_ConnectionError.txt'))
-    cleaner.add_urls_to_clean(from_txt_to_list('data/exp_links/failed_urls_HTTPError.txt'))
-    cleaner.add_urls_to_clean(from_txt_to_list('../../data/exp_links/failed_urls_IndexError.txt'))
-    cleaner.add_urls_to_clean(from_txt_to_list('data/exp_links/failed_urls_MissingExperience.txt'))
-    cleaner.clean_cache_from_urls()
+        self.patterns_to_clear.append(pattern)
 
+    def add_failures_to_clean(self, state: DownloadState, error_type: Optional[str] = None):
+        """
+        :param state: download state recording the failures
+        :param error_type: only the failures with this exception name, e.g. 'IndexError' for pages whose
+                           extraction failed, all of them if None
+        """
+        self.add_urls_to_clean([url for _, url in state.failed(error_type)])
 
-if __name__ == '__main__':
-    main()
+    def clean_cache_from_urls(self) -> int:
+        """
+        Delete all urls in `urls_to_clear`, and all urls matching `patterns_to_clear`, from cache
+        in a single transaction
+        :return: number of responses deleted
+        """
+        deleted = self.session_manager.invalidate(self.urls_to_clear, self.patterns_to_clear)
+        self.urls_to_clear = []
+        self.patterns_to_clear = []
+        return deleted
+
+
+def print_size_report(report: Dict[str, Dict[str, int]]):
+    print(f"{'pattern':<45}{'pages':>10}{'bodies':>10}{'pages MB':>12}{'stored MB':>12}{'ratio':>8}")
+    for pattern, sizes in report.items():
+        stored = sizes['stored_bytes'] + sizes['stored_body_bytes']
+        ratio = sizes['page_bytes'] / stored if stored else 0
+        print(f"{pattern:<45}{sizes['pages']:>10}{sizes['bodies']:>10}{sizes['page_bytes'] / 2 ** 20:>12.1f}"
+              f"{stored / 2 ** 20:>12.1f}{ratio:>8.1f}")
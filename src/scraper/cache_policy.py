@@ -0,0 +1,242 @@
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+import requests
+from requests_cache import CachedSession
+from requests_cache.backends.sqlite import DbCache
+from requests_cache.response import CachedResponse, set_response_defaults
+from requests_cache.session import OriginalSession, url_match
+
+from scraper.cache_storage import CompressedResponses, train_dictionary
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Time to live of the cached pages, by url glob pattern. The first pattern matching a url is used.
+# List pages change whenever experiences are published, experiences are almost never edited.
+CACHE_TTLS: Dict[str, timedelta] = {
+    'www.erowid.org/experiences/exp.cgi*': timedelta(days=1),
+    'www.erowid.org/experiences/exp.php*': timedelta(days=365),
+}
+
+
+class PolicyCache(DbCache):
+    # Sqlite cache keeping, next to the responses, an index of the url, status and time of each one,
+    # so that entries can be found by url pattern without unpickling every response.
+    # Bodies are compressed and stored once however many responses share them (see `CompressedResponses`).
+
+    def __init__(self, db_path: str = 'data/erowid_cache', fast_save: bool = False, **kwargs):
+        super().__init__(db_path, fast_save=fast_save, **kwargs)
+        kwargs.setdefault('suppress_warnings', True)
+        self.responses = CompressedResponses(self.responses.db_path, table_name='responses', fast_save=fast_save,
+                                             **kwargs)
+        self.db_path = self.responses.db_path
+        with self.responses.connection(commit_on_success=True) as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS cache_index (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    status_code INTEGER,
+                    created_at TEXT,
+                    expires TEXT
+                )""")
+
+    def save_response(self, key: str, response: requests.Response, expire_after=None):
+        cached_response = CachedResponse(response, expire_after=expire_after)
+        self.responses[key] = cached_response
+        self._index(key, cached_response)
+
+    def _index(self, key: str, response):
+        with self.responses.connection(commit_on_success=True) as connection:
+            connection.execute("INSERT OR REPLACE INTO cache_index VALUES (?, ?, ?, ?, ?)",
+                               (key, response.url, response.status_code, response.created_at.isoformat(),
+                                response.expires.isoformat() if response.expires else None))
+
+    def is_fresh(self, key: str) -> bool:
+        """
+        :param key: key of the response
+        :return: True if the response is stored and not expired, so that no http call is needed to get it
+        """
+        with self.responses.connection() as connection:
+            row = connection.execute("SELECT expires FROM cache_index WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            # Redirects, and responses cached before the index existed, which never expire
+            return self.has_key(key)
+        return row[0] is None or datetime.fromisoformat(row[0]) > datetime.utcnow()
+
+    def refresh(self, key: str, response, expire_after):
+        """
+        Store again a cached response confirmed unchanged by the server, with a new expiration
+
+        :param key: key of the response
+        :param response: cached response
+        :param expire_after: time to live from now
+        """
+        response.created_at = datetime.utcnow()
+        response.revalidate(expire_after)
+        self.responses[key] = response
+        self._index(key, response)
+
+    def delete(self, key: str):
+        super().delete(key)
+        with self.responses.connection(commit_on_success=True) as connection:
+            connection.execute("DELETE FROM cache_index WHERE key = ?", (key,))
+
+    def rebuild_index(self):
+        """
+        Index the responses stored before the index existed, unpickling each of them once
+        """
+        self.apply_ttls({})
+
+    def keys_matching(self, pattern: str) -> List[str]:
+        """
+        :param pattern: url glob pattern, as in `CACHE_TTLS`
+        :return: keys of the cached responses whose url matches the pattern
+        """
+        with self.responses.connection() as connection:
+            rows = connection.execute("SELECT key, url FROM cache_index").fetchall()
+        return [key for key, url in rows if url_match(url, pattern)]
+
+    def delete_keys(self, keys: Iterable[str]) -> int:
+        """
+        Delete many responses, with their redirects, in a single transaction
+
+        :param keys: keys of the responses
+        :return: number of responses deleted
+        """
+        keys = [(key,) for key in keys]
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with connection:
+                deleted = connection.executemany("DELETE FROM responses WHERE key = ?", keys).rowcount
+                connection.executemany("DELETE FROM redirects WHERE key = ? OR value = ?",
+                                       ((key, key) for key, in keys))
+                connection.executemany("DELETE FROM cache_index WHERE key = ?", keys)
+        finally:
+            connection.close()
+        logger.info(f"Deleted {deleted} cached responses")
+        return deleted
+
+    def apply_ttls(self, ttls: Dict[str, timedelta]):
+        """
+        Set the expiration of the responses cached without one, e.g. before the policy was in place, from the time
+        they were saved, and index all the responses again
+
+        :param ttls: time to live by url glob pattern
+        """
+        indexed = updated = 0
+        with self.responses.bulk_commit():
+            with self.responses.connection() as connection:
+                connection.execute("DELETE FROM cache_index")
+            for key, response in self._get_valid_responses():
+                ttl = next((ttl for pattern, ttl in ttls.items() if url_match(response.url, pattern)), None)
+                if ttl is not None and response.expires is None:
+                    response.expires = response.created_at + ttl
+                    self.responses[key] = response
+                    updated += 1
+                self._index(key, response)
+                indexed += 1
+        logger.info(f"Indexed {indexed} cached responses, set the expiration of {updated} of them")
+
+    def compact(self, train: bool = True, samples: int = 1000):
+        """
+        Compress the responses stored whole by older versions, train a new compression dictionary on the cached
+        pages and compress all the bodies with it, delete the bodies no longer used, and give back the free space
+
+        :param train: train a new dictionary, otherwise only migrate, clean up and vacuum
+        :param samples: number of pages the dictionary is trained on
+        """
+        migrated = self.responses.migrate()
+        logger.info(f"Compressed {migrated} responses stored whole")
+        if train:
+            # A pickled response first, for the responses without body, which are all alike
+            dictionary = train_dictionary(self.responses.sample_bodies(samples), prefix=self.responses.sample_response())
+            if dictionary:
+                self.responses.add_dictionary(dictionary)
+                logger.info(f"Trained a {len(dictionary)} bytes dictionary, "
+                            f"compressed again {self.responses.recompress()} bodies")
+        logger.info(f"Deleted {self.responses.delete_unused_bodies()} unused bodies")
+        self.responses.vacuum()
+
+    def size_report(self, patterns: Iterable[str] = ()) -> Dict[str, Dict[str, int]]:
+        """
+        Size of the cached pages, grouped by the first url pattern matching them
+
+        :param patterns: url glob patterns, the patterns of `CACHE_TTLS` by default
+        :return: for each pattern, and 'other' for the remaining urls: number of pages, distinct bodies, size of the
+                 bodies of all the pages and of the distinct ones, and bytes used in the cache by the bodies and by
+                 the responses without them
+        """
+        patterns = list(patterns) or list(CACHE_TTLS)
+        report = {pattern: {'pages': 0, 'bodies': 0, 'page_bytes': 0, 'body_bytes': 0, 'stored_body_bytes': 0,
+                            'stored_bytes': 0}
+                  for pattern in patterns + ['other']}
+        seen = {pattern: set() for pattern in report}
+        with self.responses.connection() as connection:
+            rows = connection.execute(
+                "SELECT i.url, length(r.value), r.body, b.size, length(b.data) FROM responses AS r "
+                "LEFT JOIN cache_index AS i ON i.key = r.key LEFT JOIN bodies AS b ON b.digest = r.body")
+            for url, stored, digest, size, stored_body in rows:
+                pattern = next((pattern for pattern in patterns if url_match(url, pattern)), 'other')
+                sizes = report[pattern]
+                sizes['pages'] += 1
+                sizes['stored_bytes'] += stored
+                if digest is None:
+                    # Stored whole by older versions
+                    sizes['bodies'] += 1
+                    sizes['page_bytes'] += stored
+                    sizes['body_bytes'] += stored
+                    continue
+                sizes['page_bytes'] += size
+                if digest not in seen[pattern]:
+                    seen[pattern].add(digest)
+                    sizes['bodies'] += 1
+                    sizes['body_bytes'] += size
+                    sizes['stored_body_bytes'] += stored_body
+        return report
+
+
+class RevalidatingSession(CachedSession):
+    # Expired responses are revalidated with a conditional request (If-None-Match / If-Modified-Since) when the
+    # server sent an ETag or Last-Modified header. A 304 only refreshes the expiration of the cached response.
+    revalidated: int = 0
+
+    def __init__(self, cache: PolicyCache, urls_expire_after: Optional[Dict[str, timedelta]] = None, **kwargs):
+        """
+        :param cache: cache backend, shared by the sessions
+        :param urls_expire_after: time to live by url glob pattern, `CACHE_TTLS` by default
+        """
+        super().__init__(backend=cache,
+                         urls_expire_after=CACHE_TTLS if urls_expire_after is None else urls_expire_after, **kwargs)
+
+    def _handle_expired_response(self, request, response, cache_key, **kwargs):
+        validators = {}
+        if response.headers.get('ETag'):
+            validators['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        if not validators:
+            return super()._handle_expired_response(request, response, cache_key, **kwargs)
+
+        conditional_request = request.copy()
+        conditional_request.headers.update(validators)
+        try:
+            new_response = OriginalSession.send(self, conditional_request, **kwargs)
+        except Exception:
+            if self.old_data_on_error:
+                logger.warning('Revalidation failed; using stale cache data')
+                return response
+            raise
+        if new_response.status_code != 304:
+            if new_response.status_code in self.allowable_codes:
+                self.cache.save_response(cache_key, new_response, self._get_expiration(request.url))
+            return set_response_defaults(new_response)
+
+        for header in ('ETag', 'Last-Modified', 'Date'):
+            if header in new_response.headers:
+                response.headers[header] = new_response.headers[header]
+        self.cache.refresh(cache_key, response, self._get_expiration(request.url))
+        self.revalidated += 1
+        return response
@@ -0,0 +1,234 @@
+import hashlib
+import logging
+import sqlite3
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from requests_cache.backends.sqlite import DbPickleDict
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Maximum size of a zlib preset dictionary, the size of its window
+DICTIONARY_SIZE = 32768
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = DICTIONARY_SIZE, prefix: bytes = b'') -> bytes:
+    """
+    Build a zlib preset dictionary from the lines shared by many pages (page layout, navigation, scripts, error pages)
+
+    :param samples: bodies of representative pages
+    :param size: maximum size of the dictionary
+    :param prefix: content put first in the dictionary, e.g. a pickled response without body
+    :return: dictionary, with the most common lines at the end, where zlib references them with the shortest distances
+    """
+    document_frequency: Counter = Counter()
+    for sample in samples:
+        document_frequency.update(set(sample.splitlines(keepends=True)))
+    lines = []
+    length = len(prefix)
+    for line, count in document_frequency.most_common():
+        if count < 2:
+            break
+        if len(line.strip()) < 3 or length + len(line) > size:
+            continue
+        lines.append(line)
+        length += len(line)
+    return prefix + b''.join(reversed(lines))
+
+
+class CompressedResponses(DbPickleDict):
+    # Responses stored in two parts, both compressed with zlib and a preset dictionary trained on cached pages:
+    # the pickled response without its body in the `responses` table, and the body in the `bodies` table keyed by
+    # its sha1, so that identical bodies (error pages, block pages, empty result lists) are stored once.
+    # Rows written before, with the whole pickled response and no body, are still read.
+
+    def __init__(self, db_path, table_name: str = 'responses', level: int = 6, **kwargs):
+        """
+        :param db_path: path of the sqlite file
+        :param table_name: table of the pickled responses
+        :param level: zlib compression level
+        """
+        super().__init__(db_path, table_name=table_name, **kwargs)
+        self.level = level
+        self._dictionaries: Dict[int, bytes] = {}
+        with self.connection(commit_on_success=True) as connection:
+            columns = [row[1] for row in connection.execute(f"PRAGMA table_info(`{self.table_name}`)")]
+            for column, column_type in (('body', 'TEXT'), ('dictionary', 'INTEGER')):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE `{self.table_name}` ADD COLUMN {column} {column_type}")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS bodies (
+                    digest TEXT PRIMARY KEY,
+                    dictionary INTEGER,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )""")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_dictionaries (id INTEGER PRIMARY KEY, data BLOB)")
+        self._load_dictionaries()
+
+    def _load_dictionaries(self):
+        with self.connection() as connection:
+            self._dictionaries = dict(connection.execute("SELECT id, data FROM cache_dictionaries"))
+
+    @property
+    def dictionary_id(self) -> Optional[int]:
+        """
+        Dictionary used to compress new bodies, the last one trained
+        """
+        return max(self._dictionaries) if self._dictionaries else None
+
+    def add_dictionary(self, dictionary: bytes) -> int:
+        """
+        :param dictionary: preset dictionary, as returned by `train_dictionary`
+        :return: id of the dictionary, used to compress the bodies saved from now on
+        """
+        with self.connection(commit_on_success=True) as connection:
+            dictionary_id = connection.execute("INSERT INTO cache_dictionaries (data) VALUES (?)",
+                                               (sqlite3.Binary(dictionary),)).lastrowid
+        self._dictionaries[dictionary_id] = dictionary
+        return dictionary_id
+
+    def compress(self, content: bytes) -> Tuple[Optional[int], bytes]:
+        """
+        :param content: body of a response
+        :return: id of the dictionary used, and compressed body
+        """
+        dictionary_id = self.dictionary_id
+        if dictionary_id is None:
+            return None, zlib.compress(content, self.level)
+        compressor = zlib.compressobj(self.level, zdict=self._dictionaries[dictionary_id])
+        return dictionary_id, compressor.compress(content) + compressor.flush()
+
+    def decompress(self, dictionary_id: Optional[int], data: bytes) -> bytes:
+        """
+        :param dictionary_id: id of the dictionary used to compress the body
+        :param data: compressed body
+        :return: body
+        """
+        if dictionary_id is None:
+            return zlib.decompress(data)
+        if dictionary_id not in self._dictionaries:
+            # Trained by another process since this one started
+            self._load_dictionaries()
+        decompressor = zlib.decompressobj(zdict=self._dictionaries[dictionary_id])
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def __getitem__(self, key):
+        with self.connection() as connection:
+            row = connection.execute(
+                f"SELECT r.value, r.dictionary, r.body, b.dictionary, b.data FROM `{self.table_name}` AS r "
+                f"LEFT JOIN bodies AS b ON b.digest = r.body WHERE r.key = ?", (key,)).fetchone()
+        if not row:
+            raise KeyError
+        value, dictionary_id, digest, body_dictionary_id, data = row
+        if digest is None:
+            return self.deserialize(value)
+        response = self.deserialize(self.decompress(dictionary_id, value))
+        response._content = self.decompress(body_dictionary_id, data)
+        return response
+
+    def __setitem__(self, key, item):
+        content = getattr(item, '_content', None)
+        if not isinstance(content, bytes):
+            with self.connection(True) as connection:
+                connection.execute(f"INSERT OR REPLACE INTO `{self.table_name}` (key, value, body) VALUES (?, ?, NULL)",
+                                   (key, sqlite3.Binary(self.serialize(item))))
+            return
+        # Pickle a copy of the response without its body
+        stripped = object.__new__(type(item))
+        stripped.__dict__.update(item.__dict__, _content=b'', _raw_response=None)
+        digest = hashlib.sha1(content).hexdigest()
+        body_dictionary_id, data = self.compress(content)
+        with self.connection(True) as connection:
+            # Workers sharing the cache can save the same body (block and error pages) at the same time
+            connection.execute("INSERT OR IGNORE INTO bodies (digest, dictionary, size, data) VALUES (?, ?, ?, ?)",
+                               (digest, body_dictionary_id, len(content), sqlite3.Binary(data)))
+            dictionary_id, value = self.compress(self.serialize(stripped))
+            connection.execute(
+                f"INSERT OR REPLACE INTO `{self.table_name}` (key, value, body, dictionary) VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), digest, dictionary_id))
+
+    def clear(self):
+        super().clear()
+        with self.connection(True) as connection:
+            connection.execute(f"ALTER TABLE `{self.table_name}` ADD COLUMN body TEXT")
+            connection.execute(f"ALTER TABLE `{self.table_name}` ADD COLUMN dictionary INTEGER")
+            connection.execute("DELETE FROM bodies")
+
+    def migrate(self) -> int:
+        """
+        Split the responses stored whole, before the bodies were compressed, into response and compressed body
+        :return: number of responses migrated
+        """
+        with self.connection() as connection:
+            keys = [row[0] for row in connection.execute(f"SELECT key FROM `{self.table_name}` WHERE body IS NULL")]
+        migrated = 0
+        with self.bulk_commit():
+            for key in keys:
+                try:
+                    self[key] = self[key]
+                    migrated += 1
+                except Exception as e:
+                    logger.debug(f"Unable to migrate response with key {key}: {e}")
+        return migrated
+
+    def sample_bodies(self, count: int) -> List[bytes]:
+        """
+        :param count: maximum number of bodies
+        :return: bodies picked at random
+        """
+        with self.connection() as connection:
+            rows = connection.execute("SELECT dictionary, data FROM bodies ORDER BY random() LIMIT ?",
+                                      (count,)).fetchall()
+        return [self.decompress(dictionary_id, data) for dictionary_id, data in rows]
+
+    def sample_response(self) -> bytes:
+        """
+        :return: a pickled response without body, picked at random, empty if there is none
+        """
+        with self.connection() as connection:
+            row = connection.execute(f"SELECT dictionary, value FROM `{self.table_name}` WHERE body IS NOT NULL "
+                                     f"ORDER BY random() LIMIT 1").fetchone()
+        return self.decompress(*row) if row else b''
+
+    def _recompress_table(self, table: str, key_column: str, data_column: str, where: str, batch_size: int) -> int:
+        dictionary_id = self.dictionary_id
+        recompressed = 0
+        last_key = ''
+        while True:
+            with self.connection() as connection:
+                rows = connection.execute(
+                    f"SELECT {key_column}, dictionary, {data_column} FROM `{table}` WHERE {key_column} > ? "
+                    f"AND dictionary IS NOT ? AND {where} ORDER BY {key_column} LIMIT ?",
+                    (last_key, dictionary_id, batch_size)).fetchall()
+            updates = []
+            for last_key, old_dictionary_id, data in rows:
+                updates.append(self.compress(self.decompress(old_dictionary_id, data)) + (last_key,))
+            with self.connection(True) as connection:
+                connection.executemany(
+                    f"UPDATE `{table}` SET dictionary = ?, {data_column} = ? WHERE {key_column} = ?",
+                    ((new_id, sqlite3.Binary(data), key) for new_id, data, key in updates))
+            recompressed += len(rows)
+            if len(rows) < batch_size:
+                return recompressed
+
+    def recompress(self, batch_size: int = 1000) -> int:
+        """
+        Compress again all the responses and bodies with the last dictionary
+        :param batch_size: number of rows read at once
+        :return: number of bodies compressed again
+        """
+        self._recompress_table(self.table_name, 'key', 'value', 'body IS NOT NULL', batch_size)
+        return self._recompress_table('bodies', 'digest', 'data', '1', batch_size)
+
+    def delete_unused_bodies(self) -> int:
+        """
+        Delete the bodies no response refers to anymore, e.g. after invalidating pages
+        :return: number of bodies deleted
+        """
+        with self.connection(True) as connection:
+            return connection.execute(
+                f"DELETE FROM bodies WHERE digest NOT IN "
+                f"(SELECT body FROM `{self.table_name}` WHERE body IS NOT NULL)").rowcount
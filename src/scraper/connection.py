@@ -1,11 +1,22 @@
+import copy
 import json
 import logging
 import random
-from typing import List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+
+import requests
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Url probed through the proxy servers when credentials.json has no `probe_url`. It is not on the scraped site, so
+# probes do not count towards its rate limits, but the hosts must be allowed to reach it through the proxies
+DEFAULT_PROBE_URL = 'http://www.gstatic.com/generate_204'
+
 
 class ProxyServer:
     servers: List[str]
@@ -41,13 +52,320 @@ class ProxyServer:
         self.server_in_use = self.servers[self.server_number]
         logger.warning(f"Changed server, now using '{self.servers[self.server_number]}'")
 
-    def get_proxy(self):
+    def pin(self, server: str) -> 'ProxyServer':
+        """
+        Return a copy of this proxy that only ever uses `server`, so that
+        rotating after a failure does not move calls onto another IP.
+        :param server: one of the servers in `servers`
+        :return: ProxyServer bound to a single server
+        """
+        pinned = copy.copy(self)
+        pinned.servers = [server]
+        pinned.server_number = 0
+        pinned.server_in_use = server
+        return pinned
+
+    def is_alive(self, server: str) -> bool:
+        """
+        :param server: one of the servers in `servers`
+        :return: whether calls can be made through the server
+        """
+        return True
+
+    def best_server(self) -> str:
+        """
+        :return: server to use for the next call
+        """
+        return self.server_in_use
+
+    def get_proxy(self, server: Optional[str] = None):
         """
         Return proxy credentials to use to make socks calls though requests
+        :param server: server to use, defaults to `server_in_use`. Port 1080 unless given as host:port
         :return: dict with credenials and server for http and https
         """
-        proxy_string = f"socks5://{self.username}:{self.password}@{self.server_in_use}:1080"
+        server = server or self.server_in_use
+        address = server if ':' in server else f"{server}:1080"
+        proxy_string = f"socks5://{self.username}:{self.password}@{address}"
         return {
             'http': proxy_string,
             'https': proxy_string
         }
+
+
+@dataclass
+class ServerHealth:
+    # Moving average of the latency of the successful probes, None until the first one
+    latency: Optional[float] = None
+    # Moving average of the share of successful probes
+    success_rate: float = 1
+    consecutive_failures: int = 0
+    probes: int = 0
+
+
+class ProxyPool(ProxyServer):
+    probe_url: str
+    probe_interval: float
+    probe_timeout: float
+    max_failures: int
+    health: Dict[str, ServerHealth]
+
+    def __init__(self, cred_file, probe_url: Optional[str] = None, probe_interval: float = 60,
+                 probe_timeout: float = 10, max_failures: int = 3, smoothing: float = 0.3, start: bool = True):
+        """
+        Proxy servers checked in the background with a lightweight request through each of them, and ranked by
+        latency and success rate. Every call uses the best server at that moment, and servers failing
+        `max_failures` probes in a row are taken out of rotation until a probe succeeds again.
+
+        :param cred_file: credentials file, as for ProxyServer
+        :param probe_url: url requested through every server to check it, not on the scraped site so that probes
+                          do not count towards its rate limits. E.g. a local stand-in when testing. By default, the
+                          `probe_url` of the credentials file, or `DEFAULT_PROBE_URL` if it has none
+        :param probe_interval: seconds between two rounds of probes
+        :param probe_timeout: seconds after which a probe is considered failed
+        :param max_failures: failed probes in a row after which a server is considered dead
+        :param smoothing: weight of the last probe in the moving averages
+        :param start: start probing in a background thread right away
+        """
+        self._health_lock = threading.Lock()
+        super().__init__(cred_file)
+        if probe_url is None:
+            with open(cred_file) as open_json:
+                probe_url = json.load(open_json).get('probe_url', DEFAULT_PROBE_URL)
+        self.probe_url = probe_url
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_failures = max_failures
+        self.smoothing = smoothing
+        self.health = {server: ServerHealth() for server in self.servers}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if start:
+            self.start()
+
+    @property
+    def server_in_use(self) -> str:
+        return self.best_server()
+
+    @server_in_use.setter
+    def server_in_use(self, server: str):
+        # Set by ProxyServer, the server in use is always the best one instead
+        pass
+
+    def is_alive(self, server: str) -> bool:
+        with self._health_lock:
+            return self.health[server].consecutive_failures < self.max_failures
+
+    def _score(self, server: str) -> float:
+        health = self.health[server]
+        latency = health.latency if health.latency is not None else self.probe_timeout / 2
+        return latency / max(health.success_rate, 0.01)
+
+    def ranking(self) -> List[str]:
+        """
+        :return: servers alive, best first, followed by the dead ones
+        """
+        with self._health_lock:
+            return sorted(self.servers, key=lambda server: (self.health[server].consecutive_failures
+                                                            >= self.max_failures, self._score(server)))
+
+    def best_server(self) -> str:
+        return self.ranking()[0]
+
+    def record(self, server: str, latency: Optional[float]):
+        """
+        Record the outcome of a probe through a server. Failed real calls are recorded by `update_server_used`
+
+        :param server: one of the servers in `servers`
+        :param latency: seconds taken by the call, None if it failed
+        """
+        with self._health_lock:
+            health = self.health[server]
+            was_alive = health.consecutive_failures < self.max_failures
+            health.probes += 1
+            health.success_rate = self.smoothing * (latency is not None) + (1 - self.smoothing) * health.success_rate
+            if latency is None:
+                health.consecutive_failures += 1
+            else:
+                health.consecutive_failures = 0
+                health.latency = latency if health.latency is None else \
+                    self.smoothing * latency + (1 - self.smoothing) * health.latency
+            is_alive = health.consecutive_failures < self.max_failures
+        if was_alive != is_alive:
+            logger.warning(f"Server '{server}' is {'back in rotation' if is_alive else 'dead, out of rotation'}")
+
+    def update_server_used(self):
+        """
+        Record a failure of the best server, after a call through it failed, so that the next best is used
+        """
+        server = self.best_server()
+        self.record(server, None)
+        if self.best_server() != server:
+            logger.warning(f"Call through '{server}' failed, now using '{self.best_server()}'")
+
+    def probe(self, server: str) -> Optional[float]:
+        """
+        Make the probe request through a server
+        :param server: one of the servers in `servers`
+        :return: seconds taken, None if it failed
+        """
+        start = monotonic()
+        try:
+            res = requests.get(self.probe_url, proxies=self.get_proxy(server), timeout=self.probe_timeout)
+            res.raise_for_status()
+        except Exception as e:
+            logger.debug(f"Probe through '{server}' failed: {type(e).__name__}")
+            return None
+        return monotonic() - start
+
+    def probe_all(self):
+        """
+        Probe all the servers concurrently, so that a round takes at most `probe_timeout` seconds
+        """
+        with ThreadPoolExecutor(max_workers=len(self.servers)) as executor:
+            for server, latency in zip(self.servers, executor.map(self.probe, self.servers)):
+                self.record(server, latency)
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.probe_interval)
+
+    def start(self):
+        """
+        Start probing the servers in a background thread
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._probe_loop, name='proxy-probes', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def pin(self, server: str) -> ProxyServer:
+        """
+        Return a plain proxy that only ever uses `server`, without probes of its own
+        :param server: one of the servers in `servers`
+        :return: ProxyServer bound to a single server
+        """
+        pinned = ProxyServer.__new__(ProxyServer)
+        pinned.username = self.username
+        pinned.password = self.password
+        pinned.servers = [server]
+        pinned.server_number = 0
+        pinned.server_in_use = server
+        return pinned
+
+
+class AdaptiveThrottle:
+    delay: float
+    min_delay: float
+    max_delay: float
+    jitter: float
+    cooldown: float
+    latency: Optional[float]
+    error_rate: float
+    block_rate: float
+    quarantined_until: float
+
+    def __init__(self, initial_delay: float, min_delay: float, max_delay: float, jitter: float = 0,
+                 cooldown: float = 1800, decrease: float = 0.95, backoff: float = 2, smoothing: float = 0.1):
+        """
+        Thread-safe scheduler of the calls made through a single proxy server. The delay between calls
+        shrinks slowly while calls succeed, grows exponentially on errors or when responses slow down,
+        and the server is quarantined for `cooldown` seconds when it gets blocked, doubling on every block in a row.
+
+        :param initial_delay: seconds between calls to start with
+        :param min_delay: lowest delay reached while the server stays healthy
+        :param max_delay: highest delay reached while backing off
+        :param jitter: random seconds, up to this value, added to every delay
+        :param cooldown: seconds the server is not used after being blocked for the first time
+        :param decrease: factor applied to the delay after each successful call
+        :param backoff: factor applied to the delay after each error
+        :param smoothing: weight of the last call in the moving averages of latency, error and block rates
+        """
+        assert 0 <= min_delay <= initial_delay <= max_delay
+        self.delay = initial_delay
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.cooldown = cooldown
+        self.decrease = decrease
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.latency = None
+        self.error_rate = 0
+        self.block_rate = 0
+        self.quarantined_until = 0
+        self._blocks_in_a_row = 0
+        self._next_call = monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next call can be made through the server, then reserve it
+        """
+        with self._lock:
+            now = monotonic()
+            call_at = max(now, self._next_call, self.quarantined_until)
+            self._next_call = call_at + self.delay + random.uniform(0, self.jitter)
+        if call_at > now:
+            sleep(call_at - now)
+
+    @property
+    def is_quarantined(self) -> bool:
+        return monotonic() < self.quarantined_until
+
+    def _update_rates(self, latency: Optional[float], error: bool, blocked: bool):
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                self.smoothing * latency + (1 - self.smoothing) * self.latency
+        self.error_rate = self.smoothing * error + (1 - self.smoothing) * self.error_rate
+        self.block_rate = self.smoothing * blocked + (1 - self.smoothing) * self.block_rate
+
+    def record_success(self, latency: float):
+        """
+        :param latency: seconds taken by the call
+        """
+        with self._lock:
+            slow = self.latency is not None and latency > 3 * self.latency
+            self._update_rates(latency, False, False)
+            self._blocks_in_a_row = 0
+            if slow:
+                # Responses slowing down are the first sign of an overloaded or suspicious server
+                self.delay = min(self.max_delay, self.delay * (1 + (self.backoff - 1) / 4))
+            else:
+                self.delay = max(self.min_delay, self.delay * self.decrease)
+
+    def record_error(self):
+        """
+        Record a failed call, e.g. a connection error or an error status
+        """
+        with self._lock:
+            self._update_rates(None, True, False)
+            self.delay = min(self.max_delay, max(self.delay, self.min_delay, 1) * self.backoff)
+
+    def record_block(self):
+        """
+        Record that the server has been blocked, putting it in quarantine
+        """
+        with self._lock:
+            self._update_rates(None, True, True)
+            cooldown = self.cooldown * 2 ** self._blocks_in_a_row
+            self._blocks_in_a_row += 1
+            self.quarantined_until = monotonic() + cooldown
+            self.delay = max(self.delay, self.initial_delay)
+            logger.warning(f"Server quarantined for {cooldown:.0f} seconds")
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: current delay, moving averages of latency, error and block rates, and seconds left in quarantine
+        """
+        with self._lock:
+            return {'delay': self.delay,
+                    'latency': self.latency if self.latency is not None else float('nan'),
+                    'error_rate': self.error_rate,
+                    'block_rate': self.block_rate,
+                    'quarantine_left': max(0.0, self.quarantined_until - monotonic())}
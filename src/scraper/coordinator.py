@@ -0,0 +1,242 @@
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+@dataclass
+class Lease:
+    first_id: int
+    last_id: int
+    worker: str
+    # Number of times the batch was leased, so that a worker whose lease expired cannot renew or complete the batch
+    # once another worker leased it
+    token: int
+    expires_at: float
+    # Set when a renewal failed, the batch may be downloaded by another worker too
+    lost: bool = False
+
+    @property
+    def exp_ids(self) -> List[str]:
+        return [str(exp_id) for exp_id in range(self.first_id, self.last_id + 1)]
+
+
+class LeaseQueue:
+    # Batches of experience ids shared by download workers on several hosts. A worker leases a batch for
+    # `lease_seconds`, renews the lease while downloading it (see LeaseHeartbeat), and completes it at the end.
+    # Batches whose lease expired, e.g. because their host crashed, are leased again by the next worker asking.
+    # The queue is a sqlite file on storage all the hosts can lock (a local file to test with several processes
+    # of the same host), a few statements per batch are the only work shared by the hosts.
+    db_path: str
+    lease_seconds: float
+    worker: str
+
+    def __init__(self, db_path: str, lease_seconds: float = 600, worker: Optional[str] = None):
+        """
+        :param db_path: path of the sqlite file, created if missing
+        :param lease_seconds: seconds a batch stays leased without being renewed
+        :param worker: name of this worker, host and process id by default
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self._lock = threading.Lock()
+        # Transactions are opened explicitly, to take the write lock of the file before reading the batch to lease
+        self._connection = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction():
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    first_id INTEGER PRIMARY KEY,
+                    last_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    token INTEGER NOT NULL DEFAULT 0,
+                    expires_at REAL,
+                    downloaded INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0
+                )""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS batches_status ON batches (status, position)")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+
+    def create(self, first_id: int = 1, last_id: int = 129999, batch_size: int = 500, seed: int = 666) -> int:
+        """
+        Split the ids into batches, leased in a random order so that each host gets ids from the whole range,
+        as ids are sparse. Nothing is done if the queue already has batches, so every worker can call it when
+        starting.
+
+        :param first_id: first id to download
+        :param last_id: last id to download, included
+        :param batch_size: number of ids in a batch
+        :param seed: seed of the order of the batches, the same for every host
+        :return: number of batches added
+        """
+        firsts = list(range(first_id, last_id + 1, batch_size))
+        positions = list(range(len(firsts)))
+        random.Random(seed).shuffle(positions)
+        with self._transaction():
+            if self._connection.execute("SELECT COUNT(*) FROM batches").fetchone()[0]:
+                return 0
+            return self._connection.executemany(
+                "INSERT OR IGNORE INTO batches (first_id, last_id, position, status) VALUES (?, ?, ?, ?)",
+                ((first, min(first + batch_size - 1, last_id), position, PENDING)
+                 for first, position in zip(firsts, positions))).rowcount
+
+    def acquire(self) -> Optional[Lease]:
+        """
+        Lease the next batch, pending or whose lease expired
+        :return: lease of the batch, None once all the batches are done or leased by live workers
+        """
+        now = time.time()
+        with self._transaction():
+            row = self._connection.execute(
+                "SELECT first_id, last_id, status, token FROM batches "
+                "WHERE status = ? OR (status = ? AND expires_at < ?) ORDER BY status = ?, position LIMIT 1",
+                (PENDING, LEASED, now, LEASED)).fetchone()
+            if row is None:
+                return None
+            first_id, last_id, status, token = row
+            lease = Lease(first_id, last_id, self.worker, token + 1, now + self.lease_seconds)
+            self._connection.execute(
+                "UPDATE batches SET status = ?, worker = ?, token = ?, expires_at = ? WHERE first_id = ?",
+                (LEASED, lease.worker, lease.token, lease.expires_at, first_id))
+        if status == LEASED:
+            logger.warning(f"Lease of batch {first_id}-{last_id} expired, batch leased again")
+        return lease
+
+    def _update_lease(self, lease: Lease, assignments: str, args: tuple) -> bool:
+        with self._transaction():
+            updated = self._connection.execute(
+                f"UPDATE batches SET {assignments} WHERE first_id = ? AND worker = ? AND token = ? AND status = ?",
+                args + (lease.first_id, lease.worker, lease.token, LEASED)).rowcount
+        return updated == 1
+
+    def renew(self, lease: Lease) -> bool:
+        """
+        Extend a lease by `lease_seconds`
+        :param lease: lease held by this worker
+        :return: False if the lease was lost, i.e. it expired and the batch was leased by another worker
+        """
+        expires_at = time.time() + self.lease_seconds
+        if not self._update_lease(lease, "expires_at = ?", (expires_at,)):
+            lease.lost = True
+            return False
+        lease.expires_at = expires_at
+        return True
+
+    def complete(self, lease: Lease, downloaded: int = 0, failed: int = 0) -> bool:
+        """
+        Mark a batch done
+        :param lease: lease held by this worker
+        :param downloaded: number of experiences of the batch downloaded
+        :param failed: number of experiences of the batch that failed, most ids do not exist
+        :return: False if the lease was lost, the batch is then completed by the worker holding it
+        """
+        return self._update_lease(lease, "status = ?, downloaded = ?, failed = ?", (DONE, downloaded, failed))
+
+    def release(self, lease: Lease) -> bool:
+        """
+        Give a batch back before downloading all of it, e.g. when stopping, so that it is leased again right away
+        :param lease: lease held by this worker
+        :return: False if the lease was already lost
+        """
+        return self._update_lease(lease, "status = ?, expires_at = NULL", (PENDING,))
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: number of batches for each status
+        """
+        with self._lock:
+            return dict(self._connection.execute("SELECT status, COUNT(*) FROM batches GROUP BY status"))
+
+    def workers(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: number of batches done, experiences downloaded and failed, for each worker
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT worker, COUNT(*), SUM(downloaded), SUM(failed) FROM batches WHERE status = ? GROUP BY worker",
+                (DONE,)).fetchall()
+        return {worker: {'batches': batches, 'downloaded': downloaded, 'failed': failed}
+                for worker, batches, downloaded, failed in rows}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class LeaseHeartbeat:
+    # Renews a lease in a background thread while its batch is downloaded, so that batches can be leased for a short
+    # time, and the ones of a crashed host are picked up quickly by the others
+    interval: float
+
+    def __init__(self, lease_queue: LeaseQueue, lease: Lease, interval: Optional[float] = None):
+        """
+        :param lease_queue: queue the lease comes from
+        :param lease: lease to renew
+        :param interval: seconds between two renewals, a third of the lease duration by default
+        """
+        self.lease_queue = lease_queue
+        self.lease = lease
+        self.interval = interval if interval is not None else lease_queue.lease_seconds / 3
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                renewed = self.lease_queue.renew(self.lease)
+            except sqlite3.Error as e:
+                # The lease is still valid until it expires, try again at the next beat
+                logger.warning(f"Unable to renew the lease of batch {self.lease.first_id}: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"Lease of batch {self.lease.first_id}-{self.lease.last_id} lost, "
+                               f"it is downloaded by another worker too")
+                return
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._heartbeat_loop, name='lease-heartbeat', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> Lease:
+        self.start()
+        return self.lease
+
+    def __exit__(self, *exc_info):
+        self.stop()
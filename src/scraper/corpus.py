@@ -0,0 +1,304 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from glob import glob
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the folder is not locked, compact only while no other process writes to the corpus
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Each table holds one record per experience, with the keys of the experience JSON it contains.
+# Reading a table only parses its own files, e.g. tags can be loaded without any story text.
+TABLES: Dict[str, Tuple[str, ...]] = {
+    'experiences': ('title', 'metadata', 'story_paragraphs'),
+    'doses': ('substances_details',),
+    'tags': ('tags',),
+    'substances': ('substances_main',),
+}
+
+
+def partition_of(exp_id: str, partitions: int) -> int:
+    """
+    Stable partition of an experience, the same in every process
+    :param exp_id: id of the experience
+    :param partitions: total number of partitions
+    :return: partition number, from 0 to `partitions` - 1
+    """
+    return zlib.crc32(exp_id.encode()) % partitions
+
+
+def _peek_exp_id(line: str) -> str:
+    """
+    Read the exp_id of a record without parsing the whole line. Records always start with it.
+    """
+    prefix = '{"exp_id": "'
+    if line.startswith(prefix):
+        return line[len(prefix):line.index('"', len(prefix))]
+    return json.loads(line)['exp_id']
+
+
+class CorpusStore:
+    # Append-only storage of the whole corpus as JSON Lines shards, one folder per table.
+    # Every process writes to its own shards, and when an experience is written more than once
+    # the most recent record wins. `compact` rewrites the tables keeping only those records.
+    # Writers hold a shared lock on the `.lock` file of the folder while they have shards open, and `compact` an
+    # exclusive one, so that a folder shared by several hosts is never compacted while one of them writes to it.
+    folder: str
+    shard_size: int
+
+    def __init__(self, folder: str = 'data/corpus', shard_size: int = 10000):
+        """
+        :param folder: folder containing one sub folder per table, created if missing
+        :param shard_size: maximum number of records written in each shard file
+        """
+        self.folder = folder.rstrip('/')
+        self.shard_size = shard_size
+        for table in TABLES:
+            os.makedirs(os.path.join(self.folder, table), exist_ok=True)
+        self._lock = threading.Lock()
+        self._shards: Dict[str, IO] = {}
+        self._shard_records: Dict[str, int] = {}
+        self._shard_numbers: Dict[str, int] = {table: 0 for table in TABLES}
+        self._writer = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}"
+        self._folder_lock: Optional[IO] = None
+
+    def _lock_folder(self, exclusive: bool = False) -> bool:
+        """
+        Take the lock of the folder, waiting for a compaction to end before writing
+        :param exclusive: take it for a compaction, without waiting
+        :return: False if the exclusive lock is held by other processes
+        """
+        if fcntl is None:
+            return True
+        if self._folder_lock is None:
+            self._folder_lock = open(os.path.join(self.folder, '.lock'), 'a')
+        try:
+            fcntl.flock(self._folder_lock, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _unlock_folder(self):
+        if self._folder_lock is not None:
+            self._folder_lock.close()
+            self._folder_lock = None
+
+    def _table_files(self, table: str) -> List[str]:
+        return sorted(glob(os.path.join(self.folder, table, '*.jsonl')))
+
+    def _open_shard(self, table: str) -> IO:
+        """
+        Return the shard file currently written by this process for `table`, rotating it when full
+        """
+        shard = self._shards.get(table)
+        if not self._shards:
+            self._lock_folder()
+        if shard is None or self._shard_records[table] >= self.shard_size:
+            if shard is not None:
+                shard.close()
+                self._shard_numbers[table] += 1
+            path = os.path.join(self.folder, table, f"{self._writer}-{self._shard_numbers[table]:05d}.jsonl")
+            shard = open(path, 'a', encoding='utf-8')
+            self._shards[table] = shard
+            self._shard_records[table] = 0
+        return shard
+
+    def write_experience(self, exp_id: str, exp_dict: dict):
+        """
+        Append an experience to all the tables
+
+        :param exp_id: id of the experience
+        :param exp_dict: experience, as returned by `ExperienceScraper.to_dict`
+        """
+        written_at = time.time()
+        with self._lock:
+            for table, keys in TABLES.items():
+                record = {'exp_id': exp_id, '_ts': written_at}
+                record.update((key, exp_dict[key]) for key in keys)
+                self._write_record(table, record)
+
+    def write_experiences(self, experiences: Iterable[Tuple[str, dict]], fsync: bool = False):
+        """
+        Append many experiences to all the tables, flushing the shards once at the end
+
+        :param experiences: tuples of id and experience
+        :param fsync: wait until the shards are written to disk
+        """
+        written_at = time.time()
+        with self._lock:
+            for exp_id, exp_dict in experiences:
+                for table, keys in TABLES.items():
+                    record = {'exp_id': exp_id, '_ts': written_at}
+                    record.update((key, exp_dict[key]) for key in keys)
+                    self._write_record(table, record, flush=False)
+            for shard in self._shards.values():
+                shard.flush()
+                if fsync:
+                    os.fsync(shard.fileno())
+
+    def write_records(self, table: str, records: Iterable[dict]):
+        """
+        Append new versions of the records of a single table, e.g. after updating some of their keys.
+        They win over the previous ones when reading.
+
+        :param table: one of `TABLES`
+        :param records: records with exp_id and all the keys of the table
+        """
+        written_at = time.time()
+        with self._lock:
+            for record in records:
+                new_record = {'exp_id': record['exp_id'], '_ts': written_at}
+                new_record.update((key, record[key]) for key in TABLES[table])
+                self._write_record(table, new_record)
+
+    def _write_record(self, table: str, record: dict, flush: bool = True):
+        shard = self._open_shard(table)
+        shard.write(json.dumps(record, ensure_ascii=False))
+        shard.write('\n')
+        if flush:
+            shard.flush()
+        self._shard_records[table] += 1
+
+    def read(self, table: str, columns: Optional[Iterable[str]] = None,
+             partition: Optional[Tuple[int, int]] = None, exclude: Optional[Set[str]] = None) -> Iterator[dict]:
+        """
+        Read the records of a table, keeping only the most recent one of each experience
+
+        :param table: one of `TABLES`
+        :param columns: keys to keep in each record, besides exp_id. All of them by default
+        :param partition: partition number and total number of partitions. When set, only the records of the
+                          experiences in the partition are parsed, so that partitions can be read in parallel
+        :param exclude: ids of experiences whose records are skipped without being parsed
+        :return: iterator of records
+        """
+        columns = tuple(columns) if columns is not None else TABLES[table]
+        latest: Dict[str, Tuple[float, dict]] = {}
+        for path in self._table_files(table):
+            with open(path, encoding='utf-8') as open_jsonl:
+                for line in open_jsonl:
+                    try:
+                        if partition is not None or exclude:
+                            exp_id = _peek_exp_id(line)
+                            if exclude and exp_id in exclude:
+                                continue
+                            if partition is not None and partition_of(exp_id, partition[1]) != partition[0]:
+                                continue
+                        record = json.loads(line)
+                    except ValueError:
+                        # Skip a line left half written by a crash
+                        logger.warning(f"Skipping invalid record in {path}")
+                        continue
+                    exp_id = record['exp_id']
+                    previous = latest.get(exp_id)
+                    if previous is None or record['_ts'] >= previous[0]:
+                        projected = {'exp_id': exp_id}
+                        projected.update((column, record[column]) for column in columns)
+                        latest[exp_id] = (record['_ts'], projected)
+        for _, record in latest.values():
+            yield record
+
+    def read_experiences(self) -> Iterator[dict]:
+        """
+        Rebuild the whole experiences, with the same keys as the JSON files written by the scraper
+        :return: iterator of experiences, with their exp_id
+        """
+        experiences: Dict[str, dict] = {record['exp_id']: record for record in self.read('experiences')}
+        for table in ('doses', 'tags', 'substances'):
+            for record in self.read(table):
+                experiences[record['exp_id']].update(record)
+        return iter(experiences.values())
+
+    def iter_dose_rows(self) -> Iterator[dict]:
+        """
+        :return: iterator of dose rows of all experiences, each with its exp_id
+        """
+        for record in self.read('doses'):
+            for row in record['substances_details']:
+                yield {'exp_id': record['exp_id'], **row}
+
+    def exp_ids(self) -> List[str]:
+        """
+        :return: ids of all the experiences in the corpus
+        """
+        return [record['exp_id'] for record in self.read('substances', columns=())]
+
+    def close(self):
+        with self._lock:
+            for shard in self._shards.values():
+                shard.close()
+            self._shards = {}
+            self._unlock_folder()
+
+    def compact(self) -> bool:
+        """
+        Rewrite every table keeping only the most recent record of each experience,
+        in full shards, and delete the previous files.
+        Nothing is done while other processes write to the corpus.
+        :return: False if the corpus was in use
+        """
+        self.close()
+        with self._lock:
+            if not self._lock_folder(exclusive=True):
+                self._unlock_folder()
+                logger.warning(f"Corpus {self.folder} is being written by other processes, not compacted")
+                return False
+            try:
+                self._compact_tables()
+            finally:
+                self._unlock_folder()
+        return True
+
+    def _compact_tables(self):
+        for table in TABLES:
+            old_files = self._table_files(table)
+            written = 0
+            shard = None
+            new_files = []
+            # The time each record was written is kept, as the version of the experience
+            for record in self.read(table, columns=TABLES[table] + ('_ts',)):
+                if written % self.shard_size == 0:
+                    if shard is not None:
+                        shard.close()
+                    shard_name = f"compacted-{self._writer}-{written // self.shard_size:05d}.tmp"
+                    path = os.path.join(self.folder, table, shard_name)
+                    shard = open(path, 'w', encoding='utf-8')
+                    new_files.append(path)
+                shard.write(json.dumps(record, ensure_ascii=False))
+                shard.write('\n')
+                written += 1
+            if shard is not None:
+                shard.close()
+            # The compacted shards are in place before the previous ones are deleted, so that a crash in between
+            # only leaves duplicate records, the most recent of which still wins
+            for path in new_files:
+                os.replace(path, path[:-len('.tmp')] + '.jsonl')
+            for path in old_files:
+                os.remove(path)
+            logger.info(f"Compacted table {table}: {len(old_files)} files into {written} records")
+
+    def import_folder(self, json_folder: str):
+        """
+        Append all the experiences found in a folder of JSON files, one per experience
+        named after its id, as written by `ExperienceScraper.save`.
+
+        :param json_folder: folder containing the JSON files
+        """
+        imported = 0
+        for file in os.listdir(json_folder):
+            if not file.endswith('.json') or file.find('(1)') != -1:
+                continue
+            with open(os.path.join(json_folder, file), encoding='utf-8') as open_json:
+                exp_dict = json.load(open_json)
+            self.write_experience(file[:-len('.json')], exp_dict)
+            imported += 1
+        logger.info(f"Imported {imported} experiences from {json_folder}")
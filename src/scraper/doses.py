@@ -0,0 +1,180 @@
+"""
+Normalisation of the dose chart of the experiences. The raw strings extracted from the page are turned into:
+- amount_value, amount_unit: numeric amount in a canonical unit, masses in mg and volumes in ml ("1.5 g" -> 1500, mg)
+- use_minutes: minutes since T+0 ("T+ 1:30" -> 90)
+- route: canonical route of administration ("snorted" -> insufflated)
+
+The same raw strings appear in thousands of rows, so every parser is cached per distinct raw string.
+"""
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from scraper.corpus import CorpusStore
+from scraper.writer import write_experience_file
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Keys added to each dose row
+NORMALIZED_FIELDS: Tuple[str, ...] = ('amount_value', 'amount_unit', 'use_minutes', 'route')
+
+# Commas followed by groups of three digits separate thousands ("1,000 mg"), other commas are decimal marks ("1,5 g")
+_THOUSANDS = r'[1-9]\d{0,2}(?:,\d{3})+(?:\.\d+)?'
+_NUMBER = rf'{_THOUSANDS}|\d+(?:[.,]\d+)?|[.,]\d+'
+# e.g. "100 mg", "1/2 tablet", "3-5 hits", "about 2 g"
+AMOUNT_PATTERN = re.compile(rf'^(?:about|approx\.?|~)?\s*(?P<value>{_NUMBER})(?:\s*/\s*(?P<denominator>\d+))?'
+                            rf'(?:\s*(?:-|to)\s*(?P<max>{_NUMBER}))?\s*(?P<unit>.*)$', re.IGNORECASE)
+# e.g. "T+ 1:30", "T- 0:15"
+TIME_PATTERN = re.compile(r'^T\s*(?P<sign>[+-])\s*(?P<hours>\d+)\s*:\s*(?P<minutes>\d{1,2})', re.IGNORECASE)
+
+# Canonical unit of each unit found in the dose chart, and the factor to convert the amount to it
+UNITS: Dict[str, Tuple[str, float]] = {
+    'mg': ('mg', 1), 'milligram': ('mg', 1),
+    'g': ('mg', 1000), 'gr': ('mg', 1000), 'gram': ('mg', 1000),
+    'kg': ('mg', 1000000),
+    'ug': ('mg', 0.001), 'µg': ('mg', 0.001), 'μg': ('mg', 0.001), 'mcg': ('mg', 0.001), 'microgram': ('mg', 0.001),
+    'ml': ('ml', 1), 'cc': ('ml', 1), 'cl': ('ml', 10), 'dl': ('ml', 100), 'l': ('ml', 1000), 'liter': ('ml', 1000),
+    'litre': ('ml', 1000), 'fl oz': ('ml', 29.5735), 'oz': ('oz', 1), 'lb': ('lb', 1),
+    'tab': ('tablet', 1), 'tablet': ('tablet', 1), 'cap': ('capsule', 1), 'capsule': ('capsule', 1),
+    'pill': ('pill', 1), 'hit': ('hit', 1), 'drop': ('drop', 1), 'bowl': ('bowl', 1), 'joint': ('joint', 1),
+    'cigarette': ('cigarette', 1), 'line': ('line', 1), 'puff': ('puff', 1), 'glass': ('glass', 1),
+    'cup': ('cup', 1), 'shot': ('shot', 1), 'bottle': ('bottle', 1), 'beer': ('beer', 1), 'seed': ('seed', 1),
+    'leaf': ('leaf', 1), 'leaves': ('leaf', 1), 'square': ('square', 1), 'blotter': ('blotter', 1),
+    '%': ('%', 1),
+}
+
+# Canonical route of each method found in the dose chart. Methods not listed are kept lowercased.
+ROUTES: Dict[str, Optional[str]] = {
+    'oral': 'oral', 'swallowed': 'oral', 'eaten': 'oral', 'drank': 'oral', 'drunk': 'oral',
+    'insufflated': 'insufflated', 'snorted': 'insufflated', 'intranasal': 'insufflated', 'nasal': 'insufflated',
+    'smoked': 'smoked', 'vaporized': 'vaporized', 'vaporised': 'vaporized', 'vaped': 'vaporized',
+    'inhaled': 'inhaled', 'iv': 'intravenous', 'intravenous': 'intravenous', 'injected': 'intravenous',
+    'im': 'intramuscular', 'intramuscular': 'intramuscular', 'sub-q': 'subcutaneous', 'subq': 'subcutaneous',
+    'subcutaneous': 'subcutaneous', 'sublingual': 'sublingual', 'buccal': 'buccal', 'rectal': 'rectal',
+    'plugged': 'rectal', 'transdermal': 'transdermal', 'topical': 'topical',
+    '': None, 'not applicable': None, 'unknown': None,
+}
+
+
+def _to_float(number: str) -> float:
+    if re.fullmatch(_THOUSANDS, number):
+        return float(number.replace(',', ''))
+    return float(number.replace(',', '.'))
+
+
+def _canonical_unit(unit: str) -> Tuple[Optional[str], float]:
+    unit = unit.strip().rstrip('.').lower()
+    if not unit:
+        return None, 1
+    if unit in UNITS:
+        return UNITS[unit]
+    # Plurals: "hits", "glasses", "milligrams"
+    for suffix in ('es', 's'):
+        if unit.endswith(suffix) and unit[:-len(suffix)] in UNITS:
+            return UNITS[unit[:-len(suffix)]]
+    return unit, 1
+
+
+@lru_cache(maxsize=None)
+def parse_amount(raw: str) -> Tuple[Optional[float], Optional[str]]:
+    """
+    :param raw: amount as extracted from the dose chart, e.g. "1.5 g"
+    :return: numeric amount in the canonical unit, and the unit. The middle of the range for ranges like "3-5 mg".
+             None and None if no amount can be read
+    """
+    match = AMOUNT_PATTERN.match(raw.strip())
+    if match is None:
+        return None, None
+    value = _to_float(match['value'])
+    if match['denominator']:
+        value /= int(match['denominator']) or 1
+    if match['max']:
+        value = (value + _to_float(match['max'])) / 2
+    unit, factor = _canonical_unit(match['unit'])
+    return round(value * factor, 9), unit
+
+
+@lru_cache(maxsize=None)
+def parse_use_time(raw: str) -> Optional[int]:
+    """
+    :param raw: time of the dose as extracted from the dose chart, e.g. "T+ 1:30"
+    :return: minutes since T+0, negative before it. None if there is no time
+    """
+    match = TIME_PATTERN.match(raw.strip())
+    if match is None:
+        return None
+    minutes = int(match['hours']) * 60 + int(match['minutes'])
+    return -minutes if match['sign'] == '-' else minutes
+
+
+@lru_cache(maxsize=None)
+def parse_route(raw: str) -> Optional[str]:
+    """
+    :param raw: method as extracted from the dose chart, e.g. "snorted"
+    :return: canonical route, None if not applicable or unknown
+    """
+    method = raw.strip().lower()
+    return ROUTES.get(method, method)
+
+
+def normalize_dose(row: dict) -> dict:
+    """
+    :param row: dose row as extracted by `ExperienceScraper`
+    :return: values of `NORMALIZED_FIELDS` for the row
+    """
+    amount_value, amount_unit = parse_amount(row['amount'])
+    return {'amount_value': amount_value,
+            'amount_unit': amount_unit,
+            'use_minutes': parse_use_time(row['use_time']),
+            'route': parse_route(row['method'])}
+
+
+def normalize_dose_rows(rows: List[dict]) -> List[dict]:
+    """
+    Add the normalised fields to each dose row, in place
+    :param rows: dose chart of an experience
+    :return: the same rows
+    """
+    for row in rows:
+        row.update(normalize_dose(row))
+    return rows
+
+
+def normalize_corpus(corpus: CorpusStore) -> int:
+    """
+    Normalise the dose chart of all the experiences in the corpus, appending the updated records to the doses table
+
+    :param corpus: corpus to update
+    :return: number of experiences updated
+    """
+    records = list(corpus.read('doses'))
+    for record in records:
+        normalize_dose_rows(record['substances_details'])
+    corpus.write_records('doses', records)
+    logger.info(f"Normalised doses of {len(records)} experiences in {corpus.folder}")
+    return len(records)
+
+
+def normalize_folder(json_folder: str) -> int:
+    """
+    Normalise the dose chart of all the experiences in a folder of JSON files, rewriting them
+
+    :param json_folder: folder containing the JSON files written by `ExperienceScraper.save`
+    :return: number of experiences updated
+    """
+    updated = 0
+    for file in os.listdir(json_folder):
+        if not file.endswith('.json'):
+            continue
+        path = os.path.join(json_folder, file)
+        with open(path, encoding='utf-8') as open_json:
+            exp_dict = json.load(open_json)
+        normalize_dose_rows(exp_dict['substances_details'])
+        write_experience_file(exp_dict, path)
+        updated += 1
+    logger.info(f"Normalised doses of {updated} experiences in {json_folder}")
+    return updated
@@ -1,49 +1,51 @@
-import json
 import logging
 import os
 import random
 import re
-import sys
-from typing import Optional, List, Dict
+import threading
+from collections import Counter
+from multiprocessing import Pool
+from typing import TYPE_CHECKING, Optional, List, Dict, Iterable, Iterator, Set, Tuple
 from urllib.parse import urlparse
 
 import requests
-import requests_cache
-from bs4 import Tag, Comment, NavigableString
+from bs4 import Tag, Comment, NavigableString, SoupStrainer
+from tqdm import tqdm
 
 from scraper.connection import ProxyServer
-from scraper.scrapers import ElementScraper, ListScraper, from_txt_to_list
-
-requests_cache.install_cache('data/erowid_cache')
+from scraper.corpus import CorpusStore
+from scraper.doses import normalize_dose
+from scraper.scrapers import ElementScraper, ListScraper, NotInCache, from_txt_to_list
+from scraper.sessions import SessionManager, get_session_manager
+from scraper.state import DownloadState
+from scraper.story_index import StoryIndex
+from scraper.urls_scraper import ErowidUrlsScraper
+from scraper.writer import ExperienceWriter, write_experience_file
+
+if TYPE_CHECKING:
+    from scraper.coordinator import Lease, LeaseQueue
 
 # Create logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Create STDERR handler
-handler = logging.StreamHandler(sys.stderr)
-
-# Create formatter and add it to the handler
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
-handler.setFormatter(formatter)
-
-# Set STDERR handler as the only handler
-logger.handlers = [handler]
-
 
 class MissingExperienceFromPage(Exception):
     pass
 
 
-class ThrottledException(Exception):
-    pass
-
-
 class ExperienceScraper(ElementScraper):
-
-    def __init__(self, url: str, proxy_server: Optional[ProxyServer] = None):
-        super().__init__(url, proxy_server)
-        self.exp_id = urlparse(url).query.split('=')[1]
+    # Only the regions read by the extract_* methods are parsed, everything else in the page is skipped
+    parse_only = SoupStrainer(class_=['report-text-surround', 'dosechart', 'footdata', 'title', 'bodyweight-amount'])
+
+    def __init__(self, url: str, proxy_server: Optional[ProxyServer] = None,
+                 session_manager: Optional[SessionManager] = None, corpus: Optional[CorpusStore] = None,
+                 story_index: Optional[StoryIndex] = None, writer: Optional[ExperienceWriter] = None):
+        super().__init__(url, proxy_server, session_manager)
+        self.corpus = corpus
+        self.story_index = story_index
+        self.writer = writer
+        self.exp_id = self.id_from_url(url)
         self.title: str = ''
         self.substances_details: list = []
         self.story: list = []
@@ -51,17 +53,28 @@ class ExperienceScraper(ElementScraper):
         self.metadata: dict = {}
         self.tags: list = []
 
-    def http_call(self, proxy) -> requests.Response:
+    @staticmethod
+    def id_from_url(url: str) -> str:
+        """
+        :param url: url of the experience
+        :return: id of the experience
+        """
+        return urlparse(url).query.split('=')[1]
+
+    @property
+    def element_id(self) -> str:
+        return self.exp_id
+
+    def http_call(self, session: requests.Session) -> requests.Response:
         """
         Make the call to the experiences url
-        :param proxy: proxy server to use for the call
+        :param session: session, bound to a proxy server, to use for the call
         :return: requests response
         """
-        return requests.get(self.url,
-                            proxies=proxy,
-                            headers=self.headers,
-                            timeout=60,
-                            allow_redirects=False)
+        return session.get(self.url,
+                           headers=self.headers,
+                           timeout=60,
+                           allow_redirects=False)
 
     def extract_data(self):
         """
@@ -75,9 +88,8 @@ class ExperienceScraper(ElementScraper):
         """
         Extract experience story
         """
-        try:
-            story_tag = self.soup.find_all(class_='report-text-surround')[0]
-        except Exception:
+        story_tag = self.soup.find(class_='report-text-surround')
+        if story_tag is None:
             raise MissingExperienceFromPage(f"Missing Experience report for ID {self.url}")
 
         save_row = False
@@ -100,30 +112,40 @@ class ExperienceScraper(ElementScraper):
         """
         Extracts substances usage table
         """
-        dosechart_tag = self.soup.find_all(class_="dosechart")
-        drugs_chart = dosechart_tag[0].find_all('tr') if dosechart_tag else []
+        dosechart_tag = self.soup.find(class_="dosechart")
+        drugs_chart = dosechart_tag.find_all('tr') if dosechart_tag else []
         for row in drugs_chart:
-            amount_tag = row.find_all(class_='dosechart-amount')
-            amount = amount_tag[0].text.strip() if amount_tag else ''
-
-            method_tag = row.find_all(class_='dosechart-method')
-            method = method_tag[0].text.strip() if method_tag else ''
-
-            substance_tag = row.find_all(class_='dosechart-substance')[0]
-            substance_ids = substance_tag.find_all('a')
-            substance_id = substance_ids[0].attrs['href'].strip() if substance_ids else ''
+            # Index the cells of the row by class in a single pass, keeping the first match as find_all would
+            cells = {}
+            for cell in row.find_all(class_=True):
+                for cell_class in cell['class']:
+                    cells.setdefault(cell_class, cell)
+
+            amount_tag = cells.get('dosechart-amount')
+            amount = amount_tag.text.strip() if amount_tag else ''
+
+            method_tag = cells.get('dosechart-method')
+            method = method_tag.text.strip() if method_tag else ''
+
+            substance_tag = cells.get('dosechart-substance')
+            if substance_tag is None:
+                raise IndexError(f"Missing substance in dose chart of experience with ID {self.exp_id}")
+            substance_link = substance_tag.find('a')
+            substance_id = substance_link.attrs['href'].strip() if substance_link else ''
             substance_name = substance_tag.text.strip()
 
-            form_tag = row.find_all(class_='dosechart-form')
-            form = form_tag[0].text.strip() if form_tag else ''
+            form_tag = cells.get('dosechart-form')
+            form = form_tag.text.strip() if form_tag else ''
 
             use_time = list(row.children)[1].text.replace("DOSE:", "").strip()  # time to be extracted from text
-            self.substances_details.append({'use_time': use_time,
-                                            'amount': amount,
-                                            'method': method,
-                                            'substance_id': substance_id,
-                                            'substance_name': substance_name,
-                                            'form': form})
+            dose = {'use_time': use_time,
+                    'amount': amount,
+                    'method': method,
+                    'substance_id': substance_id,
+                    'substance_name': substance_name,
+                    'form': form}
+            dose.update(normalize_dose(dose))
+            self.substances_details.append(dose)
 
     @staticmethod
     def split_tags(text: str) -> List[Dict[str, str]]:
@@ -168,10 +190,20 @@ class ExperienceScraper(ElementScraper):
 
     def save(self):
         """
-        Save the experience as a JSON file in the `save_path`
+        Save the experience in the `corpus` if set, otherwise as a JSON file in the `save_path`,
+        and add it to the `story_index` if set.
+        With a `writer`, the experience is only queued, and saved by the writer in the background
         """
-        with open(self.save_path, 'w') as open_json:
-            json.dump(self.to_dict(), open_json, indent=4)
+        exp_dict = self.to_dict()
+        if self.writer is not None:
+            self.writer.put(self.exp_id, exp_dict, self.url, self.save_path)
+            return
+        if self.corpus is not None:
+            self.corpus.write_experience(self.exp_id, exp_dict)
+        else:
+            write_experience_file(exp_dict, self.save_path)
+        if self.story_index is not None:
+            self.story_index.add_experience(self.exp_id, exp_dict)
 
     def to_dict(self):
 
@@ -183,9 +215,162 @@ class ExperienceScraper(ElementScraper):
                 'title': self.title}
 
 
+# Session manager, corpus and story index of each re-extraction worker process, as sqlite connections
+# cannot be shared across processes and each process writes its own corpus shards
+_reextract_session_manager: Optional[SessionManager] = None
+_reextract_corpus: Optional[CorpusStore] = None
+_reextract_story_index: Optional[StoryIndex] = None
+
+
+def _init_reextract_worker(cache_name: str, corpus_folder: Optional[str], story_index_path: Optional[str]):
+    global _reextract_session_manager, _reextract_corpus, _reextract_story_index
+    _reextract_session_manager = SessionManager(cache_name)
+    _reextract_corpus = CorpusStore(corpus_folder) if corpus_folder else None
+    _reextract_story_index = StoryIndex(story_index_path) if story_index_path else None
+
+
+def _reextract_experience(job: Tuple[str, str]) -> Tuple[str, Optional[str]]:
+    """
+    Extract and save a single experience from its cached page
+    :param job: url of the experience and path where to save it
+    :return: url, and name of the exception raised if it failed
+    """
+    url, save_path = job
+    exp_scraper = ExperienceScraper(url, session_manager=_reextract_session_manager, corpus=_reextract_corpus,
+                                    story_index=_reextract_story_index)
+    exp_scraper.save_path = save_path
+    try:
+        exp_scraper.load_from_cache()
+        exp_scraper.extract_data()
+        exp_scraper.save()
+    except Exception as e:
+        logger.warning(f"Re-extraction of {url} failed: {type(e).__name__}: {e}")
+        return url, type(e).__name__
+    return url, None
+
+
 class ErowidScraper(ListScraper):
     save_folder: str = "data/experiences_db"
     base_url: str = "https://www.erowid.org/experiences/exp.php?ID="
+    # Cache read by the re-extraction processes, the one of the shared session manager by default
+    cache_name: Optional[str] = None
+    corpus: Optional[CorpusStore]
+    story_index: Optional[StoryIndex]
+    # Background output stage, writing the experiences to its own corpus and story index while the next ones are
+    # downloaded. Experiences are only marked done in the state once written
+    writer: Optional[ExperienceWriter]
+    # Batch of ids leased from a LeaseQueue, the only experiences downloaded while it is set
+    lease: Optional['Lease'] = None
+
+    def __init__(self, raise_exceptions: bool = False, proxy_server: Optional[ProxyServer] = None,
+                 state: Optional[DownloadState] = None, corpus: Optional[CorpusStore] = None,
+                 story_index: Optional[StoryIndex] = None, writer: Optional[ExperienceWriter] = None):
+        """
+        :param corpus: consolidated storage where to save the experiences, instead of one JSON file each
+        :param story_index: full text index where to add the experiences as they are saved
+        :param writer: writer saving the experiences in the background, instead of the download workers
+        """
+        super().__init__(raise_exceptions, proxy_server, state)
+        self.corpus = corpus
+        self.story_index = story_index
+        self.writer = writer
+
+    def download(self, wait: bool = False, workers_per_server: int = 0):
+        """
+        Download the experiences as `ListScraper.download`, with the `writer` running meanwhile if set
+        """
+        if self.writer is None:
+            super().download(wait, workers_per_server)
+            return
+        self.writer.metrics = self.metrics
+        self.writer.on_written = self.experiences_written
+        self.writer.on_failed = self.record_failure
+        self.writer.start()
+        try:
+            super().download(wait, workers_per_server)
+        finally:
+            self.writer.close()
+            if self.metrics.path:
+                self.metrics.dump()
+        logger.info(f"Writer: {self.writer.written} experiences written, {self.writer.failed} failed")
+
+    def download_leased(self, lease_queue: 'LeaseQueue', wait: bool = False, workers_per_server: int = 0) -> int:
+        """
+        Download batches of ids leased from a queue shared with workers on other hosts, until none is left.
+        Each host uses its own proxy servers and state, and the experiences of all the hosts are merged by saving
+        them to the same `corpus`.
+
+        :param lease_queue: queue of the batches, filled with `LeaseQueue.create`
+        :param wait: Whether calls through the same server should be rate limited
+        :param workers_per_server: if set, download concurrently with this many workers per proxy server
+        :return: number of batches downloaded
+        """
+        from scraper.coordinator import LeaseHeartbeat
+
+        batches = 0
+        while True:
+            lease = lease_queue.acquire()
+            if lease is None:
+                break
+            logger.info(f"Leased batch {lease.first_id}-{lease.last_id}, {lease_queue.counts()}")
+            downloaded, failed = self.urls_downloaded, self.urls_failed
+            if self.state is not None:
+                self.state.add_pending((exp_id, f"{self.base_url}{exp_id}") for exp_id in lease.exp_ids)
+            self.lease = lease
+            try:
+                with LeaseHeartbeat(lease_queue, lease):
+                    self.download(wait, workers_per_server)
+            except BaseException:
+                lease_queue.release(lease)
+                raise
+            finally:
+                self.lease = None
+            if lease_queue.complete(lease, self.urls_downloaded - downloaded, self.urls_failed - failed):
+                batches += 1
+        logger.info(f"No batch left to lease, {batches} downloaded by {lease_queue.worker}")
+        return batches
+
+    def iter_download_list(self) -> Iterator[Tuple[str, str]]:
+        """
+        Stream the experiences to download, only the ones of the `lease` not saved yet if set
+        :return: iterator of tuples of id and url
+        """
+        if self.lease is None:
+            return super().iter_download_list()
+        return ((exp_id, f"{self.base_url}{exp_id}") for exp_id in self._leased_ids())
+
+    def count_download_list(self) -> int:
+        if self.lease is None:
+            return super().count_download_list()
+        return len(self._leased_ids())
+
+    def _leased_ids(self) -> List[str]:
+        if self.state is not None:
+            return [exp_id for exp_id in self.lease.exp_ids if not self.state.is_done(exp_id)]
+        saved_ids = set(self.downloaded_ids())
+        return [exp_id for exp_id in self.lease.exp_ids if exp_id not in saved_ids]
+
+    def element_saved(self, scraper: ExperienceScraper):
+        # Queued experiences are marked done and counted by `experiences_written`, once actually written
+        if self.writer is None:
+            super().element_saved(scraper)
+
+    def experiences_written(self, exp_ids: List[str]):
+        """
+        Mark the experiences written by the `writer` done in the state, and count them as downloaded
+        :param exp_ids: ids of the experiences
+        """
+        if self.state is not None:
+            self.state.mark_all_done(exp_ids)
+        self.count_downloaded(len(exp_ids))
+
+    def collect_metrics(self):
+        """
+        Update the gauges of `metrics` with the state of the throttles, and the back-pressure of the writer
+        """
+        super().collect_metrics()
+        if self.writer is not None:
+            self.metrics.set_gauge('writer_saturation', self.writer.saturation)
 
     def update_from_folder(self, folder_path: str):
         """
@@ -209,6 +394,10 @@ class ErowidScraper(ListScraper):
 
         URLs that are already downloaded (there is a JSON file in the destination with
         the name of the expected downloaded file) are not added to the list.
+        When a `state` is used, candidates are only added to it in bulk, and the ones that are not
+        done yet are streamed from it when downloading, without looking at the destination folder.
+        The ids are shuffled with the same `seed` on every run: to share them between several hosts, download
+        batches leased from a LeaseQueue with `download_leased` instead.
 
         :param file: txt file with one URL per line
         """
@@ -221,23 +410,139 @@ class ErowidScraper(ListScraper):
             urls = []
             for exp_id in experiences_possible_ids:
                 urls.append(f"{self.base_url}{exp_id}")
+        self.add_urls(urls)
+
+    def add_urls(self, urls: List[str], saved_ids: Optional[Set[str]] = None) -> int:
+        """
+        Add experiences to download, skipping the ones already known.
+        With a `state`, they are picked up by a download already running.
+
+        :param urls: urls of the experiences
+        :param saved_ids: ids of the experiences already saved, looked up if not given and there is no state
+        :return: number of experiences added
+        """
+        if self.state is not None:
+            return self.state.add_pending((ExperienceScraper.id_from_url(url), url) for url in urls)
+        if saved_ids is None:
+            saved_ids = set(self.downloaded_ids())
+        added = 0
         for url in urls:
-            exp_scraper = ExperienceScraper(url, proxy_server=self.proxy_server)
-            candidate_path = os.path.join(self.save_folder, f"{exp_scraper.exp_id}.json")
-            if os.path.isfile(candidate_path):
-                logger.debug(f"Experience {exp_scraper.exp_id} already downloaded")
+            exp_id = ExperienceScraper.id_from_url(url)
+            if exp_id in saved_ids or exp_id in self.urls_to_download:
+                logger.debug(f"Experience {exp_id} already downloaded")
             else:
-                exp_scraper.save_path = candidate_path
-                self.urls_to_download[exp_scraper.exp_id] = exp_scraper
+                self.urls_to_download[exp_id] = url
+                added += 1
+        return added
 
+    def create_scraper(self, element_id: str, url: str) -> ExperienceScraper:
+        """
+        Create the scraper of an experience, right before downloading it
+        :param element_id: id of the experience
+        :param url: url of the experience
+        :return: scraper saving the experience in `save_folder`
+        """
+        exp_scraper = ExperienceScraper(url, proxy_server=self.proxy_server, corpus=self.corpus,
+                                        story_index=self.story_index, writer=self.writer)
+        exp_scraper.save_path = os.path.join(self.save_folder, f"{element_id}.json")
+        return exp_scraper
 
-def main():
-    proxy = ProxyServer("credentials.json")
-    erowid_scraper = ErowidScraper(raise_exceptions=False, proxy_server=proxy)
-    # erowid_scraper.update_download_list('data/exp_links/failed_urls_IndexError.txt')
-    erowid_scraper.update_from_folder('data/exp_links')
-    erowid_scraper.download(wait=True)
-
+    def downloaded_ids(self) -> List[str]:
+        """
+        :return: ids of all the experiences saved in `corpus`, or in `save_folder` if there is no corpus
+        """
+        if self.corpus is not None:
+            return self.corpus.exp_ids()
+        return [file[:-len('.json')] for file in os.listdir(self.save_folder) if file.endswith('.json')]
 
-if __name__ == '__main__':
-    main()
+    def reextract(self, exp_ids: Optional[Iterable[str]] = None, processes: Optional[int] = None) -> Dict[str, int]:
+        """
+        Extract and save again experiences straight from the pages stored in the cache, without
+        making any http call. Work is spread over a pool of processes, one per core by default.
+        Failures are collected per exception type, like `download` does, and experiences whose extraction failed
+        before are marked done once extracted.
+
+        :param exp_ids: ids of the experiences to extract. By default, all the ones downloaded or failed in the
+                        `state`, so that the pages whose extraction failed are extracted again too, or all the ones
+                        already saved without state
+        :param processes: number of worker processes
+        :return: number of failures for each exception type
+        """
+        if exp_ids is None:
+            exp_ids = self.state.attempted_ids() if self.state is not None else self.downloaded_ids()
+        exp_ids = list(exp_ids)
+        jobs = [(f"{self.base_url}{exp_id}", os.path.join(self.save_folder, f"{exp_id}.json")) for exp_id in exp_ids]
+        logger.info(f"A total of {len(jobs)} experiences will be extracted again from the cache")
+
+        failures: Counter = Counter()
+        corpus_folder = self.corpus.folder if self.corpus is not None else None
+        story_index_path = self.story_index.db_path if self.story_index is not None else None
+        with Pool(processes, initializer=_init_reextract_worker,
+                  initargs=(self.cache_name or get_session_manager().cache_name, corpus_folder,
+                            story_index_path)) as pool:
+            results = pool.imap_unordered(_reextract_experience, jobs, chunksize=64)
+            for url, error_name in tqdm(results, total=len(jobs)):
+                exp_id = ExperienceScraper.id_from_url(url)
+                if error_name is None:
+                    self.urls_downloaded += 1
+                    if self.state is not None:
+                        self.state.mark_done(exp_id)
+                else:
+                    failures[error_name] += 1
+                    # Pages never cached, e.g. after a network error, keep the failure of their download
+                    if error_name != NotInCache.__name__:
+                        self.record_failure(exp_id, url, error_name)
+        logger.info(f"Re-extraction completed: {self.urls_downloaded} experiences saved, failures: {dict(failures)}")
+        return dict(failures)
+
+
+def open_state(state_path: str = 'data/download_state.sqlite', save_folder: str = ErowidScraper.save_folder,
+               links_folder: str = 'data/exp_links') -> DownloadState:
+    """
+    Open the download state of the experiences. The first time, it is filled with
+    the experiences already saved and the failed urls recorded in txt files.
+    :param state_path: path of the state sqlite file
+    :param save_folder: folder of the experiences already saved
+    :param links_folder: folder of the failed_urls_<Exception>.txt files
+    :return: download state
+    """
+    state = DownloadState(state_path)
+    if not len(state):
+        if os.path.isdir(save_folder):
+            state.import_folder(save_folder, ErowidScraper.base_url)
+        if os.path.isdir(links_folder):
+            state.import_failures(links_folder, ExperienceScraper.id_from_url)
+    return state
+
+
+def discover_and_download(erowid_scraper: ErowidScraper, urls_scraper: ErowidUrlsScraper, incremental: bool = False,
+                          workers_per_server: int = 1):
+    """
+    Discover the experiences from the pages of search results in a background thread, while downloading them.
+    Experiences are downloaded as soon as the page listing them is, instead of after the whole discovery.
+    Both scrapers share the throttles of the proxy servers, so that calls through the same ip stay rate limited.
+
+    :param erowid_scraper: scraper of the experiences, with a `state` to stream the experiences discovered from
+    :param urls_scraper: scraper of the pages of search results
+    :param incremental: only discover the experiences published since the last run
+    :param workers_per_server: number of concurrent workers using the same proxy server, for each scraper
+    """
+    assert erowid_scraper.state is not None, "A state is needed to download experiences while discovering them"
+    feed_done = threading.Event()
+    erowid_scraper.feed_done = feed_done
+    urls_scraper.on_urls = erowid_scraper.add_urls
+    urls_scraper.throttles = erowid_scraper.throttles
+
+    def discover():
+        try:
+            urls_scraper.discover(workers_per_server, wait=True, incremental=incremental)
+        finally:
+            feed_done.set()
+
+    discovery = threading.Thread(target=discover, name='discovery', daemon=True)
+    discovery.start()
+    try:
+        erowid_scraper.download(wait=True, workers_per_server=workers_per_server)
+    finally:
+        discovery.join()
+        erowid_scraper.feed_done = None
@@ -0,0 +1,240 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Held while an element is profiled: only one profiler can be enabled at a time in the process (enabling a second
+# one raises ValueError from Python 3.12), so the elements sampled meanwhile by the other workers are not profiled
+_profile_lock = threading.Lock()
+
+
+def _quantile(values: list, q: float) -> float:
+    """
+    :param values: sorted values
+    :param q: quantile, between 0 and 1
+    :return: value at the quantile, by nearest rank, NaN if there are no values
+    """
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for name, value in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+
+class ScrapeMetrics:
+    # Timings of the stages of every download (http call, extraction, save...), counters of events (cache hits,
+    # proxy switches, blocks...) and gauges (state of the throttles), shared by all the download workers.
+    # They are written to `path` every `interval` seconds while downloading, as a Prometheus textfile if the path
+    # ends with .prom, as JSON otherwise, so that a running scrape can be inspected without stopping it.
+    path: str
+    interval: float
+    profile_rate: float
+    profile_folder: str
+    # Number of durations kept by stage for the quantiles, the most recent ones
+    window: int
+    prefix: str = 'erowid_scraper'
+
+    def __init__(self, path: str = '', interval: float = 60, profile_rate: float = 0,
+                 profile_folder: str = 'data/profiles', window: int = 1000):
+        """
+        :param path: file where to write the metrics, not written if empty
+        :param interval: seconds between two writes
+        :param profile_rate: share of the elements downloaded under cProfile, picked at random
+        :param profile_folder: folder of the profiles, one .prof file per element, to open with pstats or snakeviz
+        :param window: number of durations kept by stage for the quantiles
+        """
+        self.path = path
+        self.interval = interval
+        self.profile_rate = profile_rate
+        self.profile_folder = profile_folder
+        self.window = window
+        self.started = time.time()
+        self.counts: Counter = Counter()
+        self.totals: Dict[str, float] = {}
+        self.durations: Dict[str, Deque[float]] = {}
+        self.counters: Counter = Counter()
+        self.gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._collect: Optional[Callable[[], None]] = None
+
+    def record(self, stage: str, seconds: float):
+        """
+        :param stage: name of the stage, e.g. get
+        :param seconds: duration of the stage for one element
+        """
+        with self._lock:
+            self.counts[stage] += 1
+            self.totals[stage] = self.totals.get(stage, 0) + seconds
+            if stage not in self.durations:
+                self.durations[stage] = deque(maxlen=self.window)
+            self.durations[stage].append(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """
+        Record the duration of the block as a stage, even if it raises
+        :param stage: name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def increment(self, event: str, count: int = 1):
+        """
+        :param event: name of the counter, e.g. cache_hits
+        :param count: number of events
+        """
+        if count:
+            with self._lock:
+                self.counters[event] += count
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        """
+        :param name: name of the gauge, e.g. server_delay_seconds
+        :param value: current value
+        :param labels: labels of the value, e.g. server
+        """
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def profiled(self, element_id: str) -> Iterator[None]:
+        """
+        Run the block under cProfile for a share `profile_rate` of the elements, and save the profile.
+        An element sampled while another one is profiled runs without it, and is counted in `profiles_skipped`
+        :param element_id: id of the element, used as name of the profile
+        """
+        if not self.profile_rate or random.random() >= self.profile_rate:
+            yield
+            return
+        if not _profile_lock.acquire(blocking=False):
+            self.increment('profiles_skipped')
+            yield
+            return
+        profile: Optional[cProfile.Profile] = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is enabled outside of the scraper, e.g. `python -m cProfile`
+            profile = None
+            self.increment('profiles_skipped')
+        try:
+            yield
+        finally:
+            try:
+                if profile is not None:
+                    profile.disable()
+                    os.makedirs(self.profile_folder, exist_ok=True)
+                    file_name = re.sub(r'[^\w.-]', '_', element_id)
+                    profile.dump_stats(os.path.join(self.profile_folder, f"{file_name}.prof"))
+                    self.increment('profiles')
+            finally:
+                _profile_lock.release()
+
+    def snapshot(self) -> dict:
+        """
+        :return: stages with their count, total and quantiles of the recent durations, counters and gauges
+        """
+        with self._lock:
+            stages = {}
+            for stage, count in self.counts.items():
+                durations = sorted(self.durations[stage])
+                stages[stage] = {'count': count,
+                                 'total_seconds': self.totals[stage],
+                                 'mean_ms': self.totals[stage] / count * 1000,
+                                 'p50_ms': _quantile(durations, 0.5) * 1000,
+                                 'p99_ms': _quantile(durations, 0.99) * 1000,
+                                 'max_ms': durations[-1] * 1000}
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in sorted(self.gauges.items())]
+            return {'time': time.time(), 'uptime_seconds': time.time() - self.started, 'stages': stages,
+                    'counters': dict(self.counters), 'gauges': gauges}
+
+    def to_prometheus(self) -> str:
+        """
+        :return: metrics in the Prometheus text format, e.g. for the textfile collector of node_exporter
+        """
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {self.prefix}_uptime_seconds gauge",
+                 f"{self.prefix}_uptime_seconds {snapshot['uptime_seconds']:.3f}",
+                 f"# TYPE {self.prefix}_stage_seconds summary"]
+        for stage, stats in snapshot['stages'].items():
+            for quantile in ('p50', 'p99'):
+                labels = _labels({'stage': stage, 'quantile': f"0.{quantile[1:]}"})
+                lines.append(f"{self.prefix}_stage_seconds{labels} {stats[quantile + '_ms'] / 1000:.6f}")
+            lines.append(f"{self.prefix}_stage_seconds_sum{_labels({'stage': stage})} {stats['total_seconds']:.6f}")
+            lines.append(f"{self.prefix}_stage_seconds_count{_labels({'stage': stage})} {stats['count']}")
+        lines.append(f"# TYPE {self.prefix}_events_total counter")
+        for event, count in sorted(snapshot['counters'].items()):
+            lines.append(f"{self.prefix}_events_total{_labels({'event': event})} {count}")
+        typed = set()
+        for gauge in snapshot['gauges']:
+            name = f"{self.prefix}_{gauge['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{_labels(gauge['labels'])} {gauge['value']}")
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: Optional[str] = None):
+        """
+        Write the metrics, replacing the previous ones at once so that readers never see a partial file
+        :param path: file where to write them, `path` by default
+        """
+        path = path or self.path
+        if self._collect is not None:
+            self._collect()
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.snapshot(), indent=4)
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as open_file:
+            open_file.write(content)
+        os.replace(temp_path, path)
+
+    def _dump_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.dump()
+            except OSError as e:
+                logger.warning(f"Unable to write the metrics to {self.path}: {e}")
+
+    def start(self, collect: Optional[Callable[[], None]] = None):
+        """
+        Write the metrics to `path` every `interval` seconds in a background thread, if `path` is set
+        :param collect: called before every write, e.g. to update the gauges
+        """
+        self._collect = collect
+        if self.path and (self._thread is None or not self._thread.is_alive()):
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._dump_loop, name='metrics-dump', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background writes, and write the final metrics
+        """
+        self._stop.set()
+        if self.path:
+            self.dump()
@@ -1,30 +1,37 @@
 import logging
-import sys
-import random
-from time import sleep
-from typing import List, Optional, Dict
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter
+from typing import List, Optional, Dict, Iterator, Tuple, TYPE_CHECKING, Deque
 
 import requests
 import socks
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from tqdm import tqdm
 
+if TYPE_CHECKING:
+    from scraper.state import DownloadState
+
 # Create logger
-from scraper.connection import ProxyServer
+from scraper.connection import ProxyServer, AdaptiveThrottle
+from scraper.metrics import ScrapeMetrics
+from scraper.sessions import SessionManager, get_session_manager
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Create STDERR handler
-handler = logging.StreamHandler(sys.stderr)
-# ch.setLevel(logging.DEBUG)
 
-# Create formatter and add it to the handler
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
-handler.setFormatter(formatter)
+class NotInCache(Exception):
+    pass
+
+
+class ThrottledException(Exception):
+    pass
 
-# Set STDERR handler as the only handler
-logger.handlers = [handler]
+
+# Errors caused by the server or the proxy, rather than by the content of the page
+NETWORK_ERRORS = (requests.exceptions.RequestException, socks.ProxyError)
 
 
 def from_txt_to_list(txt_path: str) -> List[str]:
@@ -43,15 +50,46 @@ def from_txt_to_list(txt_path: str) -> List[str]:
 
 class ElementScraper:
     url: str
-    soup: BeautifulSoup
+    params: Optional[dict] = None
+    soup: Optional[BeautifulSoup] = None
     save_path: str = ''
     proxy_server: Optional[ProxyServer] = None
+    session_manager: SessionManager
+    # When set, only the regions of the page matching the strainer are parsed
+    parse_only: Optional[SoupStrainer] = None
     was_cached: bool = False
+    # Exception raised by the last attempt to download the element, if it failed
+    error: Optional[Exception] = None
+    # Calls made again through another proxy server, and block pages received, by the last `get`
+    proxy_switches: int = 0
+    blocks: int = 0
+    # Seconds taken by the last `parse`
+    parse_seconds: float = 0
+    # Set when the element is queued again if it is blocked, its failure is then only recorded after the last retry
+    retry_on_block: bool = False
+    # Text found in the pages returned instead of the content when the ip address is blocked
+    blocked_markers: Tuple[str, ...] = ("IP address has been blocked",)
     headers: dict = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:87.0) Gecko/20100101 Firefox/87.0"}
 
-    def __init__(self, url: str, proxy_server: Optional[ProxyServer] = None):
+    def __init__(self, url: str, proxy_server: Optional[ProxyServer] = None,
+                 session_manager: Optional[SessionManager] = None):
         self.url = url
         self.proxy_server = proxy_server
+        self.session_manager = session_manager or get_session_manager()
+
+    @property
+    def element_id(self) -> str:
+        """
+        Identifier of the element in the list it belongs to
+        """
+        return self.url
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Pooled session of the proxy server currently in use
+        """
+        return self.session_manager.get_session(self.proxy_server)
 
     def update_proxy_get_response(self) -> requests.Response:
         """
@@ -59,28 +97,77 @@ class ElementScraper:
         :return: response to url get http request
         """
         self.proxy_server.update_server_used()
-        requests.Session().cache.delete_url(self.url)
-        return self.http_call(self.proxy_server.get_proxy())
+        self.proxy_switches += 1
+        self.session_manager.delete(self.url, self.params)
+        return self.http_call(self.session)
+
+    def is_blocked(self, res: requests.Response) -> bool:
+        """
+        :param res: response to the http call
+        :return: True if the server refused to serve the page because of too many calls
+        """
+        if res.status_code in (403, 429):
+            return True
+        return any(res.text.find(marker) != -1 for marker in self.blocked_markers)
 
     def get(self):
         """
         Retrieve the experience HTML code and input it
-        for further processing
+        for further processing.
+        When the server blocks the ip address, the call is made again once through the next proxy server,
+        and ThrottledException is raised if it is blocked as well.
         """
-        proxy = self.proxy_server.get_proxy() if self.proxy_server else None
+        self.proxy_switches = self.blocks = 0
         try:
-            res = self.http_call(proxy)
-            res.raise_for_status()
+            res = self.http_call(self.session)
         except (requests.exceptions.ConnectionError, socks.SOCKS5AuthError):
             logger.error("ConnectionError or SOCKS5AuthError")
             res = self.update_proxy_get_response()
-        if res.text.find("IP address has been blocked") != -1 and proxy is not None:
-            logger.error(f"Server blocked the ip address: {res.raw._connection.sock.getsockname()}, on proxy {proxy}")
-            self.update_proxy_get_response()
+        blocked = self.is_blocked(res)
+        if blocked:
+            self.blocks += 1
+            server = self.proxy_server.server_in_use if self.proxy_server else None
+            logger.error(f"Server blocked the ip address, on proxy server {server}")
+            if self.proxy_server is not None and len(self.proxy_server.servers) > 1:
+                res = self.update_proxy_get_response()
+                blocked = self.is_blocked(res)
+                self.blocks += int(blocked)
+            if blocked:
+                # Never keep the block page in the cache
+                self.session_manager.delete(self.url, self.params)
+                raise ThrottledException(f"Blocked when downloading {self.url}, on proxy server {server}")
+        res.raise_for_status()
         self.was_cached = res.from_cache
-        self.soup = BeautifulSoup(res.content, 'html.parser')
+        self.parse(res.content)
+
+    def parse(self, content: bytes):
+        """
+        Build the parse tree of the page, restricted to `parse_only` if set
+        :param content: HTML code of the page
+        """
+        start = perf_counter()
+        self.soup = BeautifulSoup(content, 'html.parser', parse_only=self.parse_only)
+        self.parse_seconds = perf_counter() - start
+
+    def is_cached(self) -> bool:
+        """
+        Check whether the response to url is already stored in the cache
+        :return: True if no http call will be made by `get`
+        """
+        return self.session_manager.is_cached(self.url, self.params)
 
-    def http_call(self, proxy) -> requests.Response:
+    def load_from_cache(self):
+        """
+        Input the HTML code stored in the cache for further processing, without making any http call
+        """
+        key = self.session_manager.cache_key(self.url, self.params)
+        res = self.session_manager.cache.get_response(key)
+        if res is None:
+            raise NotInCache(f"No cached response for {self.url}")
+        self.was_cached = True
+        self.parse(res.content)
+
+    def http_call(self, session: requests.Session) -> requests.Response:
         raise NotImplementedError("method http_call must be implemented")
 
     def extract_data(self):
@@ -89,51 +176,314 @@ class ElementScraper:
     def save(self):
         raise NotImplementedError("method save must be implemented")
 
+    def release(self):
+        """
+        Drop the parse tree, once the data has been extracted and saved
+        """
+        self.soup = None
+
 
 class ListScraper:
     raise_exceptions: bool
     seed: int = 666
     save_folder: str = ""
-    urls_to_download: Dict[str, ElementScraper] = {}
+    # Ids of the elements to download, with their url. Scrapers are only created when downloading.
+    urls_to_download: Dict[str, str]
     base_url: str = ""
+    # Seconds between calls through the same server at the start, plus a random jitter up to max_wait
     min_wait: int = 20
     max_wait: int = 23
+    # Bounds of the delay, adapted to the health of each server, and first quarantine of blocked servers
+    min_delay: float = 5
+    max_delay: float = 600
+    quarantine: float = 1800
+    # Times a blocked element is queued again, when downloading concurrently
+    max_block_retries: int = 3
     proxy_server: Optional[Dict[str, str]]
+    state: Optional['DownloadState']
+    # Set once all the elements to download are in `state`. While it is not set, the download waits for the elements
+    # added to `state` by another thread, e.g. experiences discovered while downloading the ones already known
+    feed_done: Optional[threading.Event] = None
+    # Seconds between two checks for new elements in `state`, while `feed_done` is not set
+    poll_interval: float = 1
+    # Timings and counters of the downloads, written periodically if its `path` is set
+    metrics: ScrapeMetrics
 
-    def __init__(self, raise_exceptions: bool = False, proxy_server: Optional[ProxyServer] = None):
+    def __init__(self, raise_exceptions: bool = False, proxy_server: Optional[ProxyServer] = None,
+                 state: Optional['DownloadState'] = None):
+        """
+        :param raise_exceptions: stop at the first failure instead of recording it
+        :param proxy_server: proxy to use for the http calls
+        :param state: store keeping track of downloads and failures. Without it, failures are appended to txt files
+        """
         self.raise_exceptions = raise_exceptions
         self.proxy_server = proxy_server
+        self.state = state
+        self.urls_to_download = {}
+        self.urls_downloaded = 0
+        self.urls_failed = 0
+        self.throttles: Dict[Optional[str], AdaptiveThrottle] = {}
+        self.metrics = ScrapeMetrics()
+        self._lock = threading.Lock()
 
-    def download(self, wait: bool = False):
+    def throttle(self, server: Optional[str]) -> AdaptiveThrottle:
+        """
+        :param server: proxy server, None when calls are made without proxy
+        :return: scheduler of the calls made through the server, created the first time
+        """
+        with self._lock:
+            if server not in self.throttles:
+                # setdefault, as the throttles can be shared with another scraper using the same servers
+                self.throttles.setdefault(server, AdaptiveThrottle(initial_delay=self.min_wait,
+                                                                   min_delay=min(self.min_delay, self.min_wait),
+                                                                   max_delay=max(self.max_delay, self.min_wait),
+                                                                   jitter=self.max_wait - self.min_wait,
+                                                                   cooldown=self.quarantine))
+            return self.throttles[server]
+
+    def download(self, wait: bool = False, workers_per_server: int = 0):
         """
         Download all the urls contained in urls_to_be_downloaded
-        Wait for a random interval between a range, if needed.
+        Wait between downloads through the same server, if needed, adapting the delay to its health.
         Never wait when the url to download was already cached.
 
-        :param wait: Whether it should wait a random number of seconds (in a range) between downloads
+        :param wait: Whether calls through the same server should be rate limited
+        :param workers_per_server: if set, download concurrently with this many workers per proxy server
         """
-        urls_downloaded = 0
-        urls_failed = 0
-        logger.info(f"A total of {len(self.urls_to_download)} links will be attempted to download")
-        for i, scraper in tqdm(enumerate(self.urls_to_download.values())):
+        if workers_per_server:
+            self.download_concurrent(workers_per_server, wait=wait)
+            return
+        logger.info(f"A total of {self.count_download_list()} links will be attempted to download")
+        self.metrics.start(self.collect_metrics)
+        try:
+            for job in tqdm(self.iter_download_list(), total=self.count_download_list()):
+                if job is None:
+                    self.feed_done.wait(self.poll_interval)
+                    continue
+                scraper = self.create_scraper(*job)
+                server = self.proxy_server.server_in_use if self.proxy_server else None
+                self.throttled_download(scraper, self.throttle(server) if wait else None)
+        finally:
+            self.metrics.stop()
+        self.log_throttles()
+
+    def download_concurrent(self, workers_per_server: int = 1, wait: bool = True):
+        """
+        Download all the urls contained in urls_to_be_downloaded, with several fetches in flight.
+        Workers are spread across the servers in `proxy_server`, and each server has its own
+        adaptive throttle, so that the politeness delay is kept per IP, and throughput grows with the number of
+        servers. Blocked servers are quarantined, and their elements queued again for the other servers.
+        Cached responses skip the throttle completely.
+
+        :param workers_per_server: number of concurrent workers using the same server
+        :param wait: Whether calls through the same server should be rate limited
+        """
+        servers = self.proxy_server.servers if self.proxy_server else [None]
+        total = self.count_download_list()
+        logger.info(f"A total of {total} links will be attempted to download, "
+                    f"with {workers_per_server} workers on each of {len(servers)} servers")
+
+        # Workers pull from the same lazy stream, so that only the elements in flight are in memory.
+        # Blocked elements are pulled again before the stream.
+        jobs = self.iter_download_list()
+        retries: Deque[Tuple[str, str]] = deque()
+        block_retries: Counter = Counter()
+        jobs_lock = threading.Lock()
+        stop = threading.Event()
+        self.metrics.start(self.collect_metrics)
+        try:
+            with tqdm(total=total) as progress, \
+                    ThreadPoolExecutor(max_workers=len(servers) * workers_per_server) as executor:
+                futures = []
+                for server in servers:
+                    throttle = self.throttle(server) if wait else None
+                    for _ in range(workers_per_server):
+                        futures.append(executor.submit(self._download_worker, jobs, retries, block_retries,
+                                                       jobs_lock, server, throttle, progress, stop))
+                for future in futures:
+                    future.result()
+        finally:
+            self.metrics.stop()
+        self.log_throttles()
+
+    def _download_worker(self, jobs: Iterator[Tuple[str, str]], retries: Deque[Tuple[str, str]],
+                         block_retries: Counter, jobs_lock: threading.Lock, server: Optional[str],
+                         throttle: Optional[AdaptiveThrottle], progress: tqdm, stop: threading.Event):
+        """
+        Consume elements from `retries` and `jobs` until both are exhausted, making all calls through `server`.
+        While `server` is dead, calls go through the best server of the proxy instead.
+        """
+        while not stop.is_set():
+            try:
+                with jobs_lock:
+                    job = retries.popleft() if retries else next(jobs)
+            except StopIteration:
+                return
+            if job is None:
+                # No element to download until more are added, wait outside the lock so that the other workers can
+                # still pick up the blocked elements queued again
+                self.feed_done.wait(self.poll_interval)
+                continue
+            scraper = self.create_scraper(*job)
+            with jobs_lock:
+                scraper.retry_on_block = block_retries[job] < self.max_block_retries
+            current_server = server
+            if self.proxy_server is not None:
+                if not self.proxy_server.is_alive(server):
+                    current_server = self.proxy_server.best_server()
+                scraper.proxy_server = self.proxy_server.pin(current_server)
+            else:
+                scraper.proxy_server = None
+            job_throttle = self.throttle(current_server) if throttle is not None else None
             try:
-                logger.info(f"Downloading {scraper.url}...")
-                scraper.get()
-                scraper.extract_data()
-                scraper.save()
-                urls_downloaded += 1
-                logger.info(f"success. So far {urls_downloaded} pages downloaded correctly.")
-            except Exception as e:
-                if self.raise_exceptions:
-                    raise
-                logger.exception('failed:')
-                with open(f'data/exp_links/failed_urls_{type(e).__name__}.txt', mode='a+') as open_txt:
-                    open_txt.write(scraper.url)
+                self.throttled_download(scraper, job_throttle)
+            except Exception:
+                stop.set()
+                raise
+            if isinstance(scraper.error, ThrottledException) and scraper.retry_on_block:
+                with jobs_lock:
+                    block_retries[job] += 1
+                    retries.append(job)
+                self.metrics.increment('block_retries')
+                continue
+            progress.update()
+
+    def throttled_download(self, scraper: ElementScraper, throttle: Optional[AdaptiveThrottle]) -> bool:
+        """
+        Download a single element once `throttle` allows it, and record the outcome of the call in it
+
+        :param scraper: element to download
+        :param throttle: scheduler of the server used, None to download without waiting
+        :return: whether the element was downloaded correctly
+        """
+        if throttle is None or scraper.is_cached():
+            return self.download_element(scraper)
+        with self.metrics.timer('wait'):
+            throttle.wait()
+        start = monotonic()
+        downloaded = self.download_element(scraper)
+        if isinstance(scraper.error, ThrottledException):
+            throttle.record_block()
+        elif isinstance(scraper.error, NETWORK_ERRORS):
+            throttle.record_error()
+        else:
+            throttle.record_success(monotonic() - start)
+        return downloaded
+
+    def collect_metrics(self):
+        """
+        Update the gauges of `metrics` with the state of the throttle of every server
+        """
+        for server, throttle in list(self.throttles.items()):
+            for name, value in throttle.stats().items():
+                self.metrics.set_gauge(f"server_{name}", value, server=str(server))
+
+    def log_throttles(self):
+        for server, throttle in self.throttles.items():
+            stats = ', '.join(f"{name} {value:.2f}" for name, value in throttle.stats().items())
+            logger.info(f"Server {server}: {stats}")
+
+    def download_element(self, scraper: ElementScraper) -> bool:
+        """
+        Get, extract and save a single element. Failures are logged and the url
+        appended to the txt file of its exception type, unless `raise_exceptions` is set.
+
+        :param scraper: element to download
+        :return: whether the element was downloaded correctly
+        """
+        scraper.error = None
+        metrics = self.metrics
+        try:
+            logger.info(f"Downloading {scraper.url}...")
+            with metrics.profiled(scraper.element_id):
+                try:
+                    start = perf_counter()
+                    scraper.get()
+                finally:
+                    # The parse tree is built by `get`, time it as a stage of its own
+                    metrics.record('fetch', perf_counter() - start - scraper.parse_seconds)
+                    if scraper.soup is not None:
+                        metrics.record('parse', scraper.parse_seconds)
+                    metrics.increment('cache_hits' if scraper.was_cached else 'cache_misses')
+                    metrics.increment('proxy_switches', scraper.proxy_switches)
+                    metrics.increment('blocks', scraper.blocks)
+                with metrics.timer('extract'):
+                    scraper.extract_data()
+                with metrics.timer('save'):
+                    scraper.save()
+            scraper.release()
+            self.element_saved(scraper)
+            return True
+        except Exception as e:
+            scraper.release()
+            scraper.error = e
+            if self.raise_exceptions:
+                raise
+            if isinstance(e, ThrottledException) and scraper.retry_on_block:
+                logger.warning(f"{e}, queued again")
+                return False
+            logger.exception('failed:')
+            metrics.increment(f"failed_{type(e).__name__}")
+            self.record_failure(scraper.element_id, scraper.url, type(e).__name__)
+            return False
+
+    def element_saved(self, scraper: ElementScraper):
+        """
+        Record in `state` that the element has been saved, and count it as downloaded
+        :param scraper: scraper of the element
+        """
+        if self.state is not None:
+            self.state.mark_done(scraper.element_id)
+        self.count_downloaded()
+
+    def count_downloaded(self, count: int = 1):
+        """
+        :param count: number of elements saved
+        """
+        self.metrics.increment('downloaded', count)
+        with self._lock:
+            self.urls_downloaded += count
+            logger.info(f"success. So far {self.urls_downloaded} pages downloaded correctly.")
+
+    def record_failure(self, element_id: str, url: str, error_name: str):
+        """
+        Record the failure in `state`, or append the url to the txt file collecting
+        the failures of the same exception type if there is no state
+
+        :param element_id: id of the element that failed
+        :param url: url that failed
+        :param error_name: name of the exception type raised
+        """
+        if self.state is not None:
+            self.state.mark_failed(element_id, error_name, url)
+        with self._lock:
+            if self.state is None:
+                with open(f'data/exp_links/failed_urls_{error_name}.txt', mode='a+') as open_txt:
+                    open_txt.write(url)
                     open_txt.write('\n')
-                urls_failed += 1
-                logger.error(f"So far {urls_failed} errors.")
-            if wait and not scraper.was_cached:
-                sleep(random.randint(self.min_wait, self.max_wait))
+            self.urls_failed += 1
+            logger.error(f"So far {self.urls_failed} errors.")
+
+    def iter_download_list(self) -> Iterator[Optional[Tuple[str, str]]]:
+        """
+        Stream the elements to download: the ones left in `state` if used, otherwise `urls_to_download`
+        :return: iterator of tuples of element id and url, and None while waiting for the elements added to `state`
+                 until `feed_done` is set
+        """
+        if self.state is not None:
+            return self.state.remaining(until=self.feed_done)
+        return iter(list(self.urls_to_download.items()))
+
+    def count_download_list(self) -> int:
+        """
+        :return: number of elements that `iter_download_list` will return
+        """
+        if self.state is not None:
+            return self.state.count_remaining()
+        return len(self.urls_to_download)
+
+    def create_scraper(self, element_id: str, url: str) -> ElementScraper:
+        raise NotImplementedError("method create_scraper must be implemented")
 
     def update_download_list(self):
         raise NotImplementedError
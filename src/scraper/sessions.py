@@ -0,0 +1,148 @@
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_cache.cache_keys import normalize_dict
+
+from scraper.cache_policy import CACHE_TTLS, PolicyCache, RevalidatingSession
+from scraper.connection import ProxyServer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class SessionManager:
+    # Keep one pooled, keep-alive session per proxy server, all sharing the same cache backend.
+    # Reusing the session avoids a new TCP and SOCKS5 handshake for every page.
+    cache_name: str
+    pool_size: int
+    cache: PolicyCache
+    cache_ttls: Dict[str, timedelta]
+    sessions: Dict[Optional[str], RevalidatingSession]
+
+    def __init__(self, cache_name: str, pool_size: int = 10,
+                 cache_ttls: Optional[Dict[str, timedelta]] = None):
+        """
+        :param cache_name: path of the sqlite cache shared by all the sessions
+        :param pool_size: maximum number of connections kept alive by each session
+        :param cache_ttls: time to live of the cached pages by url glob pattern, `CACHE_TTLS` by default
+        """
+        self.cache_name = cache_name
+        self.pool_size = pool_size
+        self.cache = PolicyCache(cache_name)
+        self.cache_ttls = CACHE_TTLS if cache_ttls is None else cache_ttls
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, proxy_server: Optional[ProxyServer] = None) -> RevalidatingSession:
+        """
+        Return the session bound to the server currently in use by `proxy_server`,
+        creating it the first time the server is used.
+        :param proxy_server: proxy to use, or None for direct calls
+        :return: cached session with its own connection pool
+        """
+        server = proxy_server.server_in_use if proxy_server else None
+        session = self.sessions.get(server)
+        if session is not None:
+            return session
+        with self._lock:
+            if server not in self.sessions:
+                session = RevalidatingSession(self.cache, urls_expire_after=self.cache_ttls)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if proxy_server:
+                    session.proxies.update(proxy_server.get_proxy(server))
+                self.sessions[server] = session
+                logger.debug(f"Created session for server '{server}'")
+            return self.sessions[server]
+
+    def cache_key(self, url: str, params: Optional[dict] = None) -> str:
+        """
+        Create the cache key of a GET call to `url`, with the same settings used by the sessions.
+        Unlike `BaseCache.has_url`, this takes into account the environment (e.g. REQUESTS_CA_BUNDLE)
+        :param url: url of the call
+        :param params: query parameters of the call
+        :return: key of the response in the cache
+        """
+        session = requests.Session()
+        request = session.prepare_request(requests.Request('GET', url, params=normalize_dict(params)))
+        settings = session.merge_environment_settings(request.url, {}, None, None, None)
+        return self.cache.create_key(request, verify=settings['verify'])
+
+    def is_cached(self, url: str, params: Optional[dict] = None) -> bool:
+        """
+        :param url: url of the call
+        :param params: query parameters of the call
+        :return: True if the response to the call is stored in the cache and not expired
+        """
+        return self.cache.is_fresh(self.cache_key(url, params))
+
+    def delete(self, url: str, params: Optional[dict] = None):
+        """
+        Delete the response to a call from the cache
+        :param url: url of the call
+        :param params: query parameters of the call
+        """
+        self.cache.delete(self.cache_key(url, params))
+
+    def invalidate(self, urls: Iterable[str] = (), patterns: Iterable[str] = ()) -> int:
+        """
+        Delete the responses to many calls from the cache in a single transaction
+        :param urls: urls of the calls, with their query parameters in the url
+        :param patterns: url glob patterns, e.g. 'www.erowid.org/experiences/exp.cgi*' for all the list pages
+        :return: number of responses deleted
+        """
+        keys = {self.cache_key(url) for url in urls}
+        for pattern in patterns:
+            keys.update(self.cache.keys_matching(pattern))
+        return self.cache.delete_keys(keys)
+
+    def revalidated(self) -> int:
+        """
+        :return: number of expired pages confirmed unchanged by the server, with a 304 response, by all the sessions
+        """
+        return sum(session.revalidated for session in self.sessions.values())
+
+    def close(self):
+        """
+        Close all the sessions and their connections
+        """
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+_session_manager: Optional[SessionManager] = None
+_session_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    """
+    Return the session manager shared by all scrapers, set by `configure_session_manager`. It is never created
+    implicitly, so that no cache is opened relative to the current directory by mistake
+    :return: shared SessionManager
+    """
+    with _session_manager_lock:
+        if _session_manager is None:
+            raise RuntimeError("No cache configured: call configure_session_manager, or pass a SessionManager")
+        return _session_manager
+
+
+def configure_session_manager(cache_name: str, **kwargs) -> SessionManager:
+    """
+    Set the session manager shared by all scrapers, replacing the previous one
+    :param cache_name: path of the sqlite cache
+    :param kwargs: other arguments of SessionManager
+    :return: shared SessionManager
+    """
+    global _session_manager
+    with _session_manager_lock:
+        if _session_manager is not None:
+            _session_manager.close()
+        _session_manager = SessionManager(cache_name, **kwargs)
+        return _session_manager
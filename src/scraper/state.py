@@ -0,0 +1,207 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from scraper.scrapers import from_txt_to_list
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class DownloadState:
+    # Persistent status of every element to download, keyed by its id (exp_id for experiences).
+    # It replaces checking the filesystem for each candidate, and the failed_urls txt files.
+    db_path: str
+
+    def __init__(self, db_path: str = 'data/download_state.sqlite'):
+        """
+        :param db_path: path of the sqlite file, created if missing
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    exp_id TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error_type TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_attempt REAL
+                )""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+
+    def add_pending(self, elements: Iterable[Tuple[str, str]]) -> int:
+        """
+        Add elements to download, ignoring the ones already known
+        :param elements: tuples of id and url
+        :return: number of elements added, not known before
+        """
+        with self._lock, self._connection:
+            return self._connection.executemany(
+                "INSERT OR IGNORE INTO downloads (exp_id, url, status) VALUES (?, ?, ?)",
+                ((exp_id, url, PENDING) for exp_id, url in elements)).rowcount
+
+    def mark_done(self, exp_id: str):
+        """
+        Record a successful download
+        :param exp_id: id of the element downloaded
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE downloads SET status = ?, error_type = NULL, attempts = attempts + 1, last_attempt = ? "
+                "WHERE exp_id = ?", (DONE, time.time(), exp_id))
+
+    def mark_all_done(self, exp_ids: Iterable[str]):
+        """
+        Record many successful downloads in a single transaction
+        :param exp_ids: ids of the elements downloaded
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE downloads SET status = ?, error_type = NULL, attempts = attempts + 1, last_attempt = ? "
+                "WHERE exp_id = ?", ((DONE, now, exp_id) for exp_id in exp_ids))
+
+    def mark_failed(self, exp_id: str, error_type: str, url: str = ''):
+        """
+        Record a failed download
+        :param exp_id: id of the element that failed
+        :param error_type: name of the exception raised
+        :param url: url of the element, used if it was not in the state yet
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO downloads (exp_id, url, status, error_type, attempts, last_attempt) "
+                "VALUES (?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (exp_id) DO UPDATE SET status = excluded.status, error_type = excluded.error_type, "
+                "attempts = attempts + 1, last_attempt = excluded.last_attempt",
+                (exp_id, url, FAILED, error_type, time.time()))
+
+    def remaining(self, max_attempts: Optional[int] = None, batch_size: int = 1000,
+                  until: Optional[threading.Event] = None) -> Iterator[Optional[Tuple[str, str]]]:
+        """
+        Stream the elements that still have to be downloaded, pending and failed ones, in the order they were added.
+        Rows are read in batches, so memory does not depend on the number of elements.
+        :param max_attempts: skip failed elements that were already attempted this many times
+        :param batch_size: number of rows read from the database at once
+        :param until: while this event is not set, yield None once all the known ones are streamed, instead of
+                      stopping, and look for new elements when resumed, e.g. while they are being discovered by
+                      another thread. Callers wait before resuming, without holding any lock the other consumers need
+        :return: iterator of tuples of id and url, and None while waiting for new elements
+        """
+        query = "SELECT rowid, exp_id, url FROM downloads WHERE status != ? AND rowid > ?"
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+        query += " ORDER BY rowid LIMIT ?"
+        last_rowid = 0
+        while True:
+            # Checked before the query, so that elements added right before the event is set are still streamed
+            finished = until is None or until.is_set()
+            args: tuple = (DONE, last_rowid) + ((max_attempts,) if max_attempts is not None else ()) + (batch_size,)
+            with self._lock:
+                rows = self._connection.execute(query, args).fetchall()
+            for last_rowid, exp_id, url in rows:
+                yield exp_id, url
+            if len(rows) < batch_size:
+                if finished:
+                    return
+                yield None
+
+    def count_remaining(self) -> int:
+        """
+        :return: number of elements that still have to be downloaded
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM downloads WHERE status != ?", (DONE,)).fetchone()[0]
+
+    def failed(self, error_type: Optional[str] = None) -> List[Tuple[str, str]]:
+        """
+        :param error_type: only return the failures with this exception name
+        :return: list of tuples of id and url that failed
+        """
+        query = "SELECT exp_id, url FROM downloads WHERE status = ?"
+        args: tuple = (FAILED,)
+        if error_type is not None:
+            query += " AND error_type = ?"
+            args += (error_type,)
+        with self._lock:
+            return self._connection.execute(query, args).fetchall()
+
+    def attempted_ids(self) -> List[str]:
+        """
+        :return: ids of the elements downloaded or failed, i.e. whose page may be cached
+        """
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT exp_id FROM downloads WHERE status != ?",
+                                                               (PENDING,))]
+
+    def is_done(self, exp_id: str) -> bool:
+        """
+        :param exp_id: id of the element
+        :return: True if the element was downloaded successfully
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT status FROM downloads WHERE exp_id = ?", (exp_id,)).fetchone()
+        return row is not None and row[0] == DONE
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: number of elements for each status
+        """
+        with self._lock:
+            return dict(self._connection.execute("SELECT status, COUNT(*) FROM downloads GROUP BY status"))
+
+    def import_folder(self, save_folder: str, base_url: str, extension: str = '.json'):
+        """
+        Mark as done all the elements already saved in a folder, e.g. to migrate a download
+        started before the state existed. The folder is listed only once.
+
+        :param save_folder: folder containing one file per element, named after its id
+        :param base_url: url that, followed by the id, gives the url of the element
+        :param extension: extension of the saved files
+        """
+        exp_ids = [file[:-len(extension)] for file in os.listdir(save_folder) if file.endswith(extension)]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO downloads (exp_id, url, status) VALUES (?, ?, ?) "
+                "ON CONFLICT (exp_id) DO UPDATE SET status = excluded.status, error_type = NULL",
+                ((exp_id, f"{base_url}{exp_id}", DONE) for exp_id in exp_ids))
+        logger.info(f"Imported {len(exp_ids)} elements already saved in {save_folder}")
+
+    def import_failures(self, failures_folder: str, id_from_url):
+        """
+        Record as failed the urls listed in failed_urls_<Exception>.txt files, unless they were downloaded.
+
+        :param failures_folder: folder containing the txt files
+        :param id_from_url: function returning the id of an element given its url
+        """
+        prefix = 'failed_urls_'
+        for file in os.listdir(failures_folder):
+            if not (file.startswith(prefix) and file.endswith('.txt')):
+                continue
+            error_type = file[len(prefix):-len('.txt')]
+            urls = from_txt_to_list(os.path.join(failures_folder, file))
+            with self._lock, self._connection:
+                self._connection.executemany(
+                    "INSERT INTO downloads (exp_id, url, status, error_type, attempts) VALUES (?, ?, ?, ?, 1) "
+                    "ON CONFLICT (exp_id) DO UPDATE SET status = excluded.status, error_type = excluded.error_type, "
+                    "attempts = attempts + 1 WHERE status != ?",
+                    ((id_from_url(url), url, FAILED, error_type, DONE) for url in urls))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from scraper.corpus import CorpusStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class StoryIndex:
+    # Full text index of the title and story of every experience, in a sqlite FTS5 table, together with the
+    # substances, tags and metadata of each experience to filter the results.
+    # Queries use the FTS5 syntax: words, "exact phrases", AND, OR, NOT, prefix* and NEAR(...).
+    db_path: str
+
+    def __init__(self, db_path: str = 'data/story_index.sqlite'):
+        """
+        :param db_path: path of the sqlite file, created if missing
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS experiences (
+                    id INTEGER PRIMARY KEY,
+                    exp_id TEXT NOT NULL UNIQUE
+                )""")
+            self._connection.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS stories
+                USING fts5(title, story, tokenize = 'porter unicode61')""")
+            for table, columns in (('substances', 'substance_id TEXT, name TEXT'),
+                                   ('tags', 'tag_id TEXT, name TEXT'),
+                                   ('metadata', 'key TEXT, value TEXT')):
+                self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER NOT NULL, {columns})")
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_id ON {table} (id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS substances_substance ON substances (substance_id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag_id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS metadata_key_value ON metadata (key, value)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM experiences").fetchone()[0]
+
+    def _add(self, exp_id: str, exp_dict: dict):
+        """
+        Index an experience, replacing it if already indexed. Must be called within a transaction.
+        """
+        row = self._connection.execute("SELECT id FROM experiences WHERE exp_id = ?", (exp_id,)).fetchone()
+        if row is None:
+            row_id = self._connection.execute("INSERT INTO experiences (exp_id) VALUES (?)", (exp_id,)).lastrowid
+        else:
+            row_id = row[0]
+            for table in ('stories', 'substances', 'tags', 'metadata'):
+                self._connection.execute(f"DELETE FROM {table} WHERE {'rowid' if table == 'stories' else 'id'} = ?",
+                                         (row_id,))
+        self._connection.execute("INSERT INTO stories (rowid, title, story) VALUES (?, ?, ?)",
+                                 (row_id, exp_dict['title'], '\n'.join(exp_dict['story_paragraphs'])))
+        self._connection.executemany("INSERT INTO substances (id, substance_id, name) VALUES (?, ?, ?)",
+                                     ((row_id, item['id'], item['name']) for item in exp_dict['substances_main']))
+        self._connection.executemany("INSERT INTO tags (id, tag_id, name) VALUES (?, ?, ?)",
+                                     ((row_id, item['id'], item['name']) for item in exp_dict['tags']))
+        self._connection.executemany("INSERT INTO metadata (id, key, value) VALUES (?, ?, ?)",
+                                     ((row_id, key.strip(), str(value).strip())
+                                      for key, value in exp_dict['metadata'].items()))
+
+    def add_experience(self, exp_id: str, exp_dict: dict):
+        """
+        Index an experience, replacing it if already indexed
+
+        :param exp_id: id of the experience
+        :param exp_dict: experience, as returned by `ExperienceScraper.to_dict`
+        """
+        with self._lock, self._connection:
+            self._add(exp_id, exp_dict)
+
+    def add_experiences(self, experiences: Iterable[Tuple[str, dict]]) -> int:
+        """
+        Index many experiences in a single transaction
+
+        :param experiences: tuples of id and experience
+        :return: number of experiences indexed
+        """
+        added = 0
+        with self._lock, self._connection:
+            for exp_id, exp_dict in experiences:
+                self._add(exp_id, exp_dict)
+                added += 1
+        return added
+
+    def indexed_ids(self) -> List[str]:
+        """
+        :return: ids of all the experiences indexed
+        """
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT exp_id FROM experiences")]
+
+    def _filtered_query(self, select: str, query: str, substances: Iterable[str], tags: Iterable[str],
+                        metadata: Optional[Dict[str, str]]) -> Tuple[str, list]:
+        sql = f"{select} FROM stories JOIN experiences ON experiences.id = stories.rowid WHERE stories MATCH ?"
+        params: list = [query]
+        for substance in substances:
+            sql += " AND stories.rowid IN (SELECT id FROM substances WHERE substance_id = ? OR name = ?)"
+            params.extend((substance, substance))
+        for tag_id in tags:
+            sql += " AND stories.rowid IN (SELECT id FROM tags WHERE tag_id = ?)"
+            params.append(tag_id)
+        for key, value in (metadata or {}).items():
+            sql += " AND stories.rowid IN (SELECT id FROM metadata WHERE key = ? AND value = ?)"
+            params.extend((key, value))
+        return sql, params
+
+    def search(self, query: str, substances: Iterable[str] = (), tags: Iterable[str] = (),
+               metadata: Optional[Dict[str, str]] = None, limit: Optional[int] = 100) -> List[Tuple[str, str, str]]:
+        """
+        Experiences whose title or story match the query, best matches first
+
+        :param query: FTS5 query, e.g. '"bad trip" AND (nausea OR vomiting) NOT hospital'
+        :param substances: ids or names of substances the experiences must contain
+        :param tags: ids of tags the experiences must have
+        :param metadata: values the metadata of the experiences must have, e.g. {'Gender': 'Female'}
+        :param limit: maximum number of results, all of them if None
+        :return: tuples of exp_id, title and snippet of the story around the match
+        """
+        sql, params = self._filtered_query(
+            "SELECT experiences.exp_id, stories.title, snippet(stories, 1, '[', ']', '...', 16)",
+            query, substances, tags, metadata)
+        sql += " ORDER BY rank"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def count(self, query: str, substances: Iterable[str] = (), tags: Iterable[str] = (),
+              metadata: Optional[Dict[str, str]] = None) -> int:
+        """
+        :return: number of experiences matching the query, with the same arguments as `search`
+        """
+        sql, params = self._filtered_query("SELECT COUNT(*)", query, substances, tags, metadata)
+        with self._lock:
+            return self._connection.execute(sql, params).fetchone()[0]
+
+    def import_corpus(self, corpus: CorpusStore) -> int:
+        """
+        Index the experiences of the corpus not indexed yet
+
+        :param corpus: corpus to index
+        :return: number of experiences indexed
+        """
+        indexed = set(self.indexed_ids())
+        experiences = ((exp_dict['exp_id'], exp_dict) for exp_dict in corpus.read_experiences()
+                       if exp_dict['exp_id'] not in indexed)
+        added = self.add_experiences(experiences)
+        logger.info(f"Indexed {added} experiences from {corpus.folder}")
+        return added
+
+    def import_folder(self, json_folder: str) -> int:
+        """
+        Index the experiences of a folder of JSON files not indexed yet, as written by `ExperienceScraper.save`
+
+        :param json_folder: folder containing the JSON files
+        :return: number of experiences indexed
+        """
+        indexed = set(self.indexed_ids())
+
+        def experiences():
+            for file in os.listdir(json_folder):
+                exp_id = file[:-len('.json')]
+                if not file.endswith('.json') or file.find('(1)') != -1 or exp_id in indexed:
+                    continue
+                with open(os.path.join(json_folder, file), encoding='utf-8') as open_json:
+                    yield exp_id, json.load(open_json)
+
+        added = self.add_experiences(experiences())
+        logger.info(f"Indexed {added} experiences from {json_folder}")
+        return added
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
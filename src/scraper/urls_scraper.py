@@ -1,40 +1,54 @@
 import logging
 import os
-from copy import deepcopy
-from typing import List, Optional
+import re
+from typing import Callable, List, Optional
 
 import requests
-import requests_cache
 
 from scraper.connection import ProxyServer
 from scraper.scrapers import ElementScraper, ListScraper
+from scraper.sessions import SessionManager
+from scraper.state import DownloadState
 
-requests_cache.install_cache('data/erowid_cache')
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
 
 
 class UrlListScraper(ElementScraper):
     params: dict
     experiences_urls: List[str] = None
     base_url: str = "https://www.erowid.org/experiences/"
-
-    def __init__(self, url: str, params: dict, proxy_server: Optional[ProxyServer] = None):
-        super().__init__(url, proxy_server)
+    # Total number of results of the search, as written above the results list
+    total_pattern = re.compile(r'([\d,]+)\s+(?:total\s+)?(?:experiences|reports|results)', re.IGNORECASE)
+    total: Optional[int]
+    # Called with the urls extracted, once saved, returns how many of them were not known before
+    on_urls: Optional[Callable[[List[str]], int]]
+
+    def __init__(self, url: str, params: dict, proxy_server: Optional[ProxyServer] = None,
+                 session_manager: Optional[SessionManager] = None,
+                 on_urls: Optional[Callable[[List[str]], int]] = None):
+        super().__init__(url, proxy_server, session_manager)
         self.params = params
         self.exp_list_id = f"{params['Start']}_{params['Start'] + params['Max']}"
         self.experiences_urls = []
+        self.total = None
+        self.on_urls = on_urls
+        self.new_urls = 0
+
+    @property
+    def element_id(self) -> str:
+        return self.exp_list_id
 
-    def http_call(self, proxy):
+    def http_call(self, session: requests.Session):
         """
         Make the call to the urls list
-        :param proxy: proxy server to use for the call
+        :param session: session, bound to a proxy server, to use for the call
         :return: requests response
         """
-        return requests.get(self.url,
-                            proxies=proxy,
-                            headers=self.headers,
-                            allow_redirects=False,
-                            params=self.params)
+        return session.get(self.url,
+                           headers=self.headers,
+                           allow_redirects=False,
+                           params=self.params)
 
     def extract_data(self):
         """
@@ -48,15 +62,20 @@ class UrlListScraper(ElementScraper):
                 exp_end_url = a_tag[0].attrs['href'].strip()
                 exp_url = self.base_url + exp_end_url
                 self.experiences_urls.append(exp_url)
+        match = self.total_pattern.search(self.soup.get_text(' '))
+        if match:
+            self.total = int(match.group(1).replace(',', ''))
 
     def save(self):
         """
-        Save extracted urls in the file located in `save_path`.
+        Save extracted urls in the file located in `save_path`, and pass them to `on_urls`
         """
         with open(self.save_path, 'w') as open_txt:
             for el in self.experiences_urls:
                 open_txt.write(el)
                 open_txt.write('\n')
+        if self.on_urls is not None:
+            self.new_urls = self.on_urls(self.experiences_urls)
 
 
 class ErowidUrlsScraper(ListScraper):
@@ -65,33 +84,100 @@ class ErowidUrlsScraper(ListScraper):
     save_folder: str = "data/exp_links"
     start: int = 0
     max_step: int = 1000
-    base_params: dict = {'ShowViews': 0, 'Cellar': 1, 'Start': start, 'Max': max_step}
+    base_params: dict
+    # Last page start used when the total number of results cannot be read from the first page
     final_start: int = 39300
+    # Called with the urls of each page as soon as it is downloaded, e.g. `ErowidScraper.add_urls`
+    on_urls: Optional[Callable[[List[str]], int]]
 
-    def update_download_list(self, file: str = ''):
+    def __init__(self, raise_exceptions: bool = False, proxy_server: Optional[ProxyServer] = None,
+                 state: Optional[DownloadState] = None, on_urls: Optional[Callable[[List[str]], int]] = None):
+        """
+        :param on_urls: called with the experience urls of each page of results, returning how many were not known
+        """
+        super().__init__(raise_exceptions, proxy_server, state)
+        self.base_params = {'ShowViews': 0, 'Cellar': 1, 'Start': self.start, 'Max': self.max_step}
+        self.on_urls = on_urls
+        # Pages of results in which some urls were already known, by start
+        self.known_pages: List[int] = []
+
+    def update_download_list(self, file: str = '', total: Optional[int] = None, first_start: Optional[int] = None,
+                             refresh: bool = False):
         """
         Update the list of URLs to download.
 
-        :return:
+        :param total: total number of results, pages up to `final_start` are downloaded if unknown
+        :param first_start: start of the first page to download, `start` by default
+        :param refresh: download again the pages already saved, e.g. to find new experiences
         """
-        for i in range(self.start, self.final_start, self.max_step):
-            params = self.base_params
-            params['Start'] = i
-            urls_scraper = UrlListScraper(self.base_url, params, proxy_server=self.proxy_server)
-            candidate_path = os.path.join(self.save_folder, f"{urls_scraper.exp_list_id}.txt")
-            if os.path.isfile(candidate_path):
-                logging.debug(f"List of urls {urls_scraper.exp_list_id} already downloaded")
+        end = total if total is not None else self.final_start
+        first_start = self.start if first_start is None else first_start
+        for i in range(first_start, end, self.max_step):
+            exp_list_id = f"{i}_{i + self.max_step}"
+            candidate_path = os.path.join(self.save_folder, f"{exp_list_id}.txt")
+            if os.path.isfile(candidate_path) and not refresh:
+                logger.debug(f"List of urls {exp_list_id} already downloaded")
             else:
-                urls_scraper.save_path = candidate_path
-                self.urls_to_download[urls_scraper.exp_list_id] = urls_scraper
-
-
-def main():
-    proxy = ProxyServer("credentials.json")
-    erowid_scraper = ErowidUrlsScraper(raise_exceptions=False, proxy_server=proxy)
-    erowid_scraper.update_download_list()
-    erowid_scraper.download(wait=False)
-
+                self.urls_to_download[exp_list_id] = self.base_url
 
-if __name__ == '__main__':
-    main()
+    def create_scraper(self, element_id: str, url: str) -> UrlListScraper:
+        """
+        Create the scraper of a page of search results, with its own copy of the params
+        :param element_id: id of the page, made of the first and last result numbers
+        :param url: url of the search
+        :return: scraper saving the urls in `save_folder`
+        """
+        params = dict(self.base_params, Start=int(element_id.split('_')[0]))
+        urls_scraper = UrlListScraper(url, params, proxy_server=self.proxy_server,
+                                      on_urls=lambda urls: self._page_urls(params['Start'], urls))
+        urls_scraper.save_path = os.path.join(self.save_folder, f"{element_id}.txt")
+        return urls_scraper
+
+    def _page_urls(self, start: int, urls: List[str]) -> int:
+        new_urls = self.on_urls(urls) if self.on_urls is not None else len(urls)
+        if new_urls < len(urls):
+            with self._lock:
+                self.known_pages.append(start)
+        return new_urls
+
+    def probe_total(self) -> Optional[int]:
+        """
+        Download the first page of results, reading the total number of results from it
+        :return: total number of results, None if it could not be read
+        """
+        element_id = f"{self.start}_{self.start + self.max_step}"
+        scraper = self.create_scraper(element_id, self.base_url)
+        if not self.download_element(scraper):
+            return None
+        logger.info(f"Search returned {scraper.total} results")
+        return scraper.total
+
+    def discover(self, workers_per_server: int = 1, wait: bool = True, incremental: bool = False):
+        """
+        Download all the pages of results concurrently, after reading the total number of results from the first one.
+        The urls of each page are passed to `on_urls` as soon as it is downloaded, so that experiences can be
+        downloaded while discovery goes on.
+
+        :param workers_per_server: number of concurrent workers using the same proxy server
+        :param wait: whether calls through the same server should be rate limited
+        :param incremental: only look for experiences published since the last run. Results are the most recent
+                            first, so pages are downloaded a few at a time, and discovery stops after the first page
+                            containing an experience already known
+        """
+        self.known_pages = []
+        total = self.probe_total()
+        first_start = self.start + self.max_step
+        if not incremental:
+            self.urls_to_download = {}
+            self.update_download_list(total=total, first_start=first_start, refresh=True)
+            self.download_concurrent(workers_per_server, wait=wait)
+            return
+        servers = len(self.proxy_server.servers) if self.proxy_server else 1
+        wave = self.max_step * servers * workers_per_server
+        end = total if total is not None else self.final_start
+        while not self.known_pages and first_start < end:
+            self.urls_to_download = {}
+            self.update_download_list(total=min(end, first_start + wave), first_start=first_start, refresh=True)
+            self.download_concurrent(workers_per_server, wait=wait)
+            first_start += wave
+        logger.info(f"Discovery stopped at the page starting at {min(self.known_pages or [end])}")
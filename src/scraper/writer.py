@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from scraper.corpus import CorpusStore
+from scraper.metrics import ScrapeMetrics
+from scraper.story_index import StoryIndex
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# C encoder of the standard library without indentation nor spaces: several times faster than `indent=4`,
+# which falls back to the pure Python encoder, and the files are about a third smaller
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), check_circular=False)
+
+
+def write_experience_file(exp_dict: dict, save_path: str, fsync: bool = False):
+    """
+    Write an experience as compact UTF-8 JSON, the format of all the JSON files of experiences. It is written to a
+    temporary file renamed at the end, so that the file is either the previous version or the new one, never partial
+
+    :param exp_dict: experience, as returned by `ExperienceScraper.to_dict`
+    :param save_path: JSON file of the experience
+    :param fsync: sync the file to disk before renaming it
+    """
+    # Encoded first, so that an experience that cannot be serialised leaves nothing behind
+    content = _encoder.encode(exp_dict)
+    temp_path = f"{save_path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as open_json:
+            open_json.write(content)
+            if fsync:
+                open_json.flush()
+                os.fsync(open_json.fileno())
+        os.replace(temp_path, save_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@dataclass
+class PendingExperience:
+    exp_id: str
+    exp_dict: dict
+    url: str
+    # JSON file of the experience, unused when writing to a corpus
+    save_path: str
+
+
+class ExperienceWriter:
+    # Output stage of the download: the experiences extracted by the download workers are queued, and written in
+    # batches by a background thread, so that a slow disk (e.g. a network filesystem) does not delay the next call.
+    # JSON files are written to a temporary file, synced and renamed, so a crash never leaves a partial experience,
+    # and only the experiences written are reported through `on_written`, e.g. to mark them done in the state.
+    corpus: Optional[CorpusStore]
+    story_index: Optional[StoryIndex]
+    batch_size: int
+    # Seconds waited for a batch to fill up before writing what is queued
+    batch_wait: float
+    fsync: bool
+    metrics: ScrapeMetrics
+
+    def __init__(self, corpus: Optional[CorpusStore] = None, story_index: Optional[StoryIndex] = None,
+                 max_queue: int = 256, batch_size: int = 64, batch_wait: float = 0.5, fsync: bool = True,
+                 on_written: Optional[Callable[[List[str]], None]] = None,
+                 on_failed: Optional[Callable[[str, str, str], None]] = None):
+        """
+        :param corpus: consolidated storage where to write the experiences, instead of one JSON file each
+        :param story_index: full text index where to add the experiences written
+        :param max_queue: experiences queued at most, `put` blocks when it is reached
+        :param batch_size: experiences written at most at once
+        :param batch_wait: seconds waited for a batch to fill up
+        :param fsync: sync the files written to disk before reporting them written
+        :param on_written: called with the ids of each batch written
+        :param on_failed: called with the id, url and name of the exception of each experience that failed to be
+                          written
+        """
+        self.corpus = corpus
+        self.story_index = story_index
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.fsync = fsync
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.metrics = ScrapeMetrics()
+        self.written = 0
+        self.failed = 0
+        self._queue: 'queue.Queue[PendingExperience]' = queue.Queue(max_queue)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def saturation(self) -> float:
+        """
+        :return: share of the queue in use, close to 1 when writing is slower than downloading
+        """
+        return self._queue.qsize() / self._queue.maxsize
+
+    def put(self, exp_id: str, exp_dict: dict, url: str, save_path: str):
+        """
+        Queue an experience to write, blocking while the queue is full
+        :param exp_id: id of the experience
+        :param exp_dict: experience, as returned by `ExperienceScraper.to_dict`
+        :param url: url of the experience
+        :param save_path: JSON file of the experience
+        """
+        pending = PendingExperience(exp_id, exp_dict, url, save_path)
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            # Back-pressure: the download waits for the writes, the time spent here is I/O bound
+            self.metrics.increment('writer_full')
+            with self.metrics.timer('writer_blocked'):
+                self._queue.put(pending)
+
+    def _next_batch(self) -> List[PendingExperience]:
+        try:
+            batch = [self._queue.get(timeout=self.batch_wait)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _sync_folders(self, batch: List[PendingExperience]):
+        # The renames are only durable once the folders holding them are synced
+        for folder in {os.path.dirname(pending.save_path) or '.' for pending in batch}:
+            try:
+                folder_fd = os.open(folder, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(folder_fd)
+            except OSError:
+                pass
+            finally:
+                os.close(folder_fd)
+
+    def _report_failure(self, pending: PendingExperience, error: Exception):
+        logger.error(f"Unable to write experience {pending.exp_id}: {type(error).__name__}: {error}")
+        self.failed += 1
+        self.metrics.increment(f"write_failed_{type(error).__name__}")
+        if self.on_failed is not None:
+            self.on_failed(pending.exp_id, pending.url, type(error).__name__)
+
+    def write_batch(self, batch: List[PendingExperience]):
+        """
+        Write a batch of experiences, then index them and report them written
+        :param batch: experiences to write
+        """
+        written = []
+        with self.metrics.timer('write_batch'):
+            if self.corpus is not None:
+                try:
+                    self.corpus.write_experiences(((pending.exp_id, pending.exp_dict) for pending in batch),
+                                                  fsync=self.fsync)
+                    written = batch
+                except OSError as e:
+                    for pending in batch:
+                        self._report_failure(pending, e)
+            else:
+                for pending in batch:
+                    try:
+                        write_experience_file(pending.exp_dict, pending.save_path, self.fsync)
+                        written.append(pending)
+                    except (OSError, TypeError, ValueError) as e:
+                        self._report_failure(pending, e)
+                if self.fsync and written:
+                    self._sync_folders(written)
+            if written and self.story_index is not None:
+                self.story_index.add_experiences((pending.exp_id, pending.exp_dict) for pending in written)
+        if written:
+            self.written += len(written)
+            self.metrics.increment('written', len(written))
+            self.metrics.increment('write_batches')
+            if self.on_written is not None:
+                self.on_written([pending.exp_id for pending in written])
+
+    def _write_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except Exception:
+                    logger.exception(f"Batch of {len(batch)} experiences failed:")
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+            elif self._stop.is_set():
+                return
+
+    def start(self):
+        """
+        Start writing the experiences queued in a background thread
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._write_loop, name='experience-writer', daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        """
+        Block until all the experiences queued are written
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Write the experiences still queued, and stop the background thread
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,181 @@
+"""
+Search of the experiences by combination of substances, with the distribution of the tags of the results.
+
+Experiences are numbered, and for each substance, tag and route the index keeps the set of experiences where it
+appears as a bitset (packed numpy array, one bit per experience). Experiences containing at least a combination are
+the intersection of the bitsets of its substances, and the ones containing exactly it are further intersected with
+the bitset of the experiences with that number of substances. Tag counts of the results are the popcount of the
+intersection of the results with the bitset of each tag, computed for all the tags at once.
+"""
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Number of bits set in each byte
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int32)
+
+
+def _bitsets(postings: Dict[str, List[int]], total_rows: int) -> Tuple[List[str], np.ndarray]:
+    """
+    :param postings: rows in which each label appears
+    :param total_rows: total number of rows
+    :return: labels, and matrix with the packed bitset of each label
+    """
+    labels = sorted(postings)
+    bits = np.zeros((len(labels), total_rows), dtype=bool)
+    for i, label in enumerate(labels):
+        bits[i, postings[label]] = True
+    return labels, np.packbits(bits, axis=1)
+
+
+@dataclass
+class SearchResult:
+    exp_ids: List[str]
+    # Number of experiences of the result with each tag, most common first
+    tag_counts: Dict[str, int]
+
+    @property
+    def tag_distribution(self) -> Dict[str, float]:
+        """
+        :return: share of the experiences of the result with each tag
+        """
+        return {tag_id: count / len(self.exp_ids) for tag_id, count in self.tag_counts.items()} if self.exp_ids else {}
+
+
+class ExperienceIndex:
+
+    def __init__(self, exp_ids: List[str], bitsets: Dict[str, Tuple[List[str], np.ndarray]],
+                 names: Optional[Dict[str, Dict[str, str]]] = None):
+        """
+        :param exp_ids: id of the experience of each row
+        :param bitsets: for each kind of posting ('substances', 'tags', 'routes', 'sizes'), the labels and the
+                        matrix of their packed bitsets
+        :param names: for each kind of posting, names of the labels
+        """
+        self.exp_ids = exp_ids
+        self.bitsets = bitsets
+        self.names = names or {}
+        self._rows: Dict[str, Dict[str, int]] = {kind: {label: i for i, label in enumerate(labels)}
+                                                 for kind, (labels, _) in bitsets.items()}
+        self._ids_by_name: Dict[str, str] = {name.lower(): item_id
+                                             for item_id, name in self.names.get('substances', {}).items()}
+
+    @classmethod
+    def from_experiences(cls, experiences: Iterable[dict]) -> 'ExperienceIndex':
+        """
+        Build the index from the experiences, with the keys of the JSON files written by the scraper.
+        Only substances_main, substances_details and tags are needed.
+
+        :param experiences: experiences, each with its exp_id
+        :return: index of the experiences
+        """
+        exp_ids: List[str] = []
+        postings: Dict[str, Dict[str, List[int]]] = {'substances': {}, 'tags': {}, 'routes': {}, 'sizes': {}}
+        names: Dict[str, Dict[str, str]] = {'substances': {}, 'tags': {}}
+        for row, experience in enumerate(experiences):
+            exp_ids.append(experience['exp_id'])
+            substance_ids = set()
+            for kind, key in (('substances', 'substances_main'), ('tags', 'tags')):
+                for item in experience.get(key) or []:
+                    names[kind].setdefault(item['id'], item['name'])
+                    if kind == 'substances':
+                        substance_ids.add(item['id'])
+                    item_rows = postings[kind].setdefault(item['id'], [])
+                    if not item_rows or item_rows[-1] != row:
+                        item_rows.append(row)
+            for dose in experience.get('substances_details') or []:
+                route = dose.get('route', dose['method'].strip().lower())
+                route_rows = postings['routes'].setdefault(route, []) if route else None
+                if route_rows is not None and (not route_rows or route_rows[-1] != row):
+                    route_rows.append(row)
+            postings['sizes'].setdefault(str(len(substance_ids)), []).append(row)
+        bitsets = {kind: _bitsets(kind_postings, len(exp_ids)) for kind, kind_postings in postings.items()}
+        return cls(exp_ids, bitsets, names)
+
+    def _bitset(self, kind: str, label: str) -> np.ndarray:
+        labels, bits = self.bitsets[kind]
+        row = self._rows[kind].get(label)
+        if row is None:
+            return np.zeros(bits.shape[1], dtype=np.uint8)
+        return bits[row]
+
+    def substance_id(self, substance: str) -> str:
+        """
+        :param substance: id or name (case insensitive) of a substance
+        :return: id of the substance
+        """
+        if substance in self._rows['substances']:
+            return substance
+        return self._ids_by_name.get(substance.lower(), substance)
+
+    def matching(self, substances: Iterable[str], exact: bool = False, tags: Iterable[str] = (),
+                 routes: Iterable[str] = ()) -> np.ndarray:
+        """
+        :param substances: ids or names of the substances of the combination
+        :param exact: only experiences with no other substance than the combination
+        :param tags: ids of tags the experiences must have
+        :param routes: routes of administration (e.g. oral) the experiences must have used
+        :return: packed bitset of the matching experiences
+        """
+        substance_ids = {self.substance_id(substance) for substance in substances}
+        result = np.full(self.bitsets['sizes'][1].shape[1], 0xFF, dtype=np.uint8)
+        for substance_id in substance_ids:
+            result &= self._bitset('substances', substance_id)
+        for tag_id in tags:
+            result &= self._bitset('tags', tag_id)
+        for route in routes:
+            result &= self._bitset('routes', route)
+        if exact:
+            result &= self._bitset('sizes', str(len(substance_ids)))
+        return result
+
+    def search(self, substances: Iterable[str], exact: bool = False, tags: Iterable[str] = (),
+               routes: Iterable[str] = ()) -> SearchResult:
+        """
+        Experiences containing exactly, or at least, a combination of substances, with the tags of the results
+
+        :param substances: ids or names of the substances of the combination
+        :param exact: only experiences with no other substance than the combination
+        :param tags: ids of tags the experiences must have
+        :param routes: routes of administration (e.g. oral) the experiences must have used
+        :return: ids of the matching experiences and number of them with each tag
+        """
+        result = self.matching(substances, exact, tags, routes)
+        rows = np.flatnonzero(np.unpackbits(result, count=len(self.exp_ids)))
+        tag_labels, tag_bits = self.bitsets['tags']
+        counts = _POPCOUNT[tag_bits & result].sum(axis=1)
+        order = np.argsort(-counts, kind='stable')
+        tag_counts = {tag_labels[i]: int(counts[i]) for i in order if counts[i]}
+        return SearchResult(exp_ids=[self.exp_ids[row] for row in rows], tag_counts=tag_counts)
+
+    @staticmethod
+    def file_path(path: str) -> str:
+        """
+        :param path: path of the index, with or without extension
+        :return: path of the npz file, as numpy adds the extension when it is missing
+        """
+        return path if path.endswith('.npz') else f'{path}.npz'
+
+    def save(self, path: str):
+        """
+        Persist the index as a npz file
+
+        :param path: path of the file, .npz is added if missing
+        """
+        arrays = {f'{kind}_bits': bits for kind, (_, bits) in self.bitsets.items()}
+        labels = {kind: kind_labels for kind, (kind_labels, _) in self.bitsets.items()}
+        metadata = json.dumps({'exp_ids': self.exp_ids, 'labels': labels, 'names': self.names})
+        np.savez_compressed(self.file_path(path), metadata=np.array(metadata), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'ExperienceIndex':
+        """
+        :param path: path of the file written by `save`, with or without extension
+        :return: index
+        """
+        with np.load(cls.file_path(path)) as npz:
+            metadata = json.loads(str(npz['metadata']))
+            bitsets = {kind: (labels, npz[f'{kind}_bits']) for kind, labels in metadata['labels'].items()}
+        return cls(metadata['exp_ids'], bitsets, metadata['names'])
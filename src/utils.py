@@ -1,13 +1,129 @@
-from typing import List
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Keys of each row of the dose chart, as extracted by the scraper
+DOSE_FIELDS: Tuple[str, ...] = ('use_time', 'amount', 'method', 'substance_id', 'substance_name', 'form')
+
+
+class Vocabulary:
+    # Maps the ids of tags, substances or any other repeated string to small integer codes, so that each distinct
+    # string is stored once however many experiences refer to it.
+    __slots__ = ('codes', 'labels', 'names')
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.labels: List[str] = []
+        self.names: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def code(self, label: str, name: Optional[str] = None) -> int:
+        """
+        :param label: id to encode, added to the vocabulary the first time it is seen
+        :param name: name of the id, kept from its first occurrence. The label itself by default
+        :return: code of the label
+        """
+        code = self.codes.get(label)
+        if code is None:
+            code = len(self.labels)
+            label = sys.intern(label)
+            self.codes[label] = code
+            self.labels.append(label)
+            self.names.append(sys.intern(name) if name is not None else label)
+        return code
+
+    def label(self, code: int) -> str:
+        return self.labels[code]
+
+    def name(self, code: int) -> str:
+        return self.names[code]
+
+
+# Vocabularies shared by all the experiences loaded in the process
+TAGS = Vocabulary()
+SUBSTANCES = Vocabulary()
+DOSE_VALUES = Vocabulary()
+
+
+class DoseRows:
+    # Dose chart of an experience, stored by column: one array of codes in `DOSE_VALUES` per key of `DOSE_FIELDS`.
+    # Rows are rebuilt as dicts, the same ones written by the scraper, only when accessed. Normalised fields are
+    # computed again from the raw strings, as they are cached per distinct string.
+    __slots__ = DOSE_FIELDS
+
+    def __init__(self, rows: List[dict]):
+        """
+        :param rows: dose rows as extracted by the scraper, dicts with the keys in `DOSE_FIELDS`
+        """
+        for key in DOSE_FIELDS:
+            setattr(self, key, array('I', (DOSE_VALUES.code(row[key]) for row in rows)))
+
+    def __len__(self) -> int:
+        return len(self.use_time)
+
+    def __getitem__(self, index: int) -> dict:
+        # Imported here, so that the data model does not depend on the scraper package
+        from scraper.doses import normalize_dose
+
+        row = {key: DOSE_VALUES.label(getattr(self, key)[index]) for key in DOSE_FIELDS}
+        row.update(normalize_dose(row))
+        return row
+
+    def __iter__(self) -> Iterator[dict]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def column(self, key: str) -> List[str]:
+        """
+        :param key: one of `DOSE_FIELDS`
+        :return: value of the key in every row
+        """
+        return [DOSE_VALUES.label(code) for code in getattr(self, key)]
+
+
+def _encode_items(items: Optional[List[dict]], vocabulary: Vocabulary) -> array:
+    return array('I', (vocabulary.code(item['id'], item['name']) for item in items or []))
+
+
+def _decode_items(codes: array, vocabulary: Vocabulary) -> List[dict]:
+    return [{'name': vocabulary.name(code), 'id': vocabulary.label(code)} for code in codes]
 
 
 class Experience:
+    # Tags and substances are kept as arrays of codes in the shared vocabularies, and the dose chart by column,
+    # so that the whole corpus can be held in memory. The original lists of dicts are rebuilt when accessed.
+    __slots__ = ('exp_id', 'title', 'dose_rows', 'story', 'substance_codes', 'metadata', 'tag_codes')
+
     def __init__(self, exp_id: str, title: str, substances_details: list, story: List[str],
-                 substances_simple: List[str], metadata: dict, tags: List[dict]):
+                 substances_simple: List[dict], metadata: dict, tags: List[dict]):
         self.exp_id: str = exp_id
         self.title: str = title
-        self.substances_details: list = substances_details
-        self.story: List[str] = story
-        self.substances_simple: List[str] = substances_simple
-        self.metadata: dict = metadata
-        self.tags: List[dict] = tags
+        self.dose_rows: DoseRows = DoseRows(substances_details)
+        self.story: Tuple[str, ...] = tuple(story)
+        self.substance_codes: array = _encode_items(substances_simple, SUBSTANCES)
+        # Keys, and most values (gender, year...), are the same in every experience
+        self.metadata: Dict[str, str] = {sys.intern(key): sys.intern(value) if isinstance(value, str) else value
+                                         for key, value in metadata.items()}
+        self.tag_codes: array = _encode_items(tags, TAGS)
+
+    @property
+    def substances_details(self) -> List[dict]:
+        return list(self.dose_rows)
+
+    @property
+    def substances_simple(self) -> List[dict]:
+        return _decode_items(self.substance_codes, SUBSTANCES)
+
+    @property
+    def tags(self) -> List[dict]:
+        return _decode_items(self.tag_codes, TAGS)
+
+    @property
+    def tag_ids(self) -> List[str]:
+        return [TAGS.label(code) for code in self.tag_codes]
+
+    @property
+    def substance_ids(self) -> List[str]:
+        return [SUBSTANCES.label(code) for code in self.substance_codes]
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from scraper.coordinator import DONE, LEASED, PENDING, LeaseHeartbeat, LeaseQueue
+
+
+@pytest.fixture
+def queues(tmp_path):
+    db_path = str(tmp_path / 'leases.sqlite')
+    first = LeaseQueue(db_path, lease_seconds=0.2, worker='host-a')
+    second = LeaseQueue(db_path, lease_seconds=0.2, worker='host-b')
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_create_once(queues):
+    first, second = queues
+    assert first.create(1, 1000, batch_size=100) == 10
+    assert second.create(1, 1000, batch_size=100) == 0
+    assert len(second) == 10
+    assert second.counts() == {PENDING: 10}
+
+
+def test_workers_lease_distinct_batches(queues):
+    first, second = queues
+    first.create(1, 250, batch_size=100)
+    leases = [first.acquire(), second.acquire(), first.acquire()]
+    assert sorted((lease.first_id, lease.last_id) for lease in leases) == [(1, 100), (101, 200), (201, 250)]
+    assert first.acquire() is None
+    assert second.complete(leases[1], downloaded=80, failed=20)
+    assert first.counts() == {LEASED: 2, DONE: 1}
+    assert first.workers() == {'host-b': {'batches': 1, 'downloaded': 80, 'failed': 20}}
+
+
+def test_expired_lease_is_fenced(queues):
+    first, second = queues
+    first.create(1, 100, batch_size=100)
+    stale = first.acquire()
+    assert second.acquire() is None
+    time.sleep(0.3)
+    lease = second.acquire()
+    assert (lease.first_id, lease.token) == (stale.first_id, stale.token + 1)
+    assert not first.renew(stale)
+    assert stale.lost
+    assert not first.complete(stale)
+    assert not first.release(stale)
+    assert second.renew(lease)
+    assert second.complete(lease)
+    assert first.counts() == {DONE: 1}
+
+
+def test_release(queues):
+    first, second = queues
+    first.create(1, 100, batch_size=100)
+    lease = first.acquire()
+    assert first.release(lease)
+    assert second.acquire().first_id == lease.first_id
+
+
+def test_heartbeat_keeps_lease(queues):
+    first, second = queues
+    first.create(1, 100, batch_size=100)
+    lease = first.acquire()
+    with LeaseHeartbeat(first, lease, interval=0.05):
+        time.sleep(0.5)
+        assert second.acquire() is None
+    assert not lease.lost
+    time.sleep(0.3)
+    assert second.acquire().token == lease.token + 1
+
+
+def test_heartbeat_stops_once_lost(queues):
+    first, second = queues
+    first.create(1, 100, batch_size=100)
+    lease = first.acquire()
+    heartbeat = LeaseHeartbeat(first, lease, interval=0.35)
+    heartbeat.start()
+    time.sleep(0.25)
+    second.acquire()
+    heartbeat._thread.join(1)
+    assert not heartbeat._thread.is_alive()
+    assert lease.lost
+    heartbeat.stop()
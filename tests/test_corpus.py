@@ -0,0 +1,35 @@
+import pytest
+
+from scraper import corpus
+from scraper.corpus import CorpusStore
+
+
+def experience(title):
+    return {'title': title, 'metadata': {}, 'story_paragraphs': [], 'substances_details': [], 'tags': [],
+            'substances_main': []}
+
+
+@pytest.fixture(params=['fcntl', 'no fcntl'])
+def store(request, tmp_path, monkeypatch):
+    if request.param == 'no fcntl':
+        monkeypatch.setattr(corpus, 'fcntl', None)
+    return CorpusStore(str(tmp_path / 'corpus'))
+
+
+def test_compact_keeps_latest(store):
+    store.write_experience('1', experience('first'))
+    store.write_experience('1', experience('second'))
+    store.write_experience('2', experience('other'))
+    assert store.compact()
+    assert sorted((exp['exp_id'], exp['title']) for exp in store.read_experiences()) == [
+        ('1', 'second'), ('2', 'other')]
+
+
+def test_compact_skipped_while_written(tmp_path):
+    if corpus.fcntl is None:
+        pytest.skip('folders are not locked without fcntl')
+    writer = CorpusStore(str(tmp_path / 'corpus'))
+    writer.write_experience('1', experience('first'))
+    assert not CorpusStore(str(tmp_path / 'corpus')).compact()
+    writer.close()
+    assert CorpusStore(str(tmp_path / 'corpus')).compact()
@@ -0,0 +1,69 @@
+import pytest
+
+from scraper.doses import (NORMALIZED_FIELDS, normalize_dose, normalize_dose_rows, parse_amount, parse_route,
+                           parse_use_time)
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('1,000 mg', (1000, 'mg')),
+    ('1,000,000 ug', (1000, 'mg')),
+    ('2,500.5 mg', (2500.5, 'mg')),
+])
+def test_thousands_separator(raw, expected):
+    assert parse_amount(raw) == expected
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('1,5 g', (1500, 'mg')),
+    ('0,125 g', (125, 'mg')),
+    ('1,25 ml', (1.25, 'ml')),
+    ('1.5 g', (1500, 'mg')),
+])
+def test_decimal_comma(raw, expected):
+    assert parse_amount(raw) == expected
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('100 mg', (100, 'mg')),
+    ('1/2 tablet', (0.5, 'tablet')),
+    ('3-5 hits', (4, 'hit')),
+    ('about 2 g', (2000, 'mg')),
+    ('2 glasses', (2, 'glass')),
+    ('1 fl oz', (29.5735, 'ml')),
+    ('repeated', (None, None)),
+])
+def test_amounts(raw, expected):
+    assert parse_amount(raw) == expected
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('T+ 0:00', 0),
+    ('T+ 1:30', 90),
+    ('T- 0:15', -15),
+    ('t+12:05', 725),
+    ('', None),
+])
+def test_parse_use_time(raw, expected):
+    assert parse_use_time(raw) == expected
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('snorted', 'insufflated'),
+    (' Oral ', 'oral'),
+    ('IV', 'intravenous'),
+    ('Not Applicable', None),
+    ('', None),
+    ('Chewed', 'chewed'),
+])
+def test_parse_route(raw, expected):
+    assert parse_route(raw) == expected
+
+
+def test_normalize_dose_rows():
+    rows = [{'use_time': 'T+ 1:30', 'amount': '1.5 g', 'method': 'snorted', 'substance': 'Cocaine'},
+            {'use_time': '', 'amount': 'repeated', 'method': '', 'substance': 'Cannabis'}]
+    assert normalize_dose(rows[0]) == {'amount_value': 1500, 'amount_unit': 'mg', 'use_minutes': 90,
+                                       'route': 'insufflated'}
+    assert normalize_dose_rows(rows) is rows
+    assert rows[0]['substance'] == 'Cocaine' and rows[0]['use_minutes'] == 90
+    assert [rows[1][field] for field in NORMALIZED_FIELDS] == [None, None, None, None]
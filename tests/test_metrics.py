@@ -0,0 +1,46 @@
+import os
+import time
+
+from scraper.metrics import ScrapeMetrics
+from scraper.scrapers import ElementScraper, ListScraper
+from scraper.sessions import SessionManager
+
+
+class SlowElement(ElementScraper):
+
+    def get(self):
+        # Long enough for the workers to profile at the same time
+        time.sleep(0.02)
+        self.parse(b'<html><body><p>experience</p></body></html>')
+
+    def extract_data(self):
+        self.text = self.soup.get_text()
+
+    def save(self):
+        pass
+
+
+class SlowList(ListScraper):
+
+    def __init__(self, session_manager: SessionManager):
+        super().__init__()
+        self.session_manager = session_manager
+
+    def create_scraper(self, element_id: str, url: str) -> ElementScraper:
+        return SlowElement(url, session_manager=self.session_manager)
+
+
+def test_profile_concurrent_downloads(tmp_path):
+    scraper = SlowList(SessionManager(str(tmp_path / 'cache')))
+    scraper.urls_to_download = {str(exp_id): f"http://localhost/{exp_id}" for exp_id in range(40)}
+    profile_folder = str(tmp_path / 'profiles')
+    scraper.metrics = ScrapeMetrics(profile_rate=1, profile_folder=profile_folder)
+
+    scraper.download_concurrent(workers_per_server=4, wait=False)
+
+    counters = scraper.metrics.counters
+    assert scraper.urls_downloaded == 40
+    assert scraper.urls_failed == 0
+    assert counters['profiles'] + counters['profiles_skipped'] == 40
+    assert counters['profiles_skipped'] > 0
+    assert len(os.listdir(profile_folder)) == counters['profiles']
@@ -0,0 +1,47 @@
+import os
+
+from processor import ErowidJSONProcessor
+from scraper.writer import write_experience_file
+from search import ExperienceIndex
+
+SUBSTANCE_IDS = {'Cannabis': '1', 'Alcohol': '2'}
+
+
+def experience(*substances: str) -> dict:
+    return {'title': '', 'story_paragraphs': [], 'metadata': {},
+            'substances_main': [{'name': name, 'id': SUBSTANCE_IDS[name]} for name in substances],
+            'substances_details': [{'method': 'oral', 'route': 'oral'}],
+            'tags': [{'name': 'Glowing Experiences', 'id': '1'}]}
+
+
+def write_experiences(folder, experiences):
+    for exp_id, exp_dict in experiences.items():
+        write_experience_file(exp_dict, os.path.join(str(folder), f"{exp_id}.json"))
+
+
+def test_save_without_extension(tmp_path):
+    index = ExperienceIndex.from_experiences([dict(experience('Cannabis'), exp_id='1')])
+    index.save(str(tmp_path / 'index'))
+    assert os.listdir(tmp_path) == ['index.npz']
+    loaded = ExperienceIndex.load(str(tmp_path / 'index'))
+    assert loaded.search(['Cannabis']).exp_ids == ['1']
+
+
+def test_persisted_index(tmp_path, monkeypatch):
+    json_folder = tmp_path / 'experiences_db'
+    json_folder.mkdir()
+    write_experiences(json_folder, {'1': experience('Cannabis'), '2': experience('Cannabis', 'Alcohol')})
+    processor = ErowidJSONProcessor(str(json_folder))
+    assert sorted(processor.get_search_index().search(['Cannabis']).exp_ids) == ['1', '2']
+    assert os.path.isfile(processor.search_index_path())
+
+    built = []
+    from_experiences = ExperienceIndex.from_experiences
+    monkeypatch.setattr(ExperienceIndex, 'from_experiences',
+                        classmethod(lambda cls, experiences: built.append(1) or from_experiences(experiences)))
+    assert sorted(processor.get_search_index().exp_ids) == ['1', '2']
+    assert not built
+
+    write_experiences(json_folder, {'3': experience('Alcohol')})
+    assert sorted(processor.get_search_index().search(['Alcohol']).exp_ids) == ['2', '3']
+    assert built
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from scraper import sessions
+from scraper.experiences_scraper import ExperienceScraper
+from scraper.sessions import configure_session_manager
+
+
+@pytest.fixture
+def no_session_manager(monkeypatch):
+    monkeypatch.setattr(sessions, '_session_manager', None)
+    yield
+    if sessions._session_manager is not None:
+        sessions._session_manager.close()
+
+
+def test_no_implicit_cache(tmp_path, monkeypatch, no_session_manager):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(RuntimeError):
+        ExperienceScraper('https://www.erowid.org/experiences/exp.php?ID=1')
+    assert os.listdir(tmp_path) == []
+
+
+def test_configured_cache(tmp_path, no_session_manager):
+    session_manager = configure_session_manager(str(tmp_path / 'cache'))
+    scraper = ExperienceScraper('https://www.erowid.org/experiences/exp.php?ID=1')
+    assert scraper.session_manager is session_manager
+    assert os.listdir(tmp_path) == ['cache.sqlite']
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from scraper.state import DONE, FAILED, PENDING, DownloadState
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = DownloadState(str(tmp_path / 'state.sqlite'))
+    yield state
+    state.close()
+
+
+def elements(*exp_ids):
+    return [(exp_id, f"https://www.erowid.org/experiences/exp.php?ID={exp_id}") for exp_id in exp_ids]
+
+
+def test_statuses(state):
+    assert state.add_pending(elements('1', '2', '3')) == 3
+    assert state.add_pending(elements('3', '4')) == 1
+    state.mark_done('1')
+    state.mark_failed('2', 'IndexError')
+    state.mark_failed('5', 'MissingExperience', 'https://www.erowid.org/experiences/exp.php?ID=5')
+    assert state.counts() == {DONE: 1, FAILED: 2, PENDING: 2}
+    assert state.count_remaining() == 4
+    assert state.is_done('1') and not state.is_done('2')
+    assert state.failed('IndexError') == elements('2')
+    assert sorted(state.attempted_ids()) == ['1', '2', '5']
+
+
+def test_remaining(state):
+    state.add_pending(elements('1', '2', '3', '4'))
+    state.mark_done('2')
+    state.mark_failed('3', 'IndexError')
+    state.mark_failed('3', 'IndexError')
+    assert list(state.remaining(batch_size=2)) == elements('1', '3', '4')
+    assert list(state.remaining(max_attempts=2, batch_size=2)) == elements('1', '4')
+
+
+def test_remaining_until(state):
+    until = threading.Event()
+    state.add_pending(elements('1', '2', '3'))
+    remaining = state.remaining(batch_size=2, until=until)
+    assert [next(remaining) for _ in range(4)] == elements('1', '2', '3') + [None]
+    # Nothing new yet: None again, without stopping
+    assert next(remaining) is None
+    state.add_pending(elements('4'))
+    state.mark_done('1')
+    assert next(remaining) == elements('4')[0]
+    assert next(remaining) is None
+    # Elements added right before the end are streamed before stopping
+    state.add_pending(elements('5'))
+    until.set()
+    assert list(remaining) == elements('5')
+
+
+def test_import_failures_keeps_done(state, tmp_path):
+    folder = tmp_path / 'exp_links'
+    folder.mkdir()
+    (folder / 'failed_urls_IndexError.txt').write_text('\n'.join(url for _, url in elements('1', '2')) + '\n')
+    state.add_pending(elements('1', '2'))
+    state.mark_done('1')
+    state.import_failures(str(folder), lambda url: url.rsplit('=', 1)[1])
+    assert state.is_done('1')
+    assert state.failed('IndexError') == elements('2')
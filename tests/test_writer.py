@@ -0,0 +1,57 @@
+import json
+import os
+
+from scraper.writer import ExperienceWriter, PendingExperience
+
+
+def experience(title: str) -> dict:
+    return {'title': title, 'story_paragraphs': ['Día 1: ça va'], 'substances_details': [], 'substances_main': [],
+            'metadata': {}, 'tags': []}
+
+
+def pending(exp_id: str, exp_dict: dict, folder) -> PendingExperience:
+    return PendingExperience(exp_id, exp_dict, f"https://www.erowid.org/experiences/exp.php?ID={exp_id}",
+                             os.path.join(str(folder), f"{exp_id}.json"))
+
+
+def read(path: str) -> dict:
+    with open(path, encoding='utf-8') as open_json:
+        return json.load(open_json)
+
+
+def test_write_batch_replaces_files(tmp_path):
+    (tmp_path / '1.json').write_text('{"title": "previous"}')
+    written = []
+    writer = ExperienceWriter(on_written=written.extend)
+    writer.write_batch([pending('1', experience('Señor'), tmp_path), pending('2', experience('Two'), tmp_path)])
+    assert written == ['1', '2']
+    assert sorted(os.listdir(tmp_path)) == ['1.json', '2.json']
+    assert read(str(tmp_path / '1.json')) == experience('Señor')
+    assert 'Señor' in (tmp_path / '1.json').read_text(encoding='utf-8')
+
+
+def test_failed_experiences(tmp_path):
+    (tmp_path / '2.json').write_text('{"title": "previous"}')
+    written, failed = [], []
+    writer = ExperienceWriter(on_written=written.extend, on_failed=lambda *failure: failed.append(failure))
+    unserialisable = dict(experience('Two'), tags={'set'})
+    writer.write_batch([pending('1', experience('One'), tmp_path), pending('2', unserialisable, tmp_path),
+                        pending('3', experience('Three'), tmp_path / 'missing')])
+    assert written == ['1']
+    assert [(exp_id, error_name) for exp_id, _, error_name in failed] == [('2', 'TypeError'),
+                                                                         ('3', 'FileNotFoundError')]
+    assert writer.written == 1 and writer.failed == 2
+    # The previous version is kept, and no temporary file is left
+    assert sorted(os.listdir(tmp_path)) == ['1.json', '2.json']
+    assert read(str(tmp_path / '2.json')) == {'title': 'previous'}
+
+
+def test_background_writes(tmp_path):
+    written = []
+    writer = ExperienceWriter(max_queue=2, batch_size=3, batch_wait=0.01, on_written=written.extend)
+    writer.start()
+    for exp_id in range(10):
+        writer.put(str(exp_id), experience(str(exp_id)), '', str(tmp_path / f"{exp_id}.json"))
+    writer.close()
+    assert sorted(written, key=int) == [str(exp_id) for exp_id in range(10)]
+    assert len(os.listdir(tmp_path)) == 10